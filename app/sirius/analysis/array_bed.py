@@ -0,0 +1,157 @@
+import numpy as np
+from sirius.query.idset import IdSet, current_dictionary
+
+def get_array_interval(d):
+    """ Convert a gnode dictionary to a (contig, start, end, _id) tuple in bed coordinates """
+    return (d['contig'], d['start']-1, d['end'], d['_id'])
+
+class ArrayBed:
+    """ The ArrayBed class is an in-memory replacement of the Bed class for genome arithmetics.
+    It keeps the intervals of each contig as numpy arrays sorted by start, and implements
+    intersect and window with a vectorized searchsorted, without temporary files or bedtools subprocesses.
+
+    Attributes
+    ----------
+    contigs: dict
+        For each contig, a tuple of three numpy arrays (starts, ends, codes) sorted by starts.
+        The coordinates are 0-based and half-open like in bed files,
+        the codes are the integer codes of the interval names in dictionary.
+
+    dictionary: IdDictionary
+        The dictionary of the codes, the one of the new IdSets when this ArrayBed was created.
+
+    __len__: int
+        Number of intervals contained in this ArrayBed() object.
+
+    """
+    def __init__(self, intervals=None):
+        """ Initializer of ArrayBed class.
+
+        Parameters
+        ----------
+        intervals: None, tuple, list, generator
+        None: Empty ArrayBed() object
+        list/tuple/generator: loops over the input, each being a gnode dictionary or a bed interval tuple (contig, start, end, name, ...)
+        """
+        self.contigs = dict()
+        self.dictionary = current_dictionary()
+        if intervals is None:
+            return
+        contig_lists = dict()
+        for d in intervals:
+            if isinstance(d, dict):
+                d = get_array_interval(d)
+            contig_lists.setdefault(d[0], []).append(d[1:4])
+        for contig, ivs in contig_lists.items():
+            starts = np.array([iv[0] for iv in ivs], dtype=np.int64)
+            ends = np.array([iv[1] for iv in ivs], dtype=np.int64)
+            codes = self.dictionary.encode(iv[2] for iv in ivs)
+            self._set_contig(contig, starts, ends, codes)
+
+    def _set_contig(self, contig, starts, ends, codes):
+        order = np.lexsort((ends, starts))
+        self.contigs[contig] = (starts[order], ends[order], codes[order])
+
+    def __len__(self):
+        return sum(len(starts) for starts, ends, codes in self.contigs.values())
+
+    def __iter__(self):
+        """ Iterate over the intervals as (contig, start, end, name) tuples """
+        for contig, (starts, ends, codes) in self.contigs.items():
+            yield from zip([contig]*len(starts), starts.tolist(), ends.tolist(), self.dictionary.decode(codes))
+
+    def __eq__(self, target):
+        if len(self) != len(target):
+            return False
+        return sorted(self) == sorted(target)
+
+    def copy(self):
+        """ Create a copy of the ArrayBed() object. """
+        newBed = ArrayBed()
+        newBed.contigs = dict(self.contigs)
+        newBed.dictionary = self.dictionary
+        return newBed
+
+    def extend(self, d):
+        """ Modify the intervals by extending each to left and right by {d} """
+        self.extend_asym(d, d)
+
+    def extend_asym(self, dl, dr):
+        """ Extend the range of each interval, by dl to left and dr to right """
+        for contig, (starts, ends, codes) in list(self.contigs.items()):
+            self._set_contig(contig, starts - dl, ends + dr, codes)
+
+    def gids(self):
+        """ Return an IdSet of gnode ids in this ArrayBed """
+        if not self.contigs:
+            return IdSet()
+        codes = np.concatenate([codes for starts, ends, codes in self.contigs.values()])
+        return IdSet.from_codes(np.unique(codes), self.dictionary)
+
+    def _select_overlapping(self, b, window=0, invert=False):
+        """ Select the intervals in self that overlap with any interval in b, after extending b by window on both sides """
+        c = ArrayBed()
+        c.dictionary = self.dictionary
+        for contig, (starts, ends, codes) in self.contigs.items():
+            if contig in b.contigs:
+                b_starts, b_ends, b_codes = b.contigs[contig]
+                # b is sorted by start, so b[:idx] are all intervals that start before each of our ends
+                idx = np.searchsorted(b_starts - window, ends, side='left')
+                # among them, any overlap iff the max end is after our start
+                max_b_ends = np.maximum.accumulate(b_ends + window)
+                mask = (idx > 0) & (max_b_ends[np.maximum(idx-1, 0)] > starts)
+            else:
+                mask = np.zeros(len(starts), dtype=bool)
+            if invert:
+                mask = ~mask
+            if mask.any():
+                c.contigs[contig] = (starts[mask], ends[mask], codes[mask])
+        return c
+
+    def intersect(self, b):
+        """ intersect method, the same as BedTool.intersect(b, u=True)
+
+        Parameters
+        ----------
+        b: ArrayBed
+            Target ArrayBed() object to be intersected with
+
+        Returns
+        -------
+        c: ArrayBed
+            ArrayBed() object that contains all intervals in {self} which intersects with {b}.
+        """
+        return self._select_overlapping(b)
+
+    def window(self, b, window=1000):
+        """ window method, the same as BedTool.window(b, w=window, u=True)
+
+        Parameters
+        ----------
+        b: ArrayBed
+            Target ArrayBed() object to be windowed with
+
+        window: int, default 1000
+            The window size
+
+        Returns
+        -------
+        c: ArrayBed
+            ArrayBed() object that contains all intervals in {self} which is within {window} from any interval in {b}.
+        """
+        return self._select_overlapping(b, window=window)
+
+    def diff(self, b):
+        """ diff method, the same as BedTool.intersect(b, v=True)
+
+        Parameters
+        ----------
+        b: ArrayBed
+            Target ArrayBed() object to be subtracted
+
+        Returns
+        -------
+        c: ArrayBed
+            ArrayBed() object that contains all intervals in {self} which does not intersect with {b}.
+        """
+        return self._select_overlapping(b, invert=True)
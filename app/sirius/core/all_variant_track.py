@@ -1,18 +1,71 @@
-from sirius.core.utilities import threadsafe_lru
+"""
+Data of the "all variants" track, served from cached tiles.
+
+Requests are snapped to tiles of a power-of-two number of base pairs, chosen by the zoom level of the request:
+the smallest tile size of at least TILE_MIN_BITS that fits the requested span, so a request covers one or two tiles.
+Whole tiles are fetched and cached, the response is assembled by slicing them, and the neighbor tiles are
+prefetched in the background, so panning and small zooms are answered from the cache.
+The tiles of zoomed out views can hold a whole chromosome of variants, so the cache is sized by the total number of variants.
+"""
+
+import bisect
+from sirius.core.utilities import threadsafe_lru, threadsafe_sized_lru, BackgroundRunner
+from sirius.core.shared_cache import shared_cached
 from sirius.mongo import GenomeNodes
+from sirius.helpers.loaddata import loaded_contig_info_dict
 
-@threadsafe_lru(maxsize=128)
-def get_all_variants_in_range(contig, start_bp, end_bp):
+# the smallest tiles have 2**16 bp
+TILE_MIN_BITS = 16
+# the total number of variants in the tiles kept in each process
+TILE_CACHE_ROWS = 4000000
+# the tiles are prefetched in their own pool, so they don't wait behind the contig queries of the other tracks
+tile_prefetcher = BackgroundRunner(max_workers=2, max_pending=4, name='sirius_tile_prefetch')
+
+def tile_bits_for_span(start_bp, end_bp):
+    """ Return the log2 of the tile size for a request, the smallest power of two of at least the span """
+    span = end_bp - start_bp + 1
+    return max(TILE_MIN_BITS, (span - 1).bit_length())
+
+@threadsafe_sized_lru(maxsize=TILE_CACHE_ROWS, getsizeof=lambda tile: max(len(tile[0]), 1))
+@shared_cached()
+def get_variant_tile(contig, tile_bits, tile_index):
+    """
+    Return the variants with start in [tile_index * 2**tile_bits, (tile_index + 1) * 2**tile_bits), sorted by start,
+    with the list of their starts for bisect
+    """
+    tile_start = tile_index << tile_bits
     qfilt = {
         'type': {'$in': ['SNP', 'variant']},
         'contig': contig,
         'start': {
-            '$gte': start_bp,
-            '$lte': end_bp
+            '$gte': tile_start,
+            '$lt': tile_start + (1 << tile_bits)
         }
     }
     result = []
-    for d in GenomeNodes.find(qfilt, projection=['_id', 'start', 'info.variant_ref', 'info.variant_alt']):
+    for d in GenomeNodes.find(qfilt, projection=['_id', 'start', 'info.variant_ref', 'info.variant_alt'], sort=[('start', 1)]):
         d['id'] = d.pop('_id')
         result.append(d)
+    starts = [d['start'] for d in result]
+    return starts, result
+
+def prefetch_tiles(contig, tile_bits, tile_indices):
+    """ Load the tiles within the contig into the cache in the background """
+    contig_length = loaded_contig_info_dict.get(contig, {}).get('length', float('inf'))
+    for tile_index in tile_indices:
+        if 0 <= tile_index and (tile_index << tile_bits) <= contig_length:
+            tile_prefetcher.submit(get_variant_tile, contig, tile_bits, tile_index)
+
+@threadsafe_lru(maxsize=128)
+def get_all_variants_in_range(contig, start_bp, end_bp):
+    tile_bits = tile_bits_for_span(start_bp, end_bp)
+    first_tile, last_tile = start_bp >> tile_bits, end_bp >> tile_bits
+    result = []
+    for tile_index in range(first_tile, last_tile + 1):
+        starts, variants = get_variant_tile(contig, tile_bits, tile_index)
+        i_start = bisect.bisect_left(starts, start_bp)
+        i_end = bisect.bisect_right(starts, end_bp)
+        result += variants[i_start:i_end]
+    # the next request is likely a pan to one side
+    prefetch_tiles(contig, tile_bits, [first_tile - 1, last_tile + 1])
     return result
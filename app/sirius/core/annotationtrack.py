@@ -5,51 +5,52 @@ from scipy.spatial.distance import pdist
 from scipy.cluster import hierarchy
 
 from sirius.core.utilities import threadsafe_lru
+from sirius.core.shared_cache import shared_cached
+from sirius.core.track_columns import TrackColumns
 from sirius.query.query_tree import QueryTree
-from sirius.core.utilities import HashableDict
+from sirius.query.canonical import CanonicalQuery
 from sirius.helpers.constants import AGGREGATION_THRESH
 from sirius.helpers.loaddata import loaded_genome_contigs
 
+# the fields of the tuples given to get_genome_segments()
+ANNOTATION_FIELDS = ['start', 'end', '_id', 'name', 'type']
+
 @threadsafe_lru(maxsize=8192)
+@shared_cached()
 def get_annotation_query_results(query):
+    """ Return a dictionary from each contig to the TrackColumns of the results of query """
     qt = QueryTree(query)#, verbose=True)
     # we split the results into contigs
-    contig_genome_data, contig_start_bps = dict(), dict()
-    for contig in loaded_genome_contigs:
-        contig_genome_data[contig] = []
-        contig_start_bps[contig] = []
-    # put the results in to cache
+    contig_genome_data = {contig: [] for contig in loaded_genome_contigs}
     for gnode in qt.find(projection=['_id', 'contig', 'start', 'end', 'name', 'type']):
-        genome_data = (gnode['start'], gnode['end'], gnode['_id'], gnode['name'], gnode['type'])
-        contig_genome_data[gnode['contig']].append(genome_data)
-    # sort the results based on the start
+        contig_genome_data[gnode.pop('contig')].append(gnode)
+    # store the results by columns, sorted like the (start, end, _id, name, type) tuples
+    contig_columns = dict()
     for contig, genome_data_list in contig_genome_data.items():
-        genome_data_list.sort()
-        # save the 1-D array of starting loation
-        contig_start_bps[contig] = np.array([d[0] for d in genome_data_list])
-    return contig_genome_data, contig_start_bps
+        genome_data_list.sort(key=lambda d: (d['start'], d['end'], d['_id'], d['name'], d['type']))
+        contig_columns[contig] = TrackColumns(genome_data_list, ANNOTATION_FIELDS)
+    return contig_columns
 
 def get_annotation_query(annotation_id, contig, start_bp, end_bp, sampling_rate, track_height_px, query, verbose=True):
     t0 = time.time()
-    query_genome_data, query_start_bps = get_annotation_query_results(HashableDict(query))
-    contig_genome_data = query_genome_data[contig]
-    contig_start_bps = query_start_bps[contig]
-    total_query_count = len(contig_genome_data)
+    contig_columns = get_annotation_query_results(CanonicalQuery(query))[contig]
+    total_query_count = len(contig_columns)
     t1 = time.time()
     if verbose:
         print(f"{total_query_count} gnome_query_results; {t1-t0:.3f} seconds \n Query: {query} \n {get_annotation_query_results.cache_info()}")
-    # find the data in range
-    start_idx, end_idx = np.searchsorted(contig_start_bps, [start_bp, end_bp])
-    genome_data_in_range = contig_genome_data[start_idx:end_idx]
-    count_in_range = len(genome_data_in_range)
+    # find the data overlapping the range
+    columns_in_range = contig_columns.overlapping(start_bp, end_bp)
+    count_in_range = len(columns_in_range)
     t2 = time.time()
     if verbose:
         print(f"Found {count_in_range} data in range; {t2-t1:.3f} seconds")
     aggregation_on = sampling_rate > AGGREGATION_THRESH
     if aggregation_on: # turn on aggregation!
-        pos_in_range = contig_start_bps[start_idx:end_idx]
+        pos_in_range = columns_in_range.starts
         ret = get_aggregation_segments(pos_in_range, sampling_rate, track_height_px)
     else:
+        # only the tuples in view are built
+        genome_data_in_range = columns_in_range.tuples(ANNOTATION_FIELDS)
         ret = get_genome_segments(genome_data_in_range, sampling_rate, track_height_px)
     t3 = time.time()
     if verbose:
@@ -1,10 +1,14 @@
 from sirius.mongo import Edges
-from sirius.core.utilities import get_data_with_id
+from sirius.core.utilities import get_data_with_id, get_data_with_ids
 
 def node_relations(data_id):
     result = []
-    for edge in Edges.find({'from_id': data_id}, limit=100):
-        target_data = get_data_with_id(edge['to_id'])
+    out_edges = list(Edges.find({'from_id': data_id}, limit=100))
+    in_edges = list(Edges.find({'to_id': data_id}, limit=100))
+    # fetch all neighbors at once instead of one round trip each
+    neighbors = get_data_with_ids([edge['to_id'] for edge in out_edges] + [edge['from_id'] for edge in in_edges])
+    for edge in out_edges:
+        target_data = neighbors.get(edge['to_id'])
         if target_data:
             description = 'To ' + target_data['type'] + ' ' + target_data['name']
         else:
@@ -16,8 +20,8 @@ def node_relations(data_id):
             'description': description,
             'id': edge['_id']
         })
-    for edge in Edges.find({'to_id': data_id}, limit=100):
-        target_data = get_data_with_id(edge['from_id'])
+    for edge in in_edges:
+        target_data = neighbors.get(edge['from_id'])
         if target_data:
             description = 'From ' + target_data['type'] + ' ' + target_data['name']
         else:
@@ -1,30 +1,38 @@
-import numpy as np
 import time
-from sirius.core.utilities import HashableDict, threadsafe_lru
+from sirius.core.utilities import threadsafe_lru, run_in_background, nearby_contigs, contig_query, rows_on_contig
+from sirius.core.shared_cache import shared_cached
+from sirius.core.track_columns import TrackColumns
+from sirius.query.canonical import CanonicalQuery
 from sirius.query.query_tree import QueryTree
-from sirius.helpers.loaddata import loaded_genome_contigs
+from sirius.query.subsumption import SubsumptionIndex
+from sirius.query.matching import match_filter
+from sirius.mongo.utils import lookup_stats
+from sirius.helpers.loaddata import loaded_primary_contigs
 
-def get_intervals_in_range(contig, start_bp, end_bp, query, fields=None, verbose=True):
+def get_interval_columns_in_range(contig, start_bp, end_bp, query, fields=None, verbose=True):
+    """ Return the TrackColumns of the results of query on contig overlapping [start_bp, end_bp) """
     # default fields to empty list
     if fields is None: fields = []
     # lode cached data
     t0 = time.time()
-    query_genome_data, query_start_bps = get_interval_query_results(HashableDict(query), tuple(sorted(fields)))
-    contig_genome_data = query_genome_data[contig]
-    contig_start_bps = query_start_bps[contig]
-    total_query_count = len(contig_genome_data)
+    query = CanonicalQuery(query)
+    fields = tuple(sorted(fields))
+    contig_columns = get_interval_contig_results(query, fields, contig)
+    # the nearby contigs are likely to be viewed next
+    for other_contig in nearby_contigs(contig, loaded_primary_contigs):
+        run_in_background(get_interval_contig_results, query, fields, other_contig)
+    total_query_count = len(contig_columns)
     t1 = time.time()
     if verbose:
-        print(f"{total_query_count} interval_results; {t1-t0:.3f} s \n Query: {query} \n {get_interval_query_results.cache_info()}")
-    if len(contig_genome_data) == 0:
-        return []
-    # find data in view range
-    start_idx, end_idx = np.searchsorted(contig_start_bps, [start_bp, end_bp])
-    genome_data_in_range = contig_genome_data[start_idx:end_idx]
-    count_in_range = len(genome_data_in_range)
-    t2 = time.time()
+        print(f"{total_query_count} interval_results; {t1-t0:.3f} s \n Query: {query} \n {get_interval_contig_results.cache_info()} \n lookup_stats: {lookup_stats.summary()}")
+    columns_in_range = contig_columns.overlapping(start_bp, end_bp)
     if verbose:
-        print(f"Found {count_in_range} interval_results in range; {t2-t1:.3f} seconds")
+        print(f"Found {len(columns_in_range)} interval_results in range; {time.time()-t1:.3f} seconds")
+    return columns_in_range
+
+def get_intervals_in_range(contig, start_bp, end_bp, query, fields=None, verbose=True):
+    # only the rows in view are built
+    genome_data_in_range = get_interval_columns_in_range(contig, start_bp, end_bp, query, fields=fields, verbose=verbose).rows()
     # form return format
     result = []
     for d in genome_data_in_range:
@@ -40,21 +48,44 @@ def get_intervals_in_range(contig, start_bp, end_bp, query, fields=None, verbose
         result.append(ret_d)
     return result
 
+# cached results of broader queries, that can answer queries with more filters
+interval_subsumption = SubsumptionIndex()
+
+def interval_results_from_broader(query, projection, contig):
+    """ Select the results of query on contig from the cached results of a broader query, return None if there is none """
+    found = interval_subsumption.find(query, projection)
+    if found is None:
+        return None
+    broad_columns, residual = found
+    # the contig is not stored in the rows
+    defaults = {'contig': contig}
+    genome_data = [d for d in broad_columns.rows() if match_filter(d, residual, defaults)]
+    if query.get('limit', 0) > 0 and len(genome_data) > query['limit']:
+        # MongoDB would return only some of these rows
+        return None
+    return TrackColumns(genome_data, broad_columns.names)
+
 @threadsafe_lru(maxsize=8192)
-def get_interval_query_results(query, fields):
+@shared_cached()
+def get_interval_contig_results(query, fields, contig):
+    """
+    Return the TrackColumns of the results of query on one contig.
+    Each contig is queried and cached on its own, so the first view of a query doesn't wait for the whole genome.
+    The limit of the query applies to each contig.
+    """
+    # the columns of the rows, the contig is not stored
+    names = ['_id', 'start', 'length', 'type', 'name'] + list(fields)
+    query = contig_query(query, contig)
+    if query is None:
+        return TrackColumns([], names)
     print(f'-----thread running {query}')
+    projection = names + ['contig']
+    result = interval_results_from_broader(query, projection, contig)
+    if result is not None:
+        print('-----answered from a broader cached query')
+        return result
     qt = QueryTree(query)
-    # we split the results into contigs
-    genome_data = {contig: [] for contig in loaded_genome_contigs}
-    # put the results in to cache
-    projection = ['_id', 'contig', 'start', 'length', 'type', 'name'] + list(fields)
-    for gnode in qt.find(projection=projection):
-        contig = gnode.pop('contig')
-        genome_data[contig].append(gnode)
-    # sort the results based on the start
-    start_bps = dict()
-    for contig, genome_data_list in genome_data.items():
-        genome_data_list.sort(key=lambda d: d['start'])
-        # save the 1-D array of starting loation
-        start_bps[contig] = np.array([d['start'] for d in genome_data_list])
-    return genome_data, start_bps
+    # the columns are sorted by start
+    columns = TrackColumns(rows_on_contig(qt.find(projection=projection), contig), names)
+    interval_subsumption.add(query, projection, columns, len(columns))
+    return columns
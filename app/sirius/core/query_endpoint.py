@@ -1,61 +1,130 @@
+import json
+import base64
+import bisect
+import heapq
 import threading
-from pymongo.errors import CursorNotFound
 
 from sirius.query.query_tree import QueryTree
 from sirius.query.query_edge import QueryEdge
 from sirius.query.genome_query_node import GenomeQueryNode
+from sirius.query.budget import QueryBudget, find_kwargs, command_kwargs
+from sirius.query.idset import IdSet
+from sirius.mongo.utils import batched_lookup, map_id_batches, in_filter
 from sirius.core.utilities import threadsafe_lru
+from sirius.core.shared_cache import shared_cached
 
 
 class QueryResultsCache:
     """
-    Class that implemented dynamic caching for query results
+    Class that implemented keyset pagination for query results
+
+    The results are ordered by '_id'. Instead of keeping every loaded row in memory, we only keep checkpoints,
+    each being the '_id' of the last row before an offset. A page at any offset resumes from the nearest checkpoint
+    with a range predicate on '_id', so memory stays bounded and deep pages don't rescan from the beginning.
+    The continuation tokens returned to the client encode the same (offset, '_id') pair.
     """
+    # also save a checkpoint every this many rows when scanning through results
+    checkpoint_interval = 1000
+
     def __init__(self, query, projection=None):
         self.query = query
         self.qt = QueryTree(query)
         self.projection = projection
-        self.loaded_data = []
-        self.load_finished = False
-        self.data_generator = self.qt.find(projection=self.projection)
+        # offset -> '_id' of the row before that offset, None for the beginning
+        self.checkpoints = {0: None}
+        self.checkpoint_offsets = [0]
+        # total number of results, known once the end is reached
+        self.total = None
         self.lock = threading.Lock()
 
-    def __getitem__(self, key):
-        if self.load_finished is True:
-            return self.loaded_data[key]
-        elif isinstance(key, slice):
-            if key.step is not None and key.step <= 0:
-                raise ValueError("slice step cannot be zero or negative")
-            self.load_data_until(key.stop)
-            return self.loaded_data[key]
-        elif isinstance(key, int):
-            self.load_data_until(key + 1)
-            return self.loaded_data[key]
-        else:
-            raise TypeError(f"list indices must be integers or slices, not {type(key)}")
+    @property
+    def load_finished(self):
+        return self.total is not None
 
-    def load_data_until(self, index=None):
-        # if we already have that many results
-        if index is not None and index < len(self.loaded_data): return
-        # iteratively load data into cache
+    def add_checkpoint(self, offset, last_id):
         with self.lock:
-            try:
-                for data in self.data_generator:
-                    # convert "_id" to "id" for frontend
-                    data['id'] = data.pop('_id')
-                    self.loaded_data.append(data)
-                    # here we load one more data than requested, so we know if all data loaded
-                    if index is not None and len(self.loaded_data) > index:
-                        break
-                else:
-                    # all data loaded
-                    self.load_finished = True
-            except CursorNotFound:
-                print(f"*** Cursor not found for query {self.query}, restart loading")
-                self.loaded_data = []
-                self.load_finished = False
-                self.data_generator = self.qt.find(projection=self.projection)
-                self.load_data_until(index)
+            if offset not in self.checkpoints:
+                self.checkpoints[offset] = last_id
+                bisect.insort(self.checkpoint_offsets, offset)
+
+    def nearest_checkpoint(self, offset):
+        """ Return the largest checkpoint offset <= offset, and its '_id' """
+        with self.lock:
+            i = bisect.bisect_right(self.checkpoint_offsets, offset) - 1
+            cp_offset = self.checkpoint_offsets[i]
+            return cp_offset, self.checkpoints[cp_offset]
+
+    def get_page(self, start, end=None):
+        """
+        Get the results in the range [start, end)
+
+        Parameters
+        ----------
+        start: int
+            Offset of the first result
+        end: int, optional
+            Offset after the last result, None means until the end of results
+
+        Returns
+        -------
+        rows: list
+            The results, with '_id' renamed as 'id' for the frontend
+        reached_end: bool
+            True if there are no more results after these rows
+        """
+        if self.total is not None:
+            start = min(start, self.total)
+            end = self.total if end is None else min(end, self.total)
+        cp_offset, after_id = self.nearest_checkpoint(start)
+        return self.get_page_after(cp_offset, after_id, start, end)
+
+    def get_page_after(self, offset, after_id, start, end=None, trusted=True):
+        """
+        Scan results with '_id' after after_id, which is at offset, collect the rows in [start, end)
+        The checkpoints and the total are only recorded for a trusted position, the position in a client token could be anything.
+        """
+        # the query tree is kept between requests, so each page gets a new time budget
+        self.qt.set_budget(QueryBudget())
+        # we load one more row than requested, so we know if all data loaded
+        limit = 0 if end is None else end - offset + 1
+        rows = []
+        reached_end = True
+        last_id = after_id
+        for data in self.qt.find_sorted(projection=self.projection, start_after=after_id, limit=limit, offset=offset):
+            if end is not None and offset >= end:
+                reached_end = False
+                break
+            last_id = data['_id']
+            if offset >= start:
+                # convert "_id" to "id" for frontend
+                data['id'] = data.pop('_id')
+                rows.append(data)
+            offset += 1
+            if trusted and offset % self.checkpoint_interval == 0:
+                self.add_checkpoint(offset, last_id)
+        if trusted:
+            self.add_checkpoint(offset, last_id)
+            if reached_end:
+                self.total = offset
+        return rows, reached_end
+
+    def get_page_from_token(self, token, page_size):
+        """ Get the next page_size results after a continuation token, return (rows, start, reached_end) """
+        offset, after_id = decode_page_token(token)
+        rows, reached_end = self.get_page_after(offset, after_id, offset, offset + page_size, trusted=False)
+        return rows, offset, reached_end
+
+def encode_page_token(offset, last_id):
+    """ Encode the position after a page into an opaque continuation token """
+    return base64.urlsafe_b64encode(json.dumps([offset, last_id]).encode()).decode()
+
+def decode_page_token(token):
+    """ Decode a continuation token into (offset, last_id), raise ValueError if invalid """
+    try:
+        offset, last_id = json.loads(base64.urlsafe_b64decode(token.encode()).decode())
+    except Exception:
+        raise ValueError(f"Invalid page token {token}")
+    return int(offset), last_id
 
 
 @threadsafe_lru(maxsize=1024)
@@ -71,6 +140,157 @@ def get_query_basic_results(query):
     basic_projection = ['_id', 'source', 'type', 'name', 'contig', 'start', 'end', 'info.description']
     return QueryResultsCache(query, projection=basic_projection)
 
+@threadsafe_lru(maxsize=1024)
+@shared_cached()
+def get_query_count(query, estimate=False):
+    """ Cached function for counting query results, estimate=True gives a fast estimate for very large results """
+    if not query: return 0
+    return QueryTree(query, budget=QueryBudget()).count(estimate=estimate)
+
+class GWASResults:
+    """
+    Class that produces the results of a GWAS query lazily, in the order of p-values.
+
+    The lowest p-value of each SNP is computed by MongoDB with a $group on the association Edges,
+    and kept in a heap of (p-value, '_id'). Each page pops the next SNPs from the heap, and only fetches their documents,
+    so the first page is ready without loading all the SNPs. The SNPs without a p-value are loaded at the end.
+    """
+    # the fields shown in the GWAS view
+    projection = ['_id', 'source', 'type', 'name', 'contig', 'start', 'end', 'info.variant_ref', 'info.variant_alt']
+    # number of SNPs fetched from the heap at once
+    fetch_size = 1000
+
+    def __init__(self, query):
+        self.qt = QueryTree(query)
+        self.genome_query_node = self.qt.head
+        query_edges = self.genome_query_node.edges
+        assert len(query_edges) == 1, "GWAS SNP query should have exactly one edge"
+        assert self.genome_query_node.edge_rule == 0, "The edge rule of GWAP SNP query should be 0 (and)"
+        self.query_edge = query_edges[0]
+        self.rows = []
+        self.heap = None
+        self.pvalue_ids = None
+        self.no_pvalue_ids = None
+        self.allowed_ids = None
+        self.lock = threading.Lock()
+
+    def min_pvalues(self):
+        """
+        Return a dictionary from the SNP '_id' to the lowest p-value of its Edges, computed with $group.
+        If the edge has a limit, it is a quota of Edges like in QueryEdge.find_from_id(), so the same Edges are fetched instead.
+        """
+        edge = self.query_edge
+        from_id_key, to_id_key = ('to_id', 'from_id') if edge.reverse else ('from_id', 'to_id')
+        if edge.limit > 0:
+            return self.limited_min_pvalues(from_id_key, to_id_key)
+        mongo_filter = restrict_pvalue_filter(edge.filter)
+        def group_pvalues(batch_filter):
+            pipeline = [
+                {'$match': batch_filter},
+                {'$group': {'_id': '$' + from_id_key, 'pvalue': {'$min': '$info.p-value'}}},
+            ]
+            return list(edge.mongo_collection.aggregate(pipeline, allowDiskUse=True, **command_kwargs(self.qt.budget)))
+        if edge.nextnode is None:
+            groups = [group_pvalues(mongo_filter)]
+        else:
+            target_ids = edge.nextnode.findid()
+            groups = map_id_batches(lambda b: group_pvalues(in_filter(mongo_filter, to_id_key, b)), target_ids)
+        gid_score = dict()
+        for group in groups:
+            for d in group:
+                gid, pvalue = d['_id'], d['pvalue']
+                if gid not in gid_score or pvalue < gid_score[gid]:
+                    gid_score[gid] = pvalue
+        return gid_score
+
+    def limited_min_pvalues(self, from_id_key, to_id_key):
+        """ Implementation of min_pvalues() for an edge with a limit, the Edges without a p-value count toward the limit """
+        edge = self.query_edge
+        projection = {from_id_key: 1, 'info.p-value': 1}
+        if edge.nextnode is None:
+            docs = edge.mongo_collection.find(edge.filter, projection, limit=edge.limit, **find_kwargs(self.qt.budget))
+        else:
+            docs = batched_lookup(edge.mongo_collection, edge.nextnode.findid(), field=to_id_key, mongo_filter=edge.filter,
+                                  limit=edge.limit, projection=projection, **find_kwargs(self.qt.budget))
+        gid_score = dict()
+        for d in docs:
+            gid, pvalue = d[from_id_key], d.get('info', {}).get('p-value')
+            if pvalue is not None and (gid not in gid_score or pvalue < gid_score[gid]):
+                gid_score[gid] = pvalue
+        return gid_score
+
+    def start(self):
+        gid_score = self.min_pvalues()
+        if self.genome_query_node.arithmetics:
+            # the filter of the node is not enough to check the SNPs, use the ids of the node
+            self.allowed_ids = self.genome_query_node.findid()
+            gid_score = {gid: p for gid, p in gid_score.items() if gid in self.allowed_ids}
+        self.heap = [(pvalue, gid) for gid, pvalue in gid_score.items()]
+        heapq.heapify(self.heap)
+        self.pvalue_ids = IdSet(gid_score.keys())
+
+    def fetch(self, gids, pvalues=None):
+        """ Fetch the SNP documents of gids that match the genome node, in the order of gids """
+        mongo_filter = self.genome_query_node.filter
+        docs = dict()
+        for d in batched_lookup(self.genome_query_node.mongo_collection, gids, mongo_filter=mongo_filter,
+                                projection=self.projection, **find_kwargs(self.qt.budget)):
+            docs[d['_id']] = d
+        rows = []
+        for i, gid in enumerate(gids):
+            gnode = docs.get(gid)
+            if gnode is None:
+                continue
+            # replace _id by id
+            gnode['id'] = gnode.pop('_id')
+            gnode.setdefault('info', dict())['p-value'] = pvalues[i] if pvalues is not None else None
+            rows.append(gnode)
+        return rows
+
+    def load_more(self):
+        """ Load the next SNPs into self.rows, return False if there are no more """
+        # the state only changes after a successful fetch, so a page over budget can be requested again
+        if self.heap:
+            n = min(self.fetch_size, len(self.heap))
+            popped = [heapq.heappop(self.heap) for _ in range(n)]
+            try:
+                rows = self.fetch([gid for _, gid in popped], [pvalue for pvalue, _ in popped])
+            except Exception:
+                for item in popped:
+                    heapq.heappush(self.heap, item)
+                raise
+            self.rows += rows
+            return True
+        if self.no_pvalue_ids is None:
+            # the SNPs connected by Edges without a p-value come last
+            no_pvalue_ids = self.query_edge.find_from_id() - self.pvalue_ids
+            if self.allowed_ids is not None:
+                no_pvalue_ids &= self.allowed_ids
+            no_pvalue_ids = list(no_pvalue_ids)
+            self.rows += self.fetch(no_pvalue_ids)
+            self.no_pvalue_ids = no_pvalue_ids
+            return True
+        return False
+
+    def get_page(self, start, end=None):
+        """ Get the results in the range [start, end), return (rows, reached_end) """
+        with self.lock:
+            self.qt.set_budget(QueryBudget())
+            if self.heap is None:
+                self.start()
+            while end is None or len(self.rows) <= end:
+                if not self.load_more():
+                    break
+            reached_end = end is None or len(self.rows) <= end
+            return self.rows[start:end], reached_end
+
+def restrict_pvalue_filter(mongo_filter):
+    """ Only the Edges with a p-value are used to find the lowest p-values """
+    pvalue_filter = {'info.p-value': {'$ne': None}}
+    if 'info.p-value' in mongo_filter:
+        return {'$and': [mongo_filter, pvalue_filter]}
+    return {**mongo_filter, **pvalue_filter}
+
 @threadsafe_lru(maxsize=1024)
 def get_query_gwas_results(query):
     """ Cached function for getting gwas query results
@@ -80,43 +300,7 @@ def get_query_gwas_results(query):
     2.  The returning SNPs will be sorted by the info.p-value from lowest to highest.
         The SNPs that do not have any p-value from associations, they will have info.p-value = None
     3.  The limit is ignored for the resulting SNPs.
+    The results are loaded page by page with GWASResults.get_page()
     """
-    if not query: return []
-    # build a QueryTree
-    qt = QueryTree(query)
-    # here we manually execute the to_edges in the query tree
-    genome_query_node = qt.head
-    # assert len(genome_query_node.arithmetics) == 0, "No arithmetics supported for GWAS SNP query"
-    query_edges = genome_query_node.edges
-    assert len(query_edges) == 1, "GWAS SNP query should have exactly one edge"
-    assert genome_query_node.edge_rule == 0, "The edge rule of GWAP SNP query should be 0 (and)"
-    query_edge = query_edges[0]
-    # build a edges dictionary with their p-value recorded, keep the lowest one
-    gid_score = dict()
-    for edge in query_edge.find(projection=['from_id', 'info.p-value']):
-        if 'p-value' in edge['info']:
-            gid = edge['from_id']
-            pvalue = edge['info']['p-value']
-            if gid in gid_score:
-                gid_score[gid] = min(gid_score[gid], pvalue)
-            else:
-                gid_score[gid] = pvalue
-    # run the SNP genome query and store the lowest p-values
-    gwas_SNP_projection = None # this may be updated later to reduce data transfer
-    result_with_pvalue = []
-    result_no_pvalue = []
-    for gnode in genome_query_node.find(projection=gwas_SNP_projection):
-        # append the lowest p-value to the SNP node
-        gid = gnode.pop('_id')
-        # replace _id by id
-        gnode['id'] = gid
-        if gid in gid_score:
-            gnode['info']['p-value'] = gid_score[gid]
-            result_with_pvalue.append(gnode)
-        else:
-            result_no_pvalue.append(gnode)
-    # sort the resulting gnodes by their p-value
-    result_with_pvalue.sort(key=lambda d: d['info']['p-value'])
-    # append the SNP gnodes without a p-value at the end
-    result = result_with_pvalue + result_no_pvalue
-    return result
+    if not query: return None
+    return GWASResults(query)
@@ -1,7 +1,9 @@
 from sirius.mongo import GenomeNodes
 from sirius.core.utilities import threadsafe_lru
+from sirius.core.shared_cache import shared_cached
 
 @threadsafe_lru(maxsize=1024)
+@shared_cached()
 def get_reference_gene_data(contig):
     """ Find all genes in a contig """
     # First we find all the genes
@@ -15,6 +17,7 @@ def get_reference_gene_data(contig):
     return all_genes
 
 @threadsafe_lru(maxsize=1024)
+@shared_cached()
 def get_reference_hierarchy_data(contig):
     """ Find all genes in a contig, then build the gene->transcript->exon hierarchy """
     # First we find all the genes
@@ -0,0 +1,276 @@
+"""
+Query result cache shared by all workers, behind the in-process threadsafe_lru caches.
+
+Every uWSGI worker has its own threadsafe_lru caches, so without this each worker warms its own copy.
+Functions decorated with shared_cached() look up their results in a backend shared with the other workers first:
+
+- 'local': no sharing, only the in-process caches are used (the default)
+- 'mmap': one file per result in a shared memory directory (/dev/shm), read with mmap, for the workers on one host
+- 'redis': any server speaking the Redis protocol (RESP), for all pods of the fleet
+
+The backend is selected with the SIRIUS_CACHE_BACKEND environment variable.
+Values are pickled with the highest protocol, so the numpy columns of the track caches are stored as raw buffers.
+The keys are computed from the CanonicalQuery digests and the other arguments, so they are the same in every process.
+
+Unpickling runs code chosen by whoever wrote the value, so anyone who can write to the shared directory or the Redis server
+can run code in the workers. Only use a directory and a server that are not writable by anyone else,
+or set SIRIUS_CACHE_SECRET: the values are then signed with HMAC-SHA256, and values with a bad signature are ignored.
+"""
+
+import os
+import json
+import time
+import mmap
+import pickle
+import socket
+import hmac
+import hashlib
+import functools
+import threading
+from sirius.query.canonical import CanonicalQuery
+
+SHARED_CACHE_BACKEND = os.environ.get('SIRIUS_CACHE_BACKEND', 'local')
+SHARED_CACHE_DIR = os.environ.get('SIRIUS_CACHE_DIR', '/dev/shm/sirius_cache')
+SHARED_CACHE_REDIS = os.environ.get('SIRIUS_CACHE_REDIS', 'localhost:6379')
+# key of the HMAC signatures of the values, empty to not sign them
+SHARED_CACHE_SECRET = os.environ.get('SIRIUS_CACHE_SECRET', '').encode()
+# seconds until a shared result expires, the database could be updated
+SHARED_CACHE_TTL = int(os.environ.get('SIRIUS_CACHE_TTL', 86400))
+# total size of the mmap backend directory
+SHARED_CACHE_MAX_BYTES = int(os.environ.get('SIRIUS_CACHE_MAX_BYTES', 2 * 1024**3))
+# larger results are only kept in the process
+SHARED_CACHE_MAX_VALUE_BYTES = 256 * 1024**2
+# change this when the format of the cached results changes
+SHARED_CACHE_VERSION = 2
+
+class LocalBackend:
+    """ Backend that shares nothing, results are only cached by the in-process caches """
+    # the results are not serialized for backends that don't share them
+    shares = False
+
+    def get(self, key):
+        return None
+
+    def set(self, key, value, ttl):
+        pass
+
+class MmapBackend:
+    """
+    Backend storing each value in a file of a directory shared by the workers on one host.
+    On /dev/shm the files live in shared memory, and they are read with mmap.
+    Writes go to a temporary file first, then replace the key atomically, so readers never see partial values.
+    """
+    shares = True
+    # scan the directory to evict old files every this many writes
+    evict_interval = 64
+
+    def __init__(self, directory=SHARED_CACHE_DIR, max_bytes=SHARED_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.n_writes = 0
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.directory, key)
+
+    def get(self, key):
+        path = self.path(key)
+        try:
+            with open(path, 'rb') as f:
+                # the expire time is stored in the modification time
+                if os.fstat(f.fileno()).st_mtime < time.time():
+                    return None
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    return mm[:]
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def set(self, key, value, ttl):
+        path = self.path(key)
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(value)
+        expire = time.time() + ttl
+        os.utime(tmp_path, (expire, expire))
+        os.replace(tmp_path, path)
+        with self.lock:
+            self.n_writes += 1
+            evict = self.n_writes % self.evict_interval == 0
+        if evict:
+            self.evict()
+
+    def evict(self):
+        """ Remove the expired files, then the ones closest to expiring until the directory fits in max_bytes """
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.tmp'):
+                # being written by another worker
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        now = time.time()
+        for expire, size, path in entries:
+            if expire >= now and total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+class RespError(Exception):
+    pass
+
+class RedisBackend:
+    """
+    Backend using a server of the Redis protocol, with a minimal RESP client.
+    Each thread keeps its own connection. Any error is treated as a cache miss, so the cache never breaks a request,
+    and the server is not tried again for retry_interval seconds, so requests don't wait on a server that is down.
+    """
+    shares = True
+    retry_interval = 30
+
+    def __init__(self, address=SHARED_CACHE_REDIS, timeout=2.0):
+        host, _, port = address.partition(':')
+        self.host = host
+        self.port = int(port) if port else 6379
+        self.timeout = timeout
+        self.local = threading.local()
+        self.retry_after = 0
+
+    def connection(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+            conn = (sock, sock.makefile('rb'))
+            self.local.conn = conn
+        return conn
+
+    def close(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is not None:
+            self.local.conn = None
+            conn[1].close()
+            conn[0].close()
+
+    def command(self, *args):
+        """ Send a command and return its reply """
+        parts = [b'*%d\r\n' % len(args)]
+        for arg in args:
+            if not isinstance(arg, bytes):
+                arg = str(arg).encode()
+            parts += [b'$%d\r\n' % len(arg), arg, b'\r\n']
+        if time.time() < self.retry_after:
+            raise RespError('Server unavailable, waiting to retry')
+        try:
+            sock, reader = self.connection()
+            sock.sendall(b''.join(parts))
+            return self.read_reply(reader)
+        except OSError:
+            self.close()
+            self.retry_after = time.time() + self.retry_interval
+            raise
+
+    def read_reply(self, reader):
+        line = reader.readline()
+        if not line.endswith(b'\r\n'):
+            raise ConnectionError('Connection closed')
+        kind, data = line[:1], line[1:-2]
+        if kind == b'+':
+            return data
+        elif kind == b'-':
+            raise RespError(data.decode())
+        elif kind == b':':
+            return int(data)
+        elif kind == b'$':
+            n = int(data)
+            if n < 0:
+                return None
+            value = reader.read(n + 2)
+            return value[:-2]
+        elif kind == b'*':
+            n = int(data)
+            return None if n < 0 else [self.read_reply(reader) for _ in range(n)]
+        raise RespError(f'Unknown reply {line}')
+
+    def get(self, key):
+        try:
+            return self.command('GET', key)
+        except (OSError, RespError) as e:
+            print(f"Shared cache GET failed with error {e}")
+            return None
+
+    def set(self, key, value, ttl):
+        try:
+            self.command('SET', key, value, 'EX', int(ttl))
+        except (OSError, RespError) as e:
+            print(f"Shared cache SET failed with error {e}")
+
+def create_backend(name=SHARED_CACHE_BACKEND):
+    if name == 'mmap':
+        return MmapBackend()
+    elif name == 'redis':
+        return RedisBackend()
+    elif name == 'local':
+        return LocalBackend()
+    raise ValueError(f"SIRIUS_CACHE_BACKEND should be one of 'local', 'mmap', 'redis', got {name}")
+
+backend = create_backend()
+
+def stable_key_part(value):
+    """ A representation of an argument that is the same in every process, unlike hash() """
+    if isinstance(value, CanonicalQuery):
+        return value.digest
+    return json.dumps(value, sort_keys=True, default=repr)
+
+def shared_cache_key(namespace, args, kwargs):
+    parts = [namespace] + [stable_key_part(a) for a in args] + [f'{k}={stable_key_part(v)}' for k, v in sorted(kwargs.items())]
+    digest = hashlib.sha1('\n'.join(parts).encode()).hexdigest()
+    return f'sirius_v{SHARED_CACHE_VERSION}_{digest}'
+
+def sign_value(value, secret=SHARED_CACHE_SECRET):
+    """ Prefix value with its HMAC signature if there is a secret """
+    if not secret:
+        return value
+    return hmac.new(secret, value, hashlib.sha256).digest() + value
+
+def verified_value(data, secret=SHARED_CACHE_SECRET):
+    """ Return the value of sign_value(), or None if its signature is wrong """
+    if not secret:
+        return data
+    signature, value = data[:32], data[32:]
+    if not hmac.compare_digest(signature, hmac.new(secret, value, hashlib.sha256).digest()):
+        print("Shared cache value with a wrong signature ignored")
+        return None
+    return value
+
+def shared_cached(ttl=SHARED_CACHE_TTL):
+    """
+    Decorator to share the results of a function with the other workers through the backend.
+    Put it under @threadsafe_lru, so the in-process cache is checked first. The results have to be picklable.
+    """
+    def decorator(func):
+        namespace = f'{func.__module__}.{func.__qualname__}'
+        @functools.wraps(func)
+        def _shared_func(*args, **kwargs):
+            if not backend.shares:
+                return func(*args, **kwargs)
+            key = shared_cache_key(namespace, args, kwargs)
+            value = backend.get(key)
+            if value is not None:
+                value = verified_value(value)
+            if value is not None:
+                return pickle.loads(value)
+            result = func(*args, **kwargs)
+            value = pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL)
+            if len(value) <= SHARED_CACHE_MAX_VALUE_BYTES:
+                backend.set(key, sign_value(value), ttl)
+            return result
+        return _shared_func
+    return decorator
@@ -0,0 +1,135 @@
+"""
+Binary encoding of the interval and variant track responses.
+
+The JSON responses of /interval_track_data and /variant_track_data have one dict per feature, and for dense windows
+building and parsing them takes most of the response time. A client that sends 'Accept: application/octet-stream'
+gets the same rows encoded from the cached TrackColumns instead, in the layout of the /datatracks responses:
+a utf-8 JSON header, a NUL byte, then the binary body.
+
+The header has the fields of the JSON response without 'data', the number of rows 'count',
+and a 'columns' list describing each column of the body, with the byte 'offset' of its parts from the start of the body:
+
+- 'int32' (or 'int64' if the values don't fit): packed little-endian integers, like 'start' and 'length'
+- 'enum': for strings with few distinct values, like 'type', the distinct strings are in 'values',
+  followed by one little-endian code per row of 'dtype' 'int8', 'int16' or 'int32', -1 for a missing value
+- 'strings': for strings like the ids and names, 'count' + 1 little-endian int32 offsets at 'offset',
+  the value of row i is the utf-8 bytes offsets[i] to offsets[i+1] of the data at 'data_offset', empty if missing
+- 'json': any other values, like the nested 'info' fields, as a utf-8 JSON list of 'length' bytes
+
+Every part starts at a multiple of 4 bytes from the start of the body, so a client can view them as typed arrays
+after copying the body to its own buffer.
+"""
+
+import json
+import numpy as np
+from sirius.core.track_columns import StringColumn
+
+TRACK_BINARY_MIMETYPE = 'application/octet-stream'
+
+def wants_binary(accept_mimetypes):
+    """ Return True if the Accept header of a request prefers the binary encoding to JSON """
+    return accept_mimetypes.best_match(['application/json', TRACK_BINARY_MIMETYPE]) == TRACK_BINARY_MIMETYPE
+
+def enum_dtype(n_values):
+    for dtype in ('<i1', '<i2'):
+        if n_values <= np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    return np.dtype('<i4')
+
+class BodyWriter:
+    """ Collect the parts of the body, each aligned to 4 bytes """
+    def __init__(self):
+        self.parts = []
+        self.size = 0
+
+    def write(self, data):
+        """ Append data and return its offset """
+        padding = -self.size % 4
+        if padding:
+            self.parts.append(b'\x00' * padding)
+            self.size += padding
+        offset = self.size
+        self.parts.append(data)
+        self.size += len(data)
+        return offset
+
+    def getvalue(self):
+        return b''.join(self.parts)
+
+def encode_string_column(column, i_start, i_end, writer):
+    codes = column.codes[i_start:i_end]
+    distinct = np.unique(codes[codes >= 0])
+    # repeated values are sent once
+    if 2 * len(distinct) <= len(codes):
+        dtype = enum_dtype(len(distinct))
+        local_codes = np.searchsorted(distinct, codes).astype(dtype)
+        local_codes[codes < 0] = -1
+        return {
+            'kind': 'enum',
+            'values': [column.decode(code) for code in distinct.tolist()],
+            'dtype': dtype.name,
+            'offset': writer.write(local_codes.tobytes()),
+        }
+    starts = column.offsets[:-1]
+    ends = column.offsets[1:]
+    buffer = column.buffer
+    values = [buffer[starts[code]:ends[code]] if code >= 0 else b'' for code in codes.tolist()]
+    offsets = np.zeros(len(values) + 1, dtype='<i4')
+    np.cumsum([len(v) for v in values], out=offsets[1:])
+    return {
+        'kind': 'strings',
+        'offset': writer.write(offsets.tobytes()),
+        'data_offset': writer.write(b''.join(values)),
+    }
+
+def encode_track(header, columns, i_start, i_end, names):
+    """
+    Encode the rows i_start to i_end of a TrackColumns as the binary response.
+    names is a list of (column name, name in the response) pairs, columns can be None when there are no results.
+    """
+    header = dict(header)
+    header['count'] = count = i_end - i_start if columns is not None else 0
+    header['columns'] = []
+    writer = BodyWriter()
+    for name, response_name in names:
+        if columns is None:
+            break
+        column = columns.columns[name]
+        if isinstance(column, np.ndarray):
+            values = column[i_start:i_end]
+            fits = count == 0 or (values.min() >= np.iinfo(np.int32).min and values.max() <= np.iinfo(np.int32).max)
+            dtype = np.dtype('<i4') if fits else np.dtype('<i8')
+            layout = {'kind': dtype.name, 'offset': writer.write(values.astype(dtype).tobytes())}
+        elif isinstance(column, StringColumn):
+            layout = encode_string_column(column, i_start, i_end, writer)
+        else:
+            data = json.dumps(column[i_start:i_end]).encode('utf-8')
+            layout = {'kind': 'json', 'offset': writer.write(data), 'length': len(data)}
+        header['columns'].append(dict(name=response_name, **layout))
+    response = json.dumps(header).encode('utf-8')
+    response += b'\x00'
+    response += writer.getvalue()
+    return response
+
+def decode_track(response):
+    """ Decode a binary response into (header, data), data maps the name of each column to the list of its values """
+    header_bytes, _, body = response.partition(b'\x00')
+    header = json.loads(header_bytes.decode('utf-8'))
+    count = header['count']
+    data = dict()
+    for layout in header['columns']:
+        kind, offset = layout['kind'], layout['offset']
+        if kind in ('int32', 'int64'):
+            data[layout['name']] = np.frombuffer(body, dtype='<' + np.dtype(kind).str[1:], count=count, offset=offset).tolist()
+        elif kind == 'enum':
+            codes = np.frombuffer(body, dtype='<' + np.dtype(layout['dtype']).str[1:], count=count, offset=offset)
+            data[layout['name']] = [layout['values'][c] if c >= 0 else None for c in codes.tolist()]
+        elif kind == 'strings':
+            offsets = np.frombuffer(body, dtype='<i4', count=count+1, offset=offset).tolist()
+            strings = body[layout['data_offset']:layout['data_offset'] + offsets[-1]]
+            data[layout['name']] = [strings[offsets[i]:offsets[i+1]].decode('utf-8') for i in range(count)]
+        elif kind == 'json':
+            data[layout['name']] = json.loads(body[offset:offset + layout['length']].decode('utf-8'))
+        else:
+            raise ValueError(f"Unknown column kind {kind}")
+    return header, data
@@ -0,0 +1,204 @@
+"""
+Columnar storage of the cached results of the track queries.
+
+The track caches used to keep one Python dict per feature, hundreds of bytes each, so a few large ENCODE or dbSNP
+queries could fill the memory of a worker. TrackColumns stores the same rows as columns instead:
+integer fields like 'start' and 'length' in numpy arrays, and string fields like '_id', 'name' and 'type'
+dictionary-encoded, with the distinct values in one utf-8 buffer and an int32 code per row.
+The rows are sorted by 'start', and dicts are only built for the slice of rows in view.
+
+Features are found by overlap with the view, not only by start, so long features starting before the view are included.
+Next to the sorted starts, each TrackColumns keeps the end of each row and the running maximum of the ends,
+so the rows before the first one whose running maximum reaches the view can be skipped with a binary search.
+"""
+
+import numpy as np
+
+class StringColumn:
+    """
+    Dictionary-encoded column of strings.
+
+    Attributes
+    ----------
+    buffer: bytes
+        The utf-8 encoded distinct values, one after the other
+    offsets: np.ndarray
+        Value i is buffer[offsets[i]:offsets[i+1]]
+    codes: np.ndarray
+        The int32 code of the value of each row, -1 for a missing value
+    """
+    def __init__(self, values):
+        value_codes = dict()
+        codes = np.empty(len(values), dtype=np.int32)
+        for i, value in enumerate(values):
+            codes[i] = -1 if value is None else value_codes.setdefault(value, len(value_codes))
+        encoded = [value.encode() for value in value_codes]
+        self.offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(b) for b in encoded], out=self.offsets[1:])
+        self.buffer = b''.join(encoded)
+        self.codes = codes
+
+    def __len__(self):
+        return len(self.codes)
+
+    def decode(self, code):
+        if code < 0:
+            return None
+        return self.buffer[self.offsets[code]:self.offsets[code+1]].decode()
+
+    def subset(self, indices):
+        """ Return the StringColumn of the rows at indices, sharing the buffer of the values """
+        column = StringColumn.__new__(StringColumn)
+        column.buffer = self.buffer
+        column.offsets = self.offsets
+        column.codes = self.codes[indices]
+        return column
+
+    def take(self, i_start, i_end):
+        """ Return the list of values of rows i_start to i_end """
+        decoded = dict()
+        result = []
+        for code in self.codes[i_start:i_end].tolist():
+            value = decoded.get(code)
+            if value is None:
+                value = decoded[code] = self.decode(code)
+            result.append(value)
+        return result
+
+    @property
+    def nbytes(self):
+        return len(self.buffer) + self.offsets.nbytes + self.codes.nbytes
+
+def _get_path(row, path):
+    value = row
+    for key in path:
+        if not isinstance(value, dict):
+            return None
+        value = value.get(key)
+    return value
+
+def _take(column, i_start, i_end):
+    if isinstance(column, np.ndarray):
+        return column[i_start:i_end].tolist()
+    elif isinstance(column, StringColumn):
+        return column.take(i_start, i_end)
+    return column[i_start:i_end]
+
+class TrackColumns:
+    """
+    The rows of a track query result for one contig, sorted by 'start', stored by column.
+
+    Each field is stored in a numpy int64 array if all its values are integers, in a StringColumn if they are strings,
+    and in a list otherwise, like the nested 'info' values. Dotted fields like 'info.variant_ref' are stored as their own column
+    and nested again in the rows. Missing and None values are left out of the rows.
+
+    The last base pair of each row is kept in ends, from the 'end' column, or from 'start' and 'length',
+    or is the start when there are neither, and max_ends[i] is the largest end of rows 0 to i.
+    """
+    def __init__(self, rows, fields):
+        rows = sorted(rows, key=lambda d: d['start'])
+        self.names = list(fields)
+        self.columns = dict()
+        for name in self.names:
+            path = name.split('.')
+            values = [_get_path(row, path) for row in rows]
+            self.columns[name] = self.build_column(values)
+        self.build_overlap_index()
+
+    def build_overlap_index(self):
+        self.starts = self.columns['start'] if 'start' in self.columns else np.empty(0, dtype=np.int64)
+        if isinstance(self.columns.get('end'), np.ndarray):
+            self.ends = self.columns['end']
+        elif isinstance(self.columns.get('length'), np.ndarray):
+            self.ends = self.starts + np.maximum(self.columns['length'] - 1, 0)
+        else:
+            self.ends = self.starts
+        # the ends can be smaller than the starts in bad data
+        self.ends = np.maximum(self.ends, self.starts)
+        self.max_ends = np.maximum.accumulate(self.ends) if len(self.ends) else self.ends
+
+    @staticmethod
+    def build_column(values):
+        present = [v for v in values if v is not None]
+        if len(present) == len(values) and all(isinstance(v, int) and not isinstance(v, bool) for v in values):
+            return np.array(values, dtype=np.int64)
+        if all(isinstance(v, str) for v in present):
+            return StringColumn(values)
+        return values
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __getitem__(self, name):
+        """ Return a column as a numpy array or a list """
+        column = self.columns[name]
+        return column if isinstance(column, np.ndarray) else _take(column, 0, len(self))
+
+    def range_indices(self, start_bp, end_bp):
+        """ Return the indices (i_start, i_end) of the rows with start_bp <= start < end_bp """
+        i_start, i_end = np.searchsorted(self.starts, [start_bp, end_bp])
+        return int(i_start), int(i_end)
+
+    def overlap_indices(self, start_bp, end_bp):
+        """
+        Return the sorted array of the indices of the rows with start < end_bp and end >= start_bp.
+        The rows starting in range are one slice, the rows starting before it are only checked after the last row
+        whose running maximum end is before start_bp, so the cost is O(log n) plus the number of rows checked.
+        """
+        i_end = int(np.searchsorted(self.starts, end_bp))
+        i_start = min(int(np.searchsorted(self.starts, start_bp)), i_end)
+        # every row before i_first ends before start_bp
+        i_first = int(np.searchsorted(self.max_ends[:i_start], start_bp))
+        before = i_first + np.flatnonzero(self.ends[i_first:i_start] >= start_bp)
+        return np.concatenate([before, np.arange(i_start, i_end)])
+
+    def subset(self, indices):
+        """ Return the TrackColumns of the rows at indices, which should be sorted """
+        result = TrackColumns.__new__(TrackColumns)
+        result.names = self.names
+        result.columns = dict()
+        for name, column in self.columns.items():
+            if isinstance(column, (np.ndarray, StringColumn)):
+                result.columns[name] = column[indices] if isinstance(column, np.ndarray) else column.subset(indices)
+            else:
+                result.columns[name] = [column[i] for i in indices.tolist()]
+        result.build_overlap_index()
+        return result
+
+    def overlapping(self, start_bp, end_bp):
+        """ Return the TrackColumns of the rows overlapping [start_bp, end_bp), in the order of their start """
+        return self.subset(self.overlap_indices(start_bp, end_bp))
+
+    def rows(self, i_start=0, i_end=None):
+        """ Build the row dicts of rows i_start to i_end, with the fields of the original documents """
+        if i_end is None:
+            i_end = len(self)
+        columns = [(name.split('.'), _take(self.columns[name], i_start, i_end)) for name in self.names]
+        result = []
+        for k in range(i_end - i_start):
+            row = dict()
+            for path, values in columns:
+                value = values[k]
+                if value is None:
+                    continue
+                target = row
+                for key in path[:-1]:
+                    target = target.setdefault(key, dict())
+                target[path[-1]] = value
+            result.append(row)
+        return result
+
+    def tuples(self, names, i_start=0, i_end=None):
+        """ Return the values of the columns names for rows i_start to i_end, as a list of tuples """
+        if i_end is None:
+            i_end = len(self)
+        return list(zip(*[_take(self.columns[name], i_start, i_end) for name in names]))
+
+    @property
+    def nbytes(self):
+        """ Approximate memory used by the columns, the list columns are not counted """
+        total = self.max_ends.nbytes
+        for column in self.columns.values():
+            if isinstance(column, (np.ndarray, StringColumn)):
+                total += column.nbytes
+        return total
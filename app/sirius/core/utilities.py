@@ -5,10 +5,12 @@
 import json
 import threading
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 import cachetools.keys
 import cachetools.func
 
 from sirius.mongo import GenomeNodes, InfoNodes, Edges
+from sirius.query.canonical import CanonicalQuery
 
 
 def get_data_with_id(data_id):
@@ -45,6 +47,28 @@ def get_data_with_id(data_id):
         print("Data not found for _id %s" % data_id)
     return data
 
+def get_data_with_ids(data_ids):
+    """
+    Get many documents from MongoDB, with one find() per collection instead of one per document.
+
+    Returns
+    -------
+    data: dictionary
+        Mapping from each _id found to its document
+    """
+    collections = {'G': GenomeNodes, 'I': InfoNodes, 'E': Edges}
+    ids_by_prefix = defaultdict(set)
+    for data_id in data_ids:
+        ids_by_prefix[data_id[0]].add(data_id)
+    result = dict()
+    for prefix, ids in ids_by_prefix.items():
+        if prefix not in collections:
+            print("Invalid data_id prefix %s, ID should start with G, I or E" % prefix)
+            continue
+        for data in collections[prefix].find({'_id': {'$in': list(ids)}}):
+            result[data['_id']] = data
+    return result
+
 class HashableDict(dict):
     def __hash__(self):
         return hash(json.dumps(self, sort_keys=True))
@@ -63,6 +87,21 @@ def threadsafe_lru(*lru_args, **lru_kwargs):
         return _thread_safe_func
     return real_threadsafe_func
 
+def threadsafe_sized_lru(maxsize, getsizeof):
+    """ Like threadsafe_lru, with an LRU cache holding results of total getsizeof(result) up to maxsize, larger results are not cached """
+    def real_threadsafe_func(func):
+        cache = cachetools.LRUCache(maxsize=maxsize, getsizeof=getsizeof)
+        func = cachetools.cached(cache, lock=threading.Lock(), info=True)(func)
+        lock_dict = defaultdict(threading.Lock)
+        def _thread_safe_func(*args, **kwargs):
+            key = cachetools.keys.hashkey(*args, **kwargs)
+            with lock_dict[key]:
+                return func(*args, **kwargs)
+        _thread_safe_func.cache_info = func.cache_info
+        _thread_safe_func.cache_clear = func.cache_clear
+        return _thread_safe_func
+    return real_threadsafe_func
+
 def threadsafe_ttl_cache(*ttl_args, **ttl_kwargs):
     def real_threadsafe_func(func):
         func = cachetools.func.ttl_cache(*ttl_args, **ttl_kwargs)(func)
@@ -75,3 +114,88 @@ def threadsafe_ttl_cache(*ttl_args, **ttl_kwargs):
         _thread_safe_func.cache_clear = func.cache_clear
         return _thread_safe_func
     return real_threadsafe_func
+
+class BackgroundRunner:
+    """
+    Small pool of threads filling caches ahead of the requests.
+    A call is skipped if the same call is already pending, or if max_pending calls are, so the queue never grows
+    behind slow calls and the calls that are run are the ones of the recent requests.
+    """
+    def __init__(self, max_workers=2, max_pending=8, name='sirius_background'):
+        self.pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+        self.max_pending = max_pending
+        self.pending = set()
+        self.lock = threading.Lock()
+
+    def _run(self, func, args):
+        try:
+            func(*args)
+        except Exception as e:
+            print(f"Background call {func.__name__}{args} failed with error {e}")
+        finally:
+            with self.lock:
+                self.pending.discard((func, args))
+
+    def submit(self, func, *args):
+        """ Call func(*args) in a background thread, return False if the call is skipped. The args have to be hashable. """
+        key = (func, args)
+        with self.lock:
+            if key in self.pending or len(self.pending) >= self.max_pending:
+                return False
+            self.pending.add(key)
+        self.pool.submit(self._run, func, args)
+        return True
+
+_background_runner = BackgroundRunner()
+
+def run_in_background(func, *args):
+    """
+    Call func(*args) in the shared background pool, to fill the cache of a cached function before it is requested.
+    The call is skipped if the same call is already pending, or if the pool is busy.
+    """
+    return _background_runner.submit(func, *args)
+
+# the number of contigs filled in the background after a request
+NEARBY_CONTIGS = 2
+
+def nearby_contigs(contig, contigs, count=NEARBY_CONTIGS):
+    """ Return the count contigs closest to contig in the ordered list contigs, the next ones first, likely to be viewed next """
+    if contig not in contigs:
+        return []
+    i = contigs.index(contig)
+    result = []
+    for distance in range(1, len(contigs)):
+        for j in (i + distance, i - distance):
+            if 0 <= j < len(contigs) and len(result) < count:
+                result.append(contigs[j])
+    return result
+
+def contig_query(query, contig):
+    """
+    Return the CanonicalQuery of the results of query on one contig, by adding a 'contig' condition to its filters.
+    Return None if the filters select another contig, so there are no results on this one.
+    """
+    filters = dict(query.get('filters') or {})
+    condition = filters.get('contig')
+    if condition is None:
+        filters['contig'] = contig
+    elif isinstance(condition, dict):
+        condition = dict(condition)
+        for op in ('$eq', '=', '=='):
+            if op in condition and condition[op] != contig:
+                return None
+        condition['$eq'] = contig
+        filters['contig'] = condition
+    elif condition != contig:
+        return None
+    result = dict(query)
+    result['filters'] = filters
+    return CanonicalQuery(result)
+
+def rows_on_contig(rows, contig):
+    """
+    Select the rows of a contig_query() result that are on contig.
+    The 'contig' condition only applies to the head filter, so the ids added by arithmetics like 'union' can be on any contig.
+    """
+    return (d for d in rows if d.get('contig') == contig)
+
@@ -1,54 +1,59 @@
-import numpy as np
 import time
-from sirius.core.utilities import HashableDict, threadsafe_lru
+from sirius.core.utilities import threadsafe_lru, run_in_background, nearby_contigs, contig_query, rows_on_contig
+from sirius.core.shared_cache import shared_cached
+from sirius.core.track_columns import TrackColumns
+from sirius.query.canonical import CanonicalQuery
 from sirius.query.query_tree import QueryTree
-from sirius.helpers.loaddata import loaded_genome_contigs
+from sirius.mongo.utils import lookup_stats
+from sirius.helpers.loaddata import loaded_primary_contigs
 
-def get_variants_in_range(contig, start_bp, end_bp, query, verbose=True):
+def get_variant_columns_in_range(contig, start_bp, end_bp, query, verbose=True):
+    """ Return the TrackColumns of the results of query on contig overlapping [start_bp, end_bp) """
     # lode cached data
     t0 = time.time()
-    query_genome_data, query_start_bps = get_variant_query_results(HashableDict(query))
-    contig_genome_data = query_genome_data[contig]
-    contig_start_bps = query_start_bps[contig]
-    total_query_count = len(contig_genome_data)
+    query = CanonicalQuery(query)
+    contig_columns = get_variant_contig_results(query, contig)
+    # the nearby contigs are likely to be viewed next
+    for other_contig in nearby_contigs(contig, loaded_primary_contigs):
+        run_in_background(get_variant_contig_results, query, other_contig)
+    total_query_count = len(contig_columns)
     t1 = time.time()
-    if len(contig_genome_data) == 0:
-        return []
-    # find data in view range
-    start_idx, end_idx = np.searchsorted(contig_start_bps, [start_bp, end_bp])
-    genome_data_in_range = contig_genome_data[start_idx:end_idx]
-    count_in_range = len(genome_data_in_range)
+    columns_in_range = contig_columns.overlapping(start_bp, end_bp)
     t2 = time.time()
     if verbose:
         debug_message = f"**** get_variants_in_range debug info ***\n"
         debug_message += f"-- {total_query_count} variant_results; {t1-t0:.3f} s\n"
         debug_message += f"-- Query: {query}\n"
-        debug_message += f"-- Cache Info {get_variant_query_results.cache_info()}\n"
-        debug_message += f"-- Found {count_in_range} variant_results in range; {t2-t1:.3f} seconds"
+        debug_message += f"-- Cache Info {get_variant_contig_results.cache_info()}\n"
+        debug_message += f"-- Lookup Stats {lookup_stats.summary()}\n"
+        debug_message += f"-- Found {len(columns_in_range)} variant_results in range; {t2-t1:.3f} seconds"
         print(debug_message)
+    return columns_in_range
+
+def get_variants_in_range(contig, start_bp, end_bp, query, verbose=True):
+    # only the rows in view are built
+    genome_data_in_range = get_variant_columns_in_range(contig, start_bp, end_bp, query, verbose=verbose).rows()
     # form return format
     result = []
     for d in genome_data_in_range:
         result.append({
             'id': d['_id'],
             'start': d['start'],
-            'info': d['info']
+            'info': d.get('info', {})
         })
     return result
 
 @threadsafe_lru(maxsize=8192)
-def get_variant_query_results(query):
+@shared_cached()
+def get_variant_contig_results(query, contig):
+    """
+    Return the TrackColumns of the results of query on one contig.
+    Each contig is queried and cached on its own, the limit of the query applies to each contig.
+    """
+    names = ['_id', 'start', 'info.variant_ref', 'info.variant_alt']
+    query = contig_query(query, contig)
+    if query is None:
+        return TrackColumns([], names)
     qt = QueryTree(query)
-    # we split the results into contigs
-    genome_data = {contig: [] for contig in loaded_genome_contigs}
-    # put the results in to cache
-    for gnode in qt.find(projection=['_id', 'contig', 'start', 'info.variant_ref', 'info.variant_alt']):
-        contig = gnode.pop('contig')
-        genome_data[contig].append(gnode)
-    # sort the results based on the start
-    start_bps = dict()
-    for contig, genome_data_list in genome_data.items():
-        genome_data_list.sort(key=lambda d: d['start'])
-        # save the 1-D array of starting loation
-        start_bps[contig] = np.array([d['start'] for d in genome_data_list])
-    return genome_data, start_bps
+    # the columns are sorted by start
+    return TrackColumns(rows_on_contig(qt.find(projection=names + ['contig']), contig), names)
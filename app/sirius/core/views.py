@@ -4,7 +4,7 @@
 #  Here sits all the api endpoints #
 #==================================#
 
-from flask import abort, request, send_from_directory, send_file
+from flask import abort, request, send_from_directory, send_file, jsonify, Response
 import os
 import json
 import time
@@ -13,14 +13,34 @@ import random
 import subprocess
 import tempfile
 from sirius import app
-from sirius.core.utilities import get_data_with_id, HashableDict, threadsafe_lru
+from sirius.core.utilities import get_data_with_id, threadsafe_lru
+from sirius.core.shared_cache import shared_cached
+from sirius.query.canonical import CanonicalQuery
 from sirius.query.query_tree import QueryTree
 from sirius.helpers.loaddata import loaded_contig_info, loaded_contig_info_dict, loaded_track_types_info, loaded_data_track_info_dict, loaded_data_tracks
 from sirius.helpers.constants import TRACK_TYPE_SEQUENCE, TRACK_TYPE_FUNCTIONAL, TRACK_TYPE_3D, TRACK_TYPE_NETWORK, TRACK_TYPE_BOOLEAN, \
                                      QUERY_TYPE_GENOME, QUERY_TYPE_INFO, QUERY_TYPE_EDGE
 from sirius.core.annotationtrack import get_annotation_query
 from sirius.mongo import GenomeNodes, InfoNodes, Edges
+from sirius.mongo.utils import lookup_stats
 from sirius.core.auth0 import requires_auth, requires_auth_user
+from sirius.query.budget import QueryBudget, QueryTooExpensive
+from sirius.query.facets import facet_values
+from pymongo.errors import ExecutionTimeout
+
+# Error handler
+@app.errorhandler(QueryTooExpensive)
+def handle_query_too_expensive(ex):
+    """ A query exceeded its QueryBudget, tell the client instead of hanging """
+    response = jsonify(ex.to_dict())
+    response.status_code = 422
+    return response
+
+@app.errorhandler(ExecutionTimeout)
+def handle_execution_timeout(ex):
+    response = jsonify(QueryTooExpensive('time', str(ex)).to_dict())
+    response.status_code = 422
+    return response
 
 #**************************
 #*     static urls        *
@@ -180,14 +200,19 @@ def distinct_values(index):
     #     return abort(404, f"Query of {index} is not allowed for {query['type']}")
     # Update by QYD : After discussion with Salik, we decided to remove the whitelist above, and replace that by a max time limit.
     # The time limit is implemented in QueryTree
-    query = HashableDict(query)
+    query = CanonicalQuery(query)
     result = get_query_distinct_values(query, index)
     print("/distinct_values/%s for query %s returns %d results. " % (index, query, len(result)), get_query_distinct_values.cache_info())
     return json.dumps(result)
 
 @threadsafe_lru(maxsize=8192)
+@shared_cached()
 def get_query_distinct_values(query, index):
-    qt = QueryTree(query)
+    # simple queries are answered by the precomputed facet tables
+    result = facet_values(query, index)
+    if result is not None:
+        return result
+    qt = QueryTree(query, budget=QueryBudget())
     result = set(qt.distinct(index))
     result.discard(None)
     return list(result)
@@ -247,8 +272,20 @@ def suggestions():
 #**************************
 #*       /query           *
 #**************************
-from sirius.core.query_endpoint import get_query_full_results, get_query_basic_results, get_query_gwas_results
+from sirius.core.query_endpoint import get_query_full_results, get_query_basic_results, get_query_gwas_results, get_query_count, encode_page_token
+
+# the largest page of results returned for a continuation token
+MAX_PAGE_SIZE = 1000
 
+def page_size_arg(default=100):
+    """ Return the page_size argument of the request clamped to MAX_PAGE_SIZE, abort with 400 if it is not a positive integer """
+    try:
+        page_size = int(request.args.get('page_size', default=default))
+    except ValueError:
+        return abort(400, 'page_size should be an integer')
+    if page_size < 1:
+        return abort(400, 'page_size should be > 0')
+    return min(page_size, MAX_PAGE_SIZE)
 
 @app.route('/query/full', methods=['POST'])
 @requires_auth
@@ -268,18 +305,28 @@ def query_full():
         result_end = int(result_end)
         if result_end <= result_start:
             return abort(404, 'result_end should > result_start')
-    results_cache = get_query_full_results(HashableDict(query))
-    results = results_cache[result_start:result_end]
+    results_cache = get_query_full_results(CanonicalQuery(query))
+    token = request.args.get('token', default=None)
+    if token is not None:
+        # resume from a continuation token of the previous page
+        page_size = page_size_arg()
+        try:
+            results, result_start, reached_end = results_cache.get_page_from_token(token, page_size)
+        except ValueError as e:
+            return abort(404, str(e))
+    else:
+        results, reached_end = results_cache.get_page(result_start, result_end)
     t1 = time.time()
-    print(f"{len(results)} results from full query {query} cache_info: {get_query_full_results.cache_info()} {t1-t0:.1f} s")
+    print(f"{len(results)} results from full query {query} cache_info: {get_query_full_results.cache_info()} lookup_stats: {lookup_stats.summary()} {t1-t0:.1f} s")
     result_end = result_start + len(results)
-    reached_end = False
-    if results_cache.load_finished and result_end >= len(results_cache.loaded_data):
-        reached_end = True
+    next_token = None
+    if not reached_end and results:
+        next_token = encode_page_token(result_end, results[-1]['id'])
     return_dict = {
         "result_start": result_start,
         "result_end": result_end,
         "reached_end": reached_end,
+        "next_token": next_token,
         "data": results,
         "query": query
     }
@@ -303,18 +350,28 @@ def query_basic():
         result_end = int(result_end)
         if result_end <= result_start:
             return abort(404, 'result_end should > result_start')
-    results_cache = get_query_basic_results(HashableDict(query))
-    results = results_cache[result_start:result_end]
+    results_cache = get_query_basic_results(CanonicalQuery(query))
+    token = request.args.get('token', default=None)
+    if token is not None:
+        # resume from a continuation token of the previous page
+        page_size = page_size_arg()
+        try:
+            results, result_start, reached_end = results_cache.get_page_from_token(token, page_size)
+        except ValueError as e:
+            return abort(404, str(e))
+    else:
+        results, reached_end = results_cache.get_page(result_start, result_end)
     t1 = time.time()
-    print(f"{len(results)} results from basic query {query} cache_info: {get_query_full_results.cache_info()} {t1-t0:.1f} s")
+    print(f"{len(results)} results from basic query {query} cache_info: {get_query_full_results.cache_info()} lookup_stats: {lookup_stats.summary()} {t1-t0:.1f} s")
     result_end = result_start + len(results)
-    reached_end = False
-    if results_cache.load_finished and result_end >= len(results_cache.loaded_data):
-        reached_end = True
+    next_token = None
+    if not reached_end and results:
+        next_token = encode_page_token(result_end, results[-1]['id'])
     return_dict = {
         "result_start": result_start,
         "result_end": result_end,
         "reached_end": reached_end,
+        "next_token": next_token,
         "data": results,
         "query": query
     }
@@ -338,12 +395,11 @@ def query_gwas():
         result_end = int(result_end)
         if result_end <= result_start:
             return abort(404, 'result_end should > result_start')
-    results_cache = get_query_gwas_results(HashableDict(query))
-    results = results_cache[result_start:result_end]
+    results_cache = get_query_gwas_results(CanonicalQuery(query))
+    results, reached_end = results_cache.get_page(result_start, result_end)
     t1 = time.time()
-    print(f"{len(results)} results from GWAS query {query} cache_info: {get_query_gwas_results.cache_info()} {t1-t0:.1f} s")
+    print(f"{len(results)} results from GWAS query {query} cache_info: {get_query_gwas_results.cache_info()} lookup_stats: {lookup_stats.summary()} {t1-t0:.1f} s")
     result_end = result_start + len(results)
-    reached_end = (result_end >= len(results_cache))
     return_dict = {
         "result_start": result_start,
         "result_end": result_end,
@@ -354,6 +410,42 @@ def query_gwas():
     return json.dumps(return_dict)
 
 
+@app.route('/query/count', methods=['POST'])
+@requires_auth
+def query_count():
+    """ Returns the number of results for a query, without fetching them. With ?estimate=true returns a fast estimate """
+    t0 = time.time()
+    query = request.get_json()
+    print(f"***INFO: received /query/count with {query}")
+    if not query:
+        return abort(404, 'no query posted')
+    estimate = request.args.get('estimate', default='false').lower() in ('true', '1')
+    count = get_query_count(CanonicalQuery(query), estimate=estimate)
+    t1 = time.time()
+    print(f"{count} results counted for query {query} cache_info: {get_query_count.cache_info()} {t1-t0:.1f} s")
+    return_dict = {
+        "count": count,
+        "estimated": estimate,
+        "query": query
+    }
+    return json.dumps(return_dict)
+
+@app.route('/query/explain', methods=['POST'])
+@requires_auth
+def query_explain():
+    """ Execute a query with profiling, returns the executed plan tree with timing and cardinality of every node """
+    query = request.get_json()
+    print(f"***INFO: received /query/explain with {query}")
+    if not query:
+        return abort(404, 'no query posted')
+    backend = request.args.get('backend', default='auto')
+    if backend not in QueryTree.Backends:
+        return abort(404, f'backend should be one of {QueryTree.Backends}')
+    qt = QueryTree(query, backend=backend, profile=True, budget=QueryBudget())
+    result = qt.explain()
+    result['query'] = query
+    return json.dumps(result, default=str)
+
 
 #**************************
 #*       /reference       *
@@ -389,7 +481,7 @@ def reference_annotation_track(contig, start_bp, end_bp):
 #*****************************
 #*   /all variant_track_data     *
 #*****************************
-from sirius.core.all_variant_track import get_all_variants_in_range
+from sirius.core.all_variant_track import get_all_variants_in_range, get_variant_tile
 
 @app.route('/all_variant_track_data/<string:contig>/<int:start_bp>/<int:end_bp>', methods=['GET'])
 @requires_auth
@@ -417,18 +509,31 @@ def get_all_variant_track_data(contig, start_bp, end_bp):
         'data': result_data
     }
     t1 = time.time()
-    print(f'{len(result_data)} all_variant_data, {get_all_variants_in_range.cache_info()}; {t1-t0:.2f} s')
+    print(f'{len(result_data)} all_variant_data, {get_all_variants_in_range.cache_info()}, tiles {get_variant_tile.cache_info()}; {t1-t0:.2f} s')
     return json.dumps(result)
 
 
 #******************************
 #*   /interval_track_data     *
 #******************************
-from sirius.core.interval_track import get_intervals_in_range
+from sirius.core.interval_track import get_intervals_in_range, get_interval_columns_in_range
+from sirius.core.track_binary import wants_binary, encode_track, TRACK_BINARY_MIMETYPE
+
+def track_binary_response(header, columns=None, i_start=0, i_end=0, names=()):
+    """ Response with the rows i_start to i_end of the TrackColumns in the binary format, '_id' is renamed to 'id' """
+    names = [(name, 'id' if name == '_id' else name) for name in names]
+    response = Response(encode_track(header, columns, i_start, i_end, names), mimetype=TRACK_BINARY_MIMETYPE)
+    response.vary.add('Accept')
+    return response
 
 @app.route('/interval_track_data/<string:contig>/<int:start_bp>/<int:end_bp>', methods=['POST'])
 @requires_auth
 def get_interval_track_data(contig, start_bp, end_bp):
+    """
+    /interval_track_data endpoint gives the results of the query in the body that overlap [start_bp, end_bp] of contig.
+    The results are found and cached one contig at a time, so the 'limit' of the query is a number of results per contig,
+    not over the whole genome.
+    """
     t0 = time.time()
     query = request.get_json()
     fields = request.args.get('fields', None)
@@ -438,29 +543,30 @@ def get_interval_track_data(contig, start_bp, end_bp):
         return abort(404, 'no query specified')
     if contig not in loaded_contig_info_dict:
         return abort(404, 'contig not found')
-    empty_return = json.dumps({
+    # send the binary format to the clients asking for it
+    binary = wants_binary(request.accept_mimetypes)
+    header = {
         'contig': contig,
         'start_bp': start_bp,
         'end_bp': end_bp,
         'fields': fields,
-        'data': [],
-    })
+    }
     total_length = loaded_contig_info_dict[contig]['length']
     # check start_bp and end_bp
     if start_bp > total_length or end_bp < 1 or start_bp > end_bp:
         print("interval out of range!")
-        return empty_return
+        return track_binary_response(header) if binary else json.dumps(dict(header, data=[]))
     start_bp = max(start_bp, 1)
     end_bp = min(end_bp, total_length)
+    header.update(start_bp=start_bp, end_bp=end_bp)
     t1 = time.time()
+    if binary:
+        columns = get_interval_columns_in_range(contig, start_bp, end_bp, query, fields=fields)
+        response = track_binary_response(header, columns, 0, len(columns), columns.names)
+        print(f'{len(columns)} interval_data binary, {query}, parse {t1-t0:.2f} s | load {time.time()-t1:.2f} s')
+        return response
     result_data = get_intervals_in_range(contig, start_bp, end_bp, query, fields=fields)
-    result = {
-        'contig': contig,
-        'start_bp': start_bp,
-        'end_bp': end_bp,
-        'fields': fields,
-        'data': result_data,
-    }
+    result = dict(header, data=result_data)
     t2 = time.time()
     print(f'{len(result_data)} interval_data, {query}, parse {t1-t0:.2f} s | load {t2-t1:.2f} s')
     return json.dumps(result)
@@ -468,38 +574,44 @@ def get_interval_track_data(contig, start_bp, end_bp):
 #******************************
 #*   /variant_track_data     *
 #******************************
-from sirius.core.variant_track import get_variants_in_range
+from sirius.core.variant_track import get_variants_in_range, get_variant_columns_in_range
 
 @app.route('/variant_track_data/<string:contig>/<int:start_bp>/<int:end_bp>', methods=['POST'])
 @requires_auth
 def get_variant_track_data(contig, start_bp, end_bp):
+    """
+    /variant_track_data endpoint gives the variants of the query in the body that are in [start_bp, end_bp] of contig.
+    Like /interval_track_data, the 'limit' of the query is a number of results per contig.
+    """
     t0 = time.time()
     query = request.get_json()
     if not query:
         return abort(404, 'no query specified')
     if contig not in loaded_contig_info_dict:
         return abort(404, 'contig not found')
-    empty_return = json.dumps({
+    # send the binary format to the clients asking for it
+    binary = wants_binary(request.accept_mimetypes)
+    header = {
         'contig': contig,
         'start_bp': start_bp,
         'end_bp': end_bp,
-        'data': []
-    })
+    }
     total_length = loaded_contig_info_dict[contig]['length']
     # check start_bp and end_bp
     if start_bp > total_length or end_bp < 1 or start_bp > end_bp:
         print("interval out of range!")
-        return empty_return
+        return track_binary_response(header) if binary else json.dumps(dict(header, data=[]))
     start_bp = max(start_bp, 1)
     end_bp = min(end_bp, total_length)
+    header.update(start_bp=start_bp, end_bp=end_bp)
     t1 = time.time()
+    if binary:
+        columns = get_variant_columns_in_range(contig, start_bp, end_bp, query)
+        response = track_binary_response(header, columns, 0, len(columns), columns.names)
+        print(f'{len(columns)} variants_data binary, {query}, parse {t1-t0:.2f} s | load {time.time()-t1:.2f} s')
+        return response
     result_data = get_variants_in_range(contig, start_bp, end_bp, query)
-    result = {
-        'contig': contig,
-        'start_bp': start_bp,
-        'end_bp': end_bp,
-        'data': result_data
-    }
+    result = dict(header, data=result_data)
     t2 = time.time()
     print(f'{len(result_data)} variants_data, {query}, parse {t1-t0:.2f} s | load {t2-t1:.2f} s')
     return json.dumps(result)
@@ -84,6 +84,8 @@ loaded_contig_info = list(loaded_contig_info_dict.values())
 # Store all possible genome contigs
 # this should be normalized with the InfoNodes in the future
 loaded_genome_contigs = set(GenomeNodes.distinct('contig'))
+# the contigs of the reference sequence with genome data, in the order of the reference
+loaded_primary_contigs = [c['name'] for c in loaded_contig_info if c['name'] in loaded_genome_contigs]
 
 # store all loaded genes
 loaded_gene_names = sorted(GenomeNodes.distinct('name', {'type': {'$in': ENSEMBL_GENE_SUBTYPES}}))
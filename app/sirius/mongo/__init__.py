@@ -35,6 +35,8 @@ db = client.database
 GenomeNodes = db.GenomeNodes
 InfoNodes = db.InfoNodes
 Edges = db.Edges
+# precomputed value counts for /distinct_values, see sirius.query.facets
+Facets = db.Facets
 
 # The user database for storing user-uploaded private data
 userdb = client.userdb
@@ -1,4 +1,5 @@
 import copy
+from sirius.mongo.utils import batched_lookup
 
 def update_insert_many(dbCollection, nodes, update=True):
     if not nodes: return
@@ -13,10 +14,7 @@ def update_insert_many(dbCollection, nodes, update=True):
     all_ids_need_update = set()
     if update == True:
         # query the database in batches to find existing document with id
-        batch_size = 100000
-        for i_batch in range(int(len(all_ids) / batch_size)+1):
-            batch_ids = all_ids[i_batch*batch_size:(i_batch+1)*batch_size]
-            all_ids_need_update.update(result['_id'] for result in dbCollection.find({'_id': {'$in': batch_ids}}, projection=['_id']))
+        all_ids_need_update.update(result['_id'] for result in batched_lookup(dbCollection, all_ids, projection=['_id']))
     insert_nodes, update_nodes = [], []
     for node in nodes:
         if node['_id'] in all_ids_need_update:
@@ -66,10 +64,7 @@ def update_skip_insert(dbCollection, nodes):
         all_ids.append(node['_id'])
     all_ids_need_update = set()
     # query the database in batches to find existing document with id
-    batch_size = 100000
-    for i_batch in range(int(len(all_ids) / batch_size)+1):
-        batch_ids = all_ids[i_batch*batch_size:(i_batch+1)*batch_size]
-        all_ids_need_update.update(result['_id'] for result in dbCollection.find({'_id': {'$in': batch_ids}}, projection=['_id']))
+    all_ids_need_update.update(result['_id'] for result in batched_lookup(dbCollection, all_ids, projection=['_id']))
     for node in nodes:
         if node['_id'] not in all_ids_need_update: continue
         filt = {'_id': node.pop('_id')}
@@ -1,14 +1,188 @@
-def doc_generator(collection, id_stream, batch_size=100000, **kwargs):
-    batch_ids = []
-    for one_id in id_stream:
-        batch_ids.append(one_id)
-        if len(batch_ids) >= batch_size:
-            mongo_filter = {"_id": {"$in": batch_ids}}
-            for d in collection.find(mongo_filter, **kwargs):
-                yield d
-            batch_ids = []
-    else:
-        if len(batch_ids) > 0:
-            mongo_filter = {"_id": {"$in": batch_ids}}
-            for d in collection.find(mongo_filter, **kwargs):
-                yield d
+"""
+Batched lookups of documents by lists of ids.
+
+A {field: {'$in': ids}} filter has to fit in one BSON document of at most 16 MB, so long lists of ids are split into batches.
+The batches are sized by the encoded size of the ids instead of their number, since our '_id' strings vary a lot in length,
+and several batches are in flight at the same time over the connection pool of the MongoClient.
+The latency of every batch is recorded in lookup_stats, to tune LOOKUP_MAX_BATCH_BYTES and LOOKUP_CONCURRENCY for a cluster,
+its summary is printed with the cache info of the query and track endpoints.
+"""
+
+import os
+import time
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# half of the 16 MB BSON limit, leaving space for the rest of the filter
+LOOKUP_MAX_BATCH_BYTES = int(os.environ.get('SIRIUS_LOOKUP_MAX_BATCH_BYTES', 8 * 1024 * 1024))
+# large batches also make single slow round trips, so the number of ids is capped too
+LOOKUP_MAX_BATCH_IDS = int(os.environ.get('SIRIUS_LOOKUP_MAX_BATCH_IDS', 100000))
+# number of batches of one lookup in flight at the same time
+LOOKUP_CONCURRENCY = int(os.environ.get('SIRIUS_LOOKUP_CONCURRENCY', 4))
+# total number of threads running lookup batches in this process
+LOOKUP_POOL_WORKERS = 16
+
+_lookup_pool = ThreadPoolExecutor(max_workers=LOOKUP_POOL_WORKERS, thread_name_prefix='sirius_lookup')
+
+class LookupStats:
+    """ Thread-safe statistics of the lookup batches of this process """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.n_batches = 0
+            self.n_ids = 0
+            self.n_bytes = 0
+            self.n_docs = 0
+            self.total_time = 0.0
+            self.max_time = 0.0
+
+    def record(self, n_ids, n_bytes, n_docs, seconds):
+        with self.lock:
+            self.n_batches += 1
+            self.n_ids += n_ids
+            self.n_bytes += n_bytes
+            self.n_docs += n_docs
+            self.total_time += seconds
+            self.max_time = max(self.max_time, seconds)
+
+    def summary(self):
+        with self.lock:
+            mean_time = self.total_time / self.n_batches if self.n_batches else 0.0
+            return {
+                'batches': self.n_batches,
+                'ids': self.n_ids,
+                'bytes': self.n_bytes,
+                'docs': self.n_docs,
+                'mean_batch_time': mean_time,
+                'max_batch_time': self.max_time,
+            }
+
+lookup_stats = LookupStats()
+
+def encoded_id_size(i, one_id):
+    """ Size of one id as element i of a BSON array: type byte, index key, and the value """
+    key_size = len(str(i)) + 1
+    if isinstance(one_id, str):
+        # int32 length, utf-8 bytes and the null terminator
+        return 1 + key_size + 4 + len(one_id.encode()) + 1
+    # ObjectId, int64 and the like
+    return 1 + key_size + 12
+
+def iter_id_batches(ids, max_bytes=LOOKUP_MAX_BATCH_BYTES, max_ids=LOOKUP_MAX_BATCH_IDS):
+    """ Split an iterable of ids into lists that fit in an $in filter of max_bytes, with at most max_ids each """
+    batch, batch_bytes = [], 0
+    for one_id in ids:
+        size = encoded_id_size(len(batch), one_id)
+        if batch and (batch_bytes + size > max_bytes or len(batch) >= max_ids):
+            yield batch
+            batch, batch_bytes = [], 0
+            size = encoded_id_size(0, one_id)
+        batch.append(one_id)
+        batch_bytes += size
+    if batch:
+        yield batch
+
+def in_filter(mongo_filter, field, batch_ids):
+    """ Add the condition {field: {'$in': batch_ids}} to mongo_filter, keeping any existing condition on field """
+    if not mongo_filter:
+        return {field: {'$in': batch_ids}}
+    if field in mongo_filter:
+        return {'$and': [mongo_filter, {field: {'$in': batch_ids}}]}
+    result = dict(mongo_filter)
+    result[field] = {'$in': batch_ids}
+    return result
+
+def _run_batch(func, batch_ids, on_batch):
+    t0 = time.time()
+    result = func(batch_ids)
+    seconds = time.time() - t0
+    n_bytes = sum(encoded_id_size(i, one_id) for i, one_id in enumerate(batch_ids))
+    n_docs = len(result) if isinstance(result, list) else 0
+    lookup_stats.record(len(batch_ids), n_bytes, n_docs, seconds)
+    if on_batch is not None:
+        on_batch(len(batch_ids), n_docs, seconds)
+    return result
+
+def map_id_batches(func, ids, concurrency=LOOKUP_CONCURRENCY, on_batch=None, **batch_kwargs):
+    """
+    Generate func(batch_ids) for the batches of ids, in order, with up to concurrency batches in flight.
+
+    Parameters
+    ----------
+    func: callable
+        Called with each list of batch ids, runs in a pool thread
+    ids: iterable
+        The ids, split with iter_id_batches(ids, **batch_kwargs)
+    concurrency: int, default LOOKUP_CONCURRENCY
+        The number of batches requested ahead, 1 runs the batches one by one in the calling thread
+    on_batch: callable, optional
+        Called with (n_ids, n_docs, seconds) after each batch, for profiling
+
+    When the generator is closed early, the batches that have not started are cancelled.
+    """
+    batches = iter_id_batches(ids, **batch_kwargs)
+    if concurrency <= 1:
+        for batch_ids in batches:
+            yield _run_batch(func, batch_ids, on_batch)
+        return
+    pending = deque()
+    try:
+        for batch_ids in batches:
+            pending.append(_lookup_pool.submit(_run_batch, func, batch_ids, on_batch))
+            if len(pending) >= concurrency:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+
+def batched_lookup(collection, ids, field='_id', mongo_filter=None, limit=0, concurrency=LOOKUP_CONCURRENCY, on_batch=None, **kwargs):
+    """
+    Generate the documents of collection with field in ids, and matching mongo_filter.
+
+    At most limit documents are returned over all batches, 0 means no limit.
+    Each batch only asks for the documents still missing when it starts,
+    and no more batches are issued once the limit is reached.
+    Other kwargs, like projection and max_time_ms, are passed to collection.find().
+    """
+    n_found = 0
+    def find_batch(batch_ids):
+        # the batches are yielded in order, so only the documents of earlier batches count here
+        if limit > 0 and n_found >= limit:
+            # a batch started ahead of the one reaching the limit, 0 would mean no limit
+            return []
+        batch_limit = limit - n_found if limit > 0 else 0
+        return list(collection.find(in_filter(mongo_filter, field, batch_ids), limit=batch_limit, **kwargs))
+    batch_results = map_id_batches(find_batch, ids, concurrency=concurrency, on_batch=on_batch)
+    try:
+        for docs in batch_results:
+            if limit > 0:
+                docs = docs[:limit-n_found]
+            n_found += len(docs)
+            yield from docs
+            if limit > 0 and n_found >= limit:
+                return
+    finally:
+        batch_results.close()
+
+def batched_distinct(collection, key, ids, field='_id', mongo_filter=None, concurrency=LOOKUP_CONCURRENCY, on_batch=None, **kwargs):
+    """ Return the set of distinct values of key, for documents with field in ids and matching mongo_filter """
+    func = lambda b: collection.distinct(key, in_filter(mongo_filter, field, b), **kwargs)
+    result = set()
+    for values in map_id_batches(func, ids, concurrency=concurrency, on_batch=on_batch):
+        result.update(values)
+    return result
+
+def batched_count(collection, ids, field='_id', mongo_filter=None, concurrency=LOOKUP_CONCURRENCY, on_batch=None, **kwargs):
+    """ Count the documents with field in ids and matching mongo_filter """
+    func = lambda b: collection.count_documents(in_filter(mongo_filter, field, b), **kwargs)
+    return sum(map_id_batches(func, ids, concurrency=concurrency, on_batch=on_batch))
+
+def doc_generator(collection, id_stream, **kwargs):
+    """ Generate the documents of collection with '_id' in id_stream, see batched_lookup() """
+    return batched_lookup(collection, id_stream, **kwargs)
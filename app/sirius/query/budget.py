@@ -0,0 +1,108 @@
+"""
+Per-query time and resource budget.
+
+A QueryBudget is created for every interactive request that runs a QueryTree, and is shared by all nodes of the tree.
+The exports and the builds of the track caches are expected to take longer, their QueryTrees have no budget.
+Each MongoDB call gets maxTimeMS from the remaining time of the budget, the intermediate id sets are capped,
+and once the budget is exceeded it is cancelled, so the concurrent children of the query stop at their next check.
+The client then gets a QueryTooExpensive error instead of a hung request.
+"""
+
+import time
+import functools
+from pymongo.errors import ExecutionTimeout
+
+# default total time of one query
+QUERY_MAX_TIME_MS = 30000
+# default maximum size of any intermediate id set, 40 MB as an IdSet
+QUERY_MAX_IDS = 10000000
+
+class QueryTooExpensive(Exception):
+    """ Raised when a query exceeds its QueryBudget """
+    def __init__(self, reason, message):
+        super().__init__(message)
+        self.reason = reason
+        self.message = message
+
+    def to_dict(self):
+        return {'error': 'query_too_expensive', 'reason': self.reason, 'message': self.message}
+
+class QueryBudget:
+    """
+    Time and size limits of one query.
+
+    Attributes
+    ----------
+    deadline: float
+        The time.time() after which the query is cancelled
+
+    max_ids: int
+        The maximum size of any intermediate id set
+
+    cancelled: QueryTooExpensive or None
+        The error that cancelled this budget, raised again by every later check
+
+    """
+    def __init__(self, max_time_ms=QUERY_MAX_TIME_MS, max_ids=QUERY_MAX_IDS):
+        self.max_time_ms = max_time_ms
+        self.deadline = time.time() + max_time_ms / 1000
+        self.max_ids = max_ids
+        self.cancelled = None
+
+    def stop(self, reason, message):
+        """ Cancel the query without raising, all later checks will raise QueryTooExpensive """
+        if self.cancelled is None:
+            self.cancelled = QueryTooExpensive(reason, message)
+
+    def cancel(self, reason, message):
+        """ Cancel the query, and raise QueryTooExpensive """
+        self.stop(reason, message)
+        raise self.cancelled
+
+    def check(self):
+        """ Raise QueryTooExpensive if the budget is cancelled or out of time """
+        if self.cancelled is not None:
+            raise self.cancelled
+        if time.time() > self.deadline:
+            self.cancel('time', f"Query did not finish within {self.max_time_ms} ms")
+
+    def remaining_ms(self):
+        """ Return the remaining time in ms, at least 1, raise QueryTooExpensive if there is none """
+        self.check()
+        return max(int((self.deadline - time.time()) * 1000), 1)
+
+    def check_ids(self, n_ids):
+        """ Raise QueryTooExpensive if an intermediate id set is too large """
+        self.check()
+        if n_ids > self.max_ids:
+            self.cancel('size', f"Query has an intermediate result of {n_ids} ids, more than the limit {self.max_ids}")
+
+def find_kwargs(budget):
+    """ Keyword arguments for Collection.find() to respect the budget """
+    return {} if budget is None else {'max_time_ms': budget.remaining_ms()}
+
+def command_kwargs(budget, max_time_ms=None):
+    """ Keyword arguments for Collection.aggregate(), distinct() and count_documents() to respect the budget """
+    if budget is not None:
+        max_time_ms = budget.remaining_ms() if max_time_ms is None else min(max_time_ms, budget.remaining_ms())
+    return {} if max_time_ms is None else {'maxTimeMS': max_time_ms}
+
+def budget_checked(method):
+    """
+    Decorator for the findid() and find_from_id() methods of query nodes.
+    Checks the budget of the node before running, and the size of the resulting id set after.
+    A MongoDB timeout caused by maxTimeMS is converted into QueryTooExpensive, and cancels the budget.
+    """
+    @functools.wraps(method)
+    def _checked_method(self, *args, **kwargs):
+        budget = getattr(self, 'budget', None)
+        if budget is None:
+            return method(self, *args, **kwargs)
+        budget.check()
+        try:
+            result = method(self, *args, **kwargs)
+        except ExecutionTimeout:
+            budget.cancel('time', f"Query did not finish within {budget.max_time_ms} ms")
+        budget.check_ids(len(result))
+        return result
+    return _checked_method
@@ -0,0 +1,104 @@
+"""
+Canonical form of query dictionaries, used as the keys of the query caches.
+
+Queries that mean the same thing can come in different shapes: the toEdges in another order,
+the values of $in lists in another order, or defaults like edgeRule 'and' and limit 100000 given explicitly or left out.
+canonicalize() converts a query into one stable form, and CanonicalQuery computes the digest of that form once,
+so the caches hit for all these variants and hashing a query no longer serializes it again.
+"""
+
+import json
+import copy
+import hashlib
+from sirius.helpers.constants import QUERY_TYPE_GENOME, QUERY_TYPE_INFO, QUERY_TYPE_EDGE
+
+# default limit of every query node, can finish in 1s
+DEFAULT_QUERY_LIMIT = 100000
+DEFAULT_EDGE_RULE = 'and'
+DEFAULT_WINDOW_SIZE = 1000
+
+# the values of these operators are sets, their order does not matter
+SET_OPERATORS = {'$in', '$nin', '$all'}
+
+def _sort_key(value):
+    return json.dumps(value, sort_keys=True)
+
+def _sorted_unique(values):
+    """ Sort a list of values of any types, and remove duplicates """
+    unique = {_sort_key(v): v for v in values}
+    return [unique[k] for k in sorted(unique)]
+
+def canonicalize_filter(value):
+    """ Return a copy of a filter value with the lists of set operators sorted """
+    if isinstance(value, dict):
+        result = dict()
+        for k, v in value.items():
+            if k in SET_OPERATORS and isinstance(v, list):
+                result[k] = _sorted_unique(v)
+            else:
+                result[k] = canonicalize_filter(v)
+        return result
+    elif isinstance(value, list):
+        return [canonicalize_filter(v) for v in value]
+    return value
+
+def canonicalize(query):
+    """
+    Return the canonical form of a query dictionary, the query itself is not modified.
+
+    The defaults used by QueryTree are filled in, the filters have sorted $in lists,
+    the toEdges are sorted (except the base edge of a 'not'), and so are the targets of each arithmetic operation.
+    """
+    if not query:
+        return query
+    result = copy.deepcopy(query)
+    typ = result.get('type')
+    result['filters'] = canonicalize_filter(result.get('filters') or dict())
+    result.setdefault('limit', DEFAULT_QUERY_LIMIT)
+    if typ in (QUERY_TYPE_GENOME, QUERY_TYPE_INFO):
+        edge_rule = result.setdefault('edgeRule', DEFAULT_EDGE_RULE)
+        edges = [canonicalize(d) for d in result.get('toEdges', [])]
+        if edge_rule == 'not':
+            # the first edge is the base of the result, only the excluded edges can be reordered
+            edges = edges[:1] + sorted(edges[1:], key=_sort_key)
+        else:
+            edges = sorted(edges, key=_sort_key)
+        result['toEdges'] = edges
+        if typ == QUERY_TYPE_GENOME:
+            arithmetics = []
+            for ar in result.get('arithmetics', []):
+                # the targets of each operation are applied one by one as sets, their order does not matter
+                ar['target_queries'] = sorted((canonicalize(q) for q in ar.get('target_queries', [])), key=_sort_key)
+                if ar.get('operator') == 'window':
+                    ar.setdefault('windowSize', DEFAULT_WINDOW_SIZE)
+                arithmetics.append(ar)
+            result['arithmetics'] = arithmetics
+    elif typ == QUERY_TYPE_EDGE:
+        result.setdefault('reverse', False)
+        if result.get('toNode'):
+            result['toNode'] = canonicalize(result['toNode'])
+    return result
+
+def query_digest(query):
+    """ Compute the digest of a query dictionary, canonical queries with the same meaning have the same digest """
+    return hashlib.sha1(json.dumps(query, sort_keys=True).encode()).hexdigest()
+
+class CanonicalQuery(dict):
+    """
+    The canonical form of a query, hashable by its digest, to be used as the key of query caches.
+    The digest is computed once, so the query should not be modified after creation.
+    """
+    def __init__(self, query):
+        super().__init__(canonicalize(query) or dict())
+        self.digest = query_digest(self)
+
+    def __hash__(self):
+        return hash(self.digest)
+
+    def __eq__(self, other):
+        if isinstance(other, CanonicalQuery):
+            return self.digest == other.digest
+        return dict.__eq__(self, other)
+
+    def __ne__(self, other):
+        return not self == other
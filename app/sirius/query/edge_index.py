@@ -0,0 +1,245 @@
+"""
+In-memory CSR adjacency index of the Edges collection, for traversals without MongoDB round trips.
+
+Every hop of a query through Edges is a find() on the 'from_id' or 'to_id' index, batched by the ids of the next node.
+The EdgeIndex keeps the fields used by most edge filters in numpy arrays instead:
+'from_id' and 'to_id' as codes of its own IdDictionary, 'type' and 'source' as small integer categories,
+and 'info.p-value' as floats. The edges are ordered twice in CSR form, by 'from_id' and by 'to_id',
+so the edges of a set of nodes are found with one vectorized gather over the offsets of their codes.
+
+The index is optional, it is selected with the SIRIUS_EDGE_INDEX environment variable:
+
+- '' (the default): disabled, all edges are read from MongoDB
+- 'mongo': built from the Edges collection in a background thread when it is first needed
+- a path to a .npz snapshot: loaded from the file, or built from MongoDB and saved there if it does not exist,
+  the file should be deleted when the database is rebuilt
+
+Until the index is ready, and for filters on any other field, QueryEdge uses MongoDB as before.
+"""
+
+import os
+import json
+import threading
+import numpy as np
+from sirius.mongo import Edges
+from sirius.query.idset import IdSet, IdDictionary
+from sirius.query.matching import match_condition
+
+EDGE_INDEX = os.environ.get('SIRIUS_EDGE_INDEX', '')
+
+# the fields of the Edges filters that can be evaluated on the index
+CATEGORY_FIELDS = ('type', 'source')
+NUMBER_FIELDS = {'info.p-value': 'pvalue'}
+COMPARISON_OPERATORS = {
+    '$gt': np.greater, '$gte': np.greater_equal, '$lt': np.less, '$lte': np.less_equal,
+    '$eq': np.equal, '$ne': np.not_equal,
+}
+
+def csr_order(codes, n_nodes):
+    """ Return (offsets, order), the edges of node code c are order[offsets[c]:offsets[c+1]] """
+    order = np.argsort(codes, kind='stable').astype(np.int64)
+    offsets = np.zeros(n_nodes + 1, dtype=np.int64)
+    np.cumsum(np.bincount(codes, minlength=n_nodes), out=offsets[1:])
+    return offsets, order
+
+def csr_gather(offsets, order, codes):
+    """ Return the indices of all edges of the node codes, as one array """
+    codes = codes[codes < len(offsets) - 1]
+    starts = offsets[codes]
+    lengths = offsets[codes + 1] - starts
+    total = int(lengths.sum())
+    if total == 0:
+        return np.empty(0, dtype=np.int64)
+    # position of each gathered edge within its node, added to the start of its node
+    run_starts = np.repeat(np.cumsum(lengths) - lengths, lengths)
+    return order[np.repeat(starts, lengths) + np.arange(total) - run_starts]
+
+class EdgeIndex:
+    """
+    Read-only adjacency index of Edges.
+
+    Attributes
+    ----------
+    dictionary: IdDictionary
+        The codes of the node ids of the edges, kept apart from the dictionary of the queries so it doesn't grow it
+    from_codes, to_codes: np.ndarray
+        The dictionary codes of 'from_id' and 'to_id' of each edge
+    categories: dict
+        For 'type' and 'source', the pair (values, codes) of the list of distinct values and the array of value indices of each edge
+    pvalue: np.ndarray
+        'info.p-value' of each edge, NaN when it is missing
+    out_offsets, out_order, in_offsets, in_order: np.ndarray
+        The CSR orders of the edges by from_codes and by to_codes
+    """
+    def __init__(self, node_ids, from_local, to_local, categories, pvalue):
+        # the codes in the arrays are local to the snapshot, map them to the codes of this index
+        self.dictionary = IdDictionary()
+        node_codes = self.dictionary.encode(node_ids)
+        self.from_codes = node_codes[from_local]
+        self.to_codes = node_codes[to_local]
+        self.categories = categories
+        self.pvalue = pvalue
+        n_nodes = int(node_codes.max()) + 1 if len(node_codes) else 0
+        self.out_offsets, self.out_order = csr_order(self.from_codes, n_nodes)
+        self.in_offsets, self.in_order = csr_order(self.to_codes, n_nodes)
+
+    def __len__(self):
+        return len(self.from_codes)
+
+    @classmethod
+    def from_documents(cls, docs):
+        """ Build the index from Edges documents with the fields 'from_id', 'to_id', 'type', 'source', 'info' """
+        local_codes = dict()
+        from_local, to_local, pvalue = [], [], []
+        category_codes = {field: dict() for field in CATEGORY_FIELDS}
+        category_local = {field: [] for field in CATEGORY_FIELDS}
+        for d in docs:
+            from_local.append(local_codes.setdefault(d['from_id'], len(local_codes)))
+            to_local.append(local_codes.setdefault(d['to_id'], len(local_codes)))
+            for field in CATEGORY_FIELDS:
+                value = d.get(field)
+                if isinstance(value, list):
+                    value = tuple(value)
+                category_local[field].append(category_codes[field].setdefault(value, len(category_codes[field])))
+            p = d.get('info', {}).get('p-value')
+            pvalue.append(p if isinstance(p, (int, float)) else np.nan)
+        categories = {field: (list(category_codes[field]), np.array(category_local[field], dtype=np.int32)) for field in CATEGORY_FIELDS}
+        return cls(list(local_codes), np.array(from_local, dtype=np.int64), np.array(to_local, dtype=np.int64),
+                   categories, np.array(pvalue, dtype=np.float64))
+
+    @classmethod
+    def from_mongo(cls, mongo_collection=Edges):
+        projection = {'_id': 0, 'from_id': 1, 'to_id': 1, 'type': 1, 'source': 1, 'info.p-value': 1}
+        return cls.from_documents(mongo_collection.find({}, projection=projection))
+
+    def save(self, path):
+        """ Save a snapshot of the index, with the '_id' strings so it can be loaded in another process """
+        node_codes, local = np.unique(np.concatenate([self.from_codes, self.to_codes]), return_inverse=True)
+        arrays = {
+            'node_ids': np.array(self.dictionary.decode(node_codes), dtype=str),
+            'from_local': local[:len(self)],
+            'to_local': local[len(self):],
+            'pvalue': self.pvalue,
+        }
+        for field, (values, codes) in self.categories.items():
+            # the values can be None or arrays, they are saved as json
+            arrays[f'{field}_values'] = np.array([json.dumps(v) for v in values], dtype=str)
+            arrays[f'{field}_codes'] = codes
+        tmp_path = path + '.tmp.npz'
+        np.savez(tmp_path, **arrays)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            categories = dict()
+            for field in CATEGORY_FIELDS:
+                values = [json.loads(v) for v in f[f'{field}_values'].tolist()]
+                values = [tuple(v) if isinstance(v, list) else v for v in values]
+                categories[field] = (values, f[f'{field}_codes'])
+            return cls(f['node_ids'].tolist(), f['from_local'], f['to_local'], categories, f['pvalue'])
+
+    def supports(self, mongo_filter):
+        """ Return True if every condition of mongo_filter can be evaluated on the index """
+        for key, condition in mongo_filter.items():
+            if key in CATEGORY_FIELDS:
+                if isinstance(condition, dict):
+                    if not all(op in ('$eq', '$ne', '$in', '$nin') for op in condition):
+                        return False
+                elif isinstance(condition, list):
+                    return False
+            elif key in NUMBER_FIELDS:
+                if not isinstance(condition, dict):
+                    condition = {'$eq': condition}
+                for op, value in condition.items():
+                    if op not in COMPARISON_OPERATORS or isinstance(value, bool) or not isinstance(value, (int, float)):
+                        return False
+            else:
+                return False
+        return True
+
+    def _category_mask(self, field, condition, edges):
+        values, codes = self.categories[field]
+        # match each distinct value once, arrays match by their elements like in MongoDB
+        matched_codes = [i for i, v in enumerate(values) if match_condition(list(v) if isinstance(v, tuple) else v, condition)]
+        return np.isin(codes[edges], matched_codes)
+
+    def filter_edges(self, mongo_filter, edges=None):
+        """ Return the indices of the edges matching mongo_filter, among edges if given, in their order """
+        if edges is None:
+            edges = np.arange(len(self), dtype=np.int64)
+        mask = np.ones(len(edges), dtype=bool)
+        for key, condition in mongo_filter.items():
+            if key in CATEGORY_FIELDS:
+                mask &= self._category_mask(key, condition, edges)
+            else:
+                values = getattr(self, NUMBER_FIELDS[key])[edges]
+                if not isinstance(condition, dict):
+                    condition = {'$eq': condition}
+                for op, target in condition.items():
+                    # NaN compares False, like a missing field, except for $ne
+                    matched = COMPARISON_OPERATORS[op](values, target)
+                    if op == '$ne':
+                        matched |= np.isnan(values)
+                    mask &= matched
+        return edges[mask]
+
+    def edges_from(self, id_set, reverse=False):
+        """ Return the indices of the edges starting from the ids of id_set, or ending at them with reverse=True """
+        # the ids without edges are not in the dictionary of the index
+        codes = id_set.codes_in(self.dictionary, add=False)
+        if reverse:
+            return csr_gather(self.in_offsets, self.in_order, codes)
+        return csr_gather(self.out_offsets, self.out_order, codes)
+
+    def edges_to(self, id_set, reverse=False):
+        """ Return the indices of the edges ending at the ids of id_set, or starting from them with reverse=True """
+        return self.edges_from(id_set, reverse=not reverse)
+
+    def end_codes(self, end):
+        """ The codes of the 'from' or 'to' end of all edges """
+        return self.from_codes if end == 'from' else self.to_codes
+
+    def end_ids(self, edges, end, limit=0):
+        """ Return the IdSet of the 'from' or 'to' end of the edges, for the first limit edges if limit > 0 """
+        if limit > 0:
+            edges = edges[:limit]
+        return IdSet.from_codes(np.unique(self.end_codes(end)[edges]), self.dictionary)
+
+_edge_index = None
+_edge_index_lock = threading.Lock()
+_edge_index_thread = None
+
+def _load_edge_index(source):
+    global _edge_index
+    try:
+        if source == 'mongo':
+            index = EdgeIndex.from_mongo()
+        elif os.path.exists(source):
+            index = EdgeIndex.load(source)
+        else:
+            index = EdgeIndex.from_mongo()
+            index.save(source)
+        print(f"Edge index ready with {len(index)} edges")
+        _edge_index = index
+    except Exception as e:
+        print(f"Edge index failed to load with error {e}, using MongoDB for edges")
+
+def get_edge_index():
+    """
+    Return the EdgeIndex of this process, or None when it is disabled or not loaded yet.
+    The first call starts loading it in a background thread.
+    """
+    global _edge_index_thread
+    if _edge_index is not None or not EDGE_INDEX:
+        return _edge_index
+    with _edge_index_lock:
+        if _edge_index_thread is None:
+            _edge_index_thread = threading.Thread(target=_load_edge_index, args=(EDGE_INDEX,), daemon=True, name='sirius_edge_index')
+            _edge_index_thread.start()
+    return _edge_index
+
+def set_edge_index(index):
+    """ Replace the EdgeIndex of this process, None disables it """
+    global _edge_index
+    _edge_index = index
@@ -0,0 +1,86 @@
+"""
+Bounded concurrent evaluation of the independent children of query nodes.
+
+The sibling edges of a node and the targets of an arithmetic operation mostly wait on MongoDB,
+so they are evaluated in a thread pool shared by all queries of this process.
+Each QueryTree gets its own QueryExecutor, which caps how many pool threads a single query can hold,
+so one big query can't starve the other requests.
+"""
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# total number of threads evaluating query children in this process
+QUERY_POOL_WORKERS = 16
+# number of pool threads a single query can use at the same time
+QUERY_MAX_CONCURRENCY = 4
+
+_pool = ThreadPoolExecutor(max_workers=QUERY_POOL_WORKERS, thread_name_prefix='sirius_query')
+# a task is only submitted when a pool thread is reserved for it, so a task never waits in the queue
+# behind tasks that are waiting for it, and nested calls can not deadlock
+_pool_slots = threading.BoundedSemaphore(QUERY_POOL_WORKERS)
+
+class QueryExecutor:
+    """
+    Run the children of one query concurrently, with at most max_concurrency pool threads.
+
+    When no pool thread is available, a task simply runs in the calling thread,
+    so the results are always produced, just with less concurrency.
+    """
+    def __init__(self, max_concurrency=QUERY_MAX_CONCURRENCY):
+        self.max_concurrency = max_concurrency
+        self.slots = threading.BoundedSemaphore(max_concurrency)
+        # the QueryBudget of the query, set by QueryTree
+        self.budget = None
+
+    def _try_reserve(self):
+        if not self.slots.acquire(blocking=False):
+            return False
+        if not _pool_slots.acquire(blocking=False):
+            self.slots.release()
+            return False
+        return True
+
+    def _release(self):
+        _pool_slots.release()
+        self.slots.release()
+
+    def _run(self, func, item):
+        try:
+            return func(item)
+        except Exception as e:
+            # the siblings of a failed task are useless, they stop at their next budget check
+            if self.budget is not None:
+                self.budget.stop('error', f"Query cancelled after an error: {e}")
+            raise
+
+    def _run_reserved(self, func, item):
+        try:
+            return self._run(func, item)
+        finally:
+            self._release()
+
+    def map(self, func, items):
+        """ Return [func(item) for item in items], evaluated concurrently when possible """
+        items = list(items)
+        if len(items) <= 1:
+            return [func(item) for item in items]
+        futures = []
+        # the calling thread evaluates the last item itself instead of waiting idle
+        for item in items[:-1]:
+            if self._try_reserve():
+                futures.append(_pool.submit(self._run_reserved, func, item))
+            else:
+                futures.append(None)
+        last_result = self._run(func, items[-1])
+        results = []
+        for item, future in zip(items[:-1], futures):
+            results.append(future.result() if future is not None else self._run(func, item))
+        results.append(last_result)
+        return results
+
+def parallel_map(executor, func, items):
+    """ Map func over items with the executor, or sequentially if executor is None """
+    if executor is None:
+        return [func(item) for item in items]
+    return executor.map(func, items)
@@ -0,0 +1,115 @@
+"""
+Precomputed facet tables for the /distinct_values endpoint.
+
+Most /distinct_values requests are for a few indices, under no filter or a single filter on 'type' or 'source'.
+At ingest time, build_facet_tables() counts the values of each index in FACET_INDICES for each of these simple filters,
+with one $group per index and filter key, and stores the value -> count tables in the Facets collection.
+facet_values() answers the matching queries with a single document read instead of a distinct() over the collection.
+Other queries fall back to QueryTree.distinct(), which uses $group aggregation for queries with edges where possible.
+"""
+
+from sirius.mongo import GenomeNodes, InfoNodes, Edges, Facets
+from sirius.helpers.constants import QUERY_TYPE_GENOME, QUERY_TYPE_INFO, QUERY_TYPE_EDGE
+
+# the indices with precomputed tables, for each query type
+FACET_INDICES = {
+    QUERY_TYPE_GENOME: ['type', 'source', 'info.biosample', 'info.targets'],
+    QUERY_TYPE_INFO: ['type', 'source', 'info.biosample', 'info.targets', 'info.types', 'info.assay'],
+    QUERY_TYPE_EDGE: ['type', 'source', 'info.biosample'],
+}
+# the tables are computed for no filter, and for each value of these keys
+FACET_FILTER_KEYS = ['type', 'source']
+
+def facet_collections():
+    return {QUERY_TYPE_GENOME: GenomeNodes, QUERY_TYPE_INFO: InfoNodes, QUERY_TYPE_EDGE: Edges}
+
+def facet_table_id(typ, index, filter_key=None, filter_value=None):
+    """ The '_id' of the facet table of index, for queries of type typ with filter {filter_key: filter_value} """
+    if filter_key is None:
+        return f'{typ}|{index}'
+    return f'{typ}|{index}|{filter_key}={filter_value}'
+
+def count_values(mongo_collection, index, filter_key=None):
+    """
+    Count the documents for each value of index, array values are counted for each element like in distinct().
+    With filter_key, count them for each value of filter_key at once, and return a dictionary from each value to its counts.
+    """
+    project = {'value': '$' + index}
+    group_id = '$value'
+    if filter_key is not None:
+        project['key'] = '$' + filter_key
+        group_id = {'key': '$key', 'value': '$value'}
+    pipeline = [{'$project': project}]
+    if filter_key is not None:
+        # the filter {filter_key: v} matches the documents with v in an array, like the unwound documents
+        pipeline.append({'$unwind': '$key'})
+    pipeline += [
+        {'$unwind': '$value'},
+        {'$group': {'_id': group_id, 'count': {'$sum': 1}}},
+    ]
+    counts = dict()
+    for d in mongo_collection.aggregate(pipeline, allowDiskUse=True):
+        key, value = (d['_id'].get('key'), d['_id'].get('value')) if filter_key is not None else (None, d['_id'])
+        if value is not None:
+            counts.setdefault(key, []).append({'value': value, 'count': d['count']})
+    return counts if filter_key is not None else counts.get(None, [])
+
+def build_facet_tables(verbose=True, collections=None, facets_collection=Facets):
+    """
+    Compute all facet tables and replace the content of the Facets collection, to run after the data is uploaded.
+    Each index takes one aggregation with no filter, and one for all the values of each key of FACET_FILTER_KEYS.
+    The tables are written to a temporary collection that replaces Facets at once, so the old tables are used until then.
+    """
+    if collections is None:
+        collections = facet_collections()
+    tables = []
+    for typ, mongo_collection in collections.items():
+        filter_values = {key: [value for value in mongo_collection.distinct(key) if isinstance(value, str)] for key in FACET_FILTER_KEYS}
+        for index in FACET_INDICES[typ]:
+            if verbose:
+                print(f"Building facet tables of {typ} {index} for {1 + sum(len(v) for v in filter_values.values())} filters")
+            tables.append({'_id': facet_table_id(typ, index), 'values': count_values(mongo_collection, index)})
+            for key, values in filter_values.items():
+                key_counts = count_values(mongo_collection, index, filter_key=key)
+                for value in values:
+                    tables.append({'_id': facet_table_id(typ, index, key, value), 'values': key_counts.get(value, [])})
+    tmp_collection = facets_collection.database[facets_collection.name + '_building']
+    tmp_collection.drop()
+    if tables:
+        tmp_collection.insert_many(tables)
+        tmp_collection.rename(facets_collection.name, dropTarget=True)
+    else:
+        facets_collection.drop()
+    return len(tables)
+
+def facet_table_for_query(query, index):
+    """ Return the '_id' of the facet table that answers /distinct_values/index for query, or None if there is none """
+    typ = query.get('type')
+    if index not in FACET_INDICES.get(typ, []):
+        return None
+    if query.get('toEdges') or query.get('arithmetics') or query.get('toNode') or 'userFileID' in query:
+        return None
+    filters = query.get('filters') or {}
+    if not filters:
+        return facet_table_id(typ, index)
+    if len(filters) == 1:
+        key, value = next(iter(filters.items()))
+        if key in FACET_FILTER_KEYS and isinstance(value, str):
+            return facet_table_id(typ, index, key, value)
+    return None
+
+def facet_values(query, index, with_counts=False):
+    """
+    Return the distinct values of index for query from the facet tables, or None if the query can't be answered by them.
+    With with_counts=True, return a dictionary from each value to its number of documents instead.
+    """
+    table_id = facet_table_for_query(query, index)
+    if table_id is None:
+        return None
+    table = Facets.find_one({'_id': table_id})
+    if table is None:
+        # the tables are not built, or this filter value has no table
+        return None
+    if with_counts:
+        return {v['value']: v['count'] for v in table['values']}
+    return [v['value'] for v in table['values']]
@@ -2,26 +2,16 @@ import time
 import copy
 import subprocess
 from sirius.core.utilities import HashableDict
-from sirius.analysis.bed import Bed
+from sirius.analysis.array_bed import ArrayBed
 from sirius.mongo import GenomeNodes
-from sirius.mongo.utils import doc_generator
+from sirius.mongo.utils import doc_generator, batched_lookup, batched_distinct
 from sirius.helpers.constants import CONTIG_IDXS
-
-def intersect_id_filter_set(id_filter, id_set):
-    """ Intersect the '_id' field of a mongo filter with a set of ids """
-    assert isinstance(id_set, set)
-    if not id_set:
-        return []
-    elif id_filter is None:
-        return list(id_set)
-    elif isinstance(id_filter, str):
-        return [id_filter] if id_filter in id_set else None
-    elif isinstance(id_filter, dict):
-        if '$in' in id_filter:
-            id_set.intersection(id_filter.pop('$in'))
-        return list(id_set)
-    else:
-        return []
+from sirius.query.planner import evaluate_edges, restrict_id_filter, combine_limits, bounded_id_set, intersect_id_filter_set
+from sirius.query.idset import IdSet
+from sirius.query.subtree_cache import cached_id_set
+from sirius.query.profiler import profiled, batch_reporter
+from sirius.query.budget import budget_checked, find_kwargs, command_kwargs
+from sirius.query.executor import parallel_map
 
 class GenomeQueryNode(object):
     def __init__(self, mongo_collection=None, qfilter=None, edges=None, edge_rule=0, arithmetics=None, limit=0, verbose=False):
@@ -33,183 +23,158 @@ class GenomeQueryNode(object):
         self.arithmetics = arithmetics if arithmetics is not None else []
         self.limit = int(limit)
         self.verbose = verbose
+        # set by QueryTree: key in the subtree_cache, the QueryExecutor for concurrent children, the QueryProfiler and QueryBudget
+        self.cache_key = None
+        self.executor = None
+        self.profiler = None
+        self.budget = None
 
-    def find(self, projection=None):
+    def find(self, projection=None, limit=0):
         """
         Find all nodes from self.mongo_collection, based on self.filter and the edge connected.
         Return a generator for MongoDB.find() query, or an empty list if none found
+
+        At most limit documents are returned in addition to self.limit, over all batches,
+        and no more batches are requested once enough documents are found.
         """
+        limit = combine_limits(self.limit, limit)
         if self.verbose:
             print(self.filter, self.edges, self.arithmetics)
 
         if not self.arithmetics:
             mongo_filter = copy.deepcopy(self.filter)
             if len(self.edges) > 0:
-                first_edgenode = self.edges[0]
-                result_id_set = first_edgenode.find_from_id()
-                if len(result_id_set) == 0 and self.edge_rule != 1:
+                # the edges only need to be evaluated for the ids allowed by the '_id' filter
+                result_id_set = evaluate_edges(self.edges, self.edge_rule, id_filter=bounded_id_set(mongo_filter), executor=self.executor)
+                if len(result_id_set) == 0:
                     return
-                for edgenode in self.edges[1:]:
-                    e_ids = edgenode.find_from_id()
-                    if self.edge_rule == 0: # AND
-                        result_id_set &= e_ids
-                        if len(result_id_set) == 0:
-                            return
-                    elif self.edge_rule == 1: # OR
-                        result_id_set |= e_ids
-                    elif self.edge_rule == 2: # NOT
-                        result_id_set -= e_ids
-                        if len(result_id_set) == 0:
-                            return
                 # merge the id_filter with the edge ids
-                id_filter = mongo_filter.pop('_id', None)
-                intersect_ids = intersect_id_filter_set(id_filter, result_id_set)
+                intersect_ids, mongo_filter = intersect_id_filter_set(mongo_filter, result_id_set)
                 if not intersect_ids:
                     return
                 elif len(intersect_ids) == 1:
-                    mongo_filter['_id'] = intersect_ids[0]
-                    yield self.mongo_collection.find_one(mongo_filter, projection=projection)
+                    doc = self.mongo_collection.find_one(restrict_id_filter(mongo_filter, intersect_ids), projection=projection, **find_kwargs(self.budget))
+                    if doc is not None:
+                        yield doc
                 else:
-                    batch_size = 100000
-                    for i_batch in range(int(len(intersect_ids) / batch_size)+1):
-                        batch_ids = intersect_ids[i_batch*batch_size:(i_batch+1)*batch_size]
-                        mongo_filter['_id'] = {"$in": batch_ids}
-                        for d in self.mongo_collection.find(mongo_filter, limit=self.limit, projection=projection, no_cursor_timeout=True):
-                            yield d
+                    yield from batched_lookup(self.mongo_collection, intersect_ids, mongo_filter=mongo_filter, limit=limit,
+                                              projection=projection, on_batch=batch_reporter(self), **find_kwargs(self.budget))
             else:
-                for d in self.mongo_collection.find(mongo_filter, limit=self.limit, projection=projection, no_cursor_timeout=True):
+                for d in self.mongo_collection.find(mongo_filter, limit=limit, projection=projection, **find_kwargs(self.budget)):
                     yield d
         else:
             t0 = time.time()
-            result_ids = list(self.findid())
+            result_ids = self.findid()
             t1 = time.time()
             if self.verbose:
                 print(f"Find id result {len(result_ids)} took {t1-t0:.2f} s")
             # Here result_ids may exceed the limit of BSON document size for MongoDB
             # Therefore we generate the documents by batches
-            batch_size = 100000
-            for i_batch in range(int(len(result_ids) / batch_size)+1):
-                batch_ids = result_ids[i_batch*batch_size:(i_batch+1)*batch_size]
-                query = {'_id' : {'$in': batch_ids}}
-                for d in self.mongo_collection.find(query, limit=self.limit, projection=projection, no_cursor_timeout=True):
-                    yield d
+            yield from batched_lookup(self.mongo_collection, result_ids, limit=limit,
+                                      projection=projection, on_batch=batch_reporter(self), **find_kwargs(self.budget))
 
-    def find_ids_without_arithmetics(self):
+    def find_ids_without_arithmetics(self, id_filter=None):
         mongo_filter = copy.deepcopy(self.filter)
         if len(self.edges) > 0:
-            first_edgenode = self.edges[0]
-            result_id_set = first_edgenode.find_from_id()
-            if len(result_id_set) == 0 and self.edge_rule != 1:
-                return set()
-            for edgenode in self.edges[1:]:
-                e_ids = edgenode.find_from_id()
-                if self.edge_rule == 0: # AND
-                    result_id_set &= e_ids
-                    if len(result_id_set) == 0:
-                        return set()
-                elif self.edge_rule == 1: # OR
-                    result_id_set |= e_ids
-                elif self.edge_rule == 2: # NOT
-                    result_id_set -= e_ids
-                    if len(result_id_set) == 0:
-                        return set()
-            # merge the id_filter with the edge ids
-            id_filter = mongo_filter.pop('_id', None)
-            intersect_ids = intersect_id_filter_set(id_filter, result_id_set)
+            # push the '_id' filter of this node down to the edges, with the id_filter of the parent
+            result_id_set = evaluate_edges(self.edges, self.edge_rule, id_filter=bounded_id_set(mongo_filter, id_filter), executor=self.executor)
+            if len(result_id_set) == 0:
+                return IdSet()
+            # merge the '_id' field of the filter with the edge ids
+            intersect_ids, mongo_filter = intersect_id_filter_set(mongo_filter, result_id_set)
             if not intersect_ids:
-                return set()
+                return IdSet()
             elif len(intersect_ids) == 1:
-                mongo_filter['_id'] = intersect_ids[0]
-                return set([self.mongo_collection.find_one(mongo_filter, projection=['_id'])['_id']])
+                return IdSet(d['_id'] for d in self.mongo_collection.find(restrict_id_filter(mongo_filter, intersect_ids), projection=['_id'], limit=1, **find_kwargs(self.budget)))
             else:
-                batch_size = 100000
-                result_ids = set()
-                for i_batch in range(int(len(intersect_ids) / batch_size)+1):
-                    batch_ids = intersect_ids[i_batch*batch_size:(i_batch+1)*batch_size]
-                    mongo_filter['_id'] = {"$in": batch_ids}
-                    for d in self.mongo_collection.find(mongo_filter, limit=self.limit, projection=['_id']):
-                        result_ids.add(d['_id'])
-                return result_ids
+                return IdSet(d['_id'] for d in batched_lookup(self.mongo_collection, intersect_ids, mongo_filter=mongo_filter, limit=self.limit,
+                                                              projection=['_id'], on_batch=batch_reporter(self), **find_kwargs(self.budget)))
         else:
-            return set(d['_id'] for d in self.mongo_collection.find(mongo_filter, projection=['_id'], limit=self.limit))
+            if id_filter is not None:
+                if len(id_filter) == 0:
+                    return IdSet()
+                mongo_filter = restrict_id_filter(mongo_filter, id_filter)
+            return IdSet(d['_id'] for d in self.mongo_collection.find(mongo_filter, projection=['_id'], limit=self.limit, **find_kwargs(self.budget)))
+
+    def count(self):
+        """
+        Count the results without fetching the documents.
+        Without edges or arithmetics MongoDB counts the filter, with index-only plans when the filter is covered by an index,
+        otherwise this is the size of the result id set, at most self.limit.
+        """
+        if not self.edges and not self.arithmetics:
+            kwargs = command_kwargs(self.budget)
+            if self.limit > 0:
+                kwargs['limit'] = self.limit
+            return self.mongo_collection.count_documents(self.filter, **kwargs)
+        n = len(self.findid())
+        return min(n, self.limit) if self.limit > 0 else n
 
     def distinct(self, key):
         """
         Find all distinct values for a key
         """
         if not self.edges and not self.arithmetics:
-            result = self.mongo_collection.distinct(key, self.filter, maxTimeMS=15000)
+            result = self.mongo_collection.distinct(key, self.filter, **command_kwargs(self.budget, 15000))
         else:
-            result_ids = list(self.findid())
-            batch_size = 100000
-            result = set()
-            for i_batch in range(int(len(result_ids) / batch_size)+1):
-                batch_ids = result_ids[i_batch*batch_size:(i_batch+1)*batch_size]
-                query = {'_id' : {'$in': batch_ids}}
-                result.update(self.mongo_collection.distinct(key, query))
+            result = batched_distinct(self.mongo_collection, key, self.findid(), on_batch=batch_reporter(self), **command_kwargs(self.budget))
         return list(result)
 
 
-    def findid(self):
+    @profiled
+    @budget_checked
+    @cached_id_set
+    def findid(self, id_filter=None):
         """
         Find all nodes from self.mongo_collection, based on self.filter and the edge connected
-        Return a set that contain strings of node['_id']
+        Return an IdSet that contain strings of node['_id']
+
+        If id_filter is provided, the result is restricted to ids in id_filter
         """
         # get the results for all edges
-        #t0 = time.time()
-        result_ids = self.find_ids_without_arithmetics()
-        #t1 = time.time()
-        #print(f'find_ids_without_arithmetics returns {len(result_ids)} data in {t1-t0:.3f} s')
+        result_ids = self.find_ids_without_arithmetics(id_filter=id_filter)
         if not self.arithmetics:
             return result_ids
-        # Use the bedtools to do arithmics
+        # Use the in-memory ArrayBed to do arithmics
         # do the arithmetics one by one
         for ar in self.arithmetics:
             operator = ar['operator']
             if operator == 'union':
-                for target in ar['targets']:
-                    result_ids |= target.findid()
-            elif operator == 'window':
-                if len(result_ids) == 0:
-                    continue
-                bed = self.load_ids_to_bed(result_ids)
+                for target_ids in parallel_map(self.executor, lambda t: t.findid(), ar['targets']):
+                    result_ids |= target_ids
+                continue
+            if len(result_ids) == 0:
+                continue
+            # load the current results and the targets concurrently, they are independent of each other
+            loaders = [lambda: self.load_ids_to_bed(result_ids)] + [target.convert_results_to_Bed for target in ar['targets']]
+            beds = parallel_map(self.executor, lambda load: load(), loaders)
+            bed, target_beds = beds[0], beds[1:]
+            if operator == 'window':
                 window_size = ar['windowSize']
-                for target in ar['targets']:
-                    target_bed = target.convert_results_to_Bed()
+                for target_bed in target_beds:
                     bed = bed.window(target_bed, window=window_size)
-                result_ids = bed.gids()
             elif operator == 'intersect':
-                if len(result_ids) == 0:
-                    continue
-                bed = self.load_ids_to_bed(result_ids)
-                for target in ar['targets']:
-                    target_bed = target.convert_results_to_Bed()
+                for target_bed in target_beds:
                     bed = bed.intersect(target_bed)
-                result_ids = bed.gids()
             elif operator == 'diff':
-                if len(result_ids) == 0:
-                    continue
-                for target in ar['targets']:
-                    bed = self.load_ids_to_bed(result_ids)
-                    target_bed = target.convert_results_to_Bed()
-                    intersect_bed = bed.intersect(target_bed)
-                    intersect_bed_ids = intersect_bed.gids()
-                    result_ids -= intersect_bed_ids
-                    if len(result_ids) == 0:
-                        continue
+                for target_bed in target_beds:
+                    bed = bed.diff(target_bed)
+            result_ids = bed.gids()
+        if id_filter is not None:
+            result_ids &= id_filter
         return result_ids
 
     def convert_results_to_Bed(self):
-        """ Convert the results of GenomeQuery to a Bed object """
-        projection=['_id', 'contig', 'start', 'end', 'info.score', 'info.strand']
+        """ Convert the results of GenomeQuery to an ArrayBed object """
+        projection=['_id', 'contig', 'start', 'end']
         gen = self.find(projection=projection)
-        return Bed(gen)
+        return ArrayBed(gen)
 
     def load_ids_to_bed(self, result_ids):
-        """ Read information of a set of ids, and load them in to a Bed object """
-        projection=['_id', 'contig', 'start', 'end', 'info.score', 'info.strand']
-        gen = doc_generator(self.mongo_collection, result_ids, projection=projection)
-        return Bed(gen)
+        """ Read information of a set of ids, and load them in to an ArrayBed object """
+        projection=['_id', 'contig', 'start', 'end']
+        gen = doc_generator(self.mongo_collection, result_ids, projection=projection, on_batch=batch_reporter(self), **find_kwargs(self.budget))
+        return ArrayBed(gen)
 
     def export(self, filename, ftype, sort=False):
         if ftype == 'bed':
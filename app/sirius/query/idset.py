@@ -0,0 +1,211 @@
+"""
+Compact integer-encoded id sets for intermediate query results.
+
+The '_id' of our documents are long strings, a Python set of millions of them costs gigabytes.
+The IdDictionary maps each '_id' string to a dense integer once per process, and the IdSet stores
+a set of ids as a sorted numpy array of uint32 codes, so the intermediate results of the query nodes
+cost 4 bytes per id, and the and/or/not operations become vectorized merges of sorted arrays.
+The codes are only converted back to strings when the ids are sent to MongoDB.
+
+The dictionary only grows, so once it holds ID_DICTIONARY_MAX_IDS ids, new IdSets use a new dictionary.
+Each IdSet keeps a reference to the dictionary of its codes, so an old dictionary is freed when its last IdSet is,
+and the operations between IdSets of two dictionaries convert them to the current one.
+"""
+
+import os
+import threading
+import numpy as np
+
+# the number of ids after which a new dictionary is started
+ID_DICTIONARY_MAX_IDS = int(os.environ.get('SIRIUS_ID_DICTIONARY_MAX_IDS', 20000000))
+
+class IdDictionary:
+    """
+    Thread-safe, append-only mapping between '_id' strings and dense integer codes.
+
+    Attributes
+    ----------
+    codes: dict
+        Mapping from '_id' string to its integer code
+
+    ids: list
+        The '_id' strings, indexed by their codes
+
+    """
+    def __init__(self):
+        self.codes = dict()
+        self.ids = []
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _add(self, s):
+        with self.lock:
+            # another thread may have added it while we were waiting
+            code = self.codes.get(s)
+            if code is None:
+                code = len(self.ids)
+                self.ids.append(s)
+                self.codes[s] = code
+        return code
+
+    def encode(self, ids):
+        """ Convert an iterable of '_id' strings into an array of codes, new strings are added to the dictionary """
+        get = self.codes.get
+        result = []
+        for s in ids:
+            code = get(s)
+            if code is None:
+                code = self._add(s)
+            result.append(code)
+        return np.array(result, dtype=np.uint32)
+
+    def lookup(self, s):
+        """ Return the code of an '_id' string, or None if it was never encoded """
+        return self.codes.get(s)
+
+    def decode(self, codes):
+        """ Convert an array of codes back into a list of '_id' strings """
+        ids = self.ids
+        return [ids[c] for c in codes.tolist()]
+
+# the dictionary of the new IdSets, shared by all queries in this process
+_current_dictionary = IdDictionary()
+_current_dictionary_lock = threading.Lock()
+
+def current_dictionary():
+    """ Return the dictionary of the new IdSets, start a new one if it is full """
+    global _current_dictionary
+    dictionary = _current_dictionary
+    if len(dictionary) >= ID_DICTIONARY_MAX_IDS:
+        with _current_dictionary_lock:
+            if _current_dictionary is dictionary:
+                _current_dictionary = IdDictionary()
+            dictionary = _current_dictionary
+    return dictionary
+
+class DecodedView:
+    """ Read-only sequence of '_id' strings over an array of codes of dictionary, decoded on access, useful for bisect """
+    def __init__(self, codes, dictionary):
+        self.codes = codes
+        self.dictionary = dictionary
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return self.dictionary.decode(self.codes[i])
+        return self.dictionary.ids[self.codes[i]]
+
+class IdSet:
+    """
+    A set of '_id' strings, stored as a sorted array of unique uint32 codes of an IdDictionary.
+
+    It supports the subset of the set interface used by the query nodes: len(), iteration over the '_id' strings,
+    'in', and the &, |, - operators (and their in-place versions) with other IdSets or any iterable of '_id' strings.
+    """
+    __slots__ = ('codes', 'dictionary')
+
+    def __init__(self, ids=None, dictionary=None):
+        if isinstance(ids, IdSet):
+            self.codes = ids.codes
+            self.dictionary = ids.dictionary
+            return
+        self.dictionary = current_dictionary() if dictionary is None else dictionary
+        if ids is None:
+            self.codes = np.empty(0, dtype=np.uint32)
+        else:
+            self.codes = np.unique(self.dictionary.encode(ids))
+
+    @classmethod
+    def from_codes(cls, codes, dictionary):
+        """ Create an IdSet from an array of codes of dictionary that is already sorted and unique """
+        result = cls(dictionary=dictionary)
+        result.codes = codes
+        return result
+
+    def codes_in(self, dictionary, add=True):
+        """
+        Return the sorted codes of the ids in another dictionary.
+        With add=False, the ids that are not in dictionary are left out instead of added.
+        """
+        if dictionary is self.dictionary:
+            return self.codes
+        ids = self.dictionary.decode(self.codes)
+        if add:
+            return np.unique(dictionary.encode(ids))
+        codes = [code for code in map(dictionary.lookup, ids) if code is not None]
+        return np.unique(np.array(codes, dtype=np.uint32))
+
+    def _aligned(self, other):
+        """ Return (dictionary, codes of self, codes of other) with the codes of both in the same dictionary """
+        other = as_idset(other, self.dictionary)
+        if other.dictionary is self.dictionary:
+            return self.dictionary, self.codes, other.codes
+        dictionary = current_dictionary()
+        return dictionary, self.codes_in(dictionary), other.codes_in(dictionary)
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __bool__(self):
+        return len(self.codes) > 0
+
+    def __iter__(self):
+        return iter(self.dictionary.decode(self.codes))
+
+    def __contains__(self, s):
+        code = self.dictionary.lookup(s)
+        if code is None:
+            return False
+        i = np.searchsorted(self.codes, code)
+        return i < len(self.codes) and self.codes[i] == code
+
+    def __eq__(self, other):
+        _, codes, other_codes = self._aligned(other)
+        return np.array_equal(codes, other_codes)
+
+    def __repr__(self):
+        return f'IdSet({len(self)} ids)'
+
+    def __and__(self, other):
+        dictionary, codes, other_codes = self._aligned(other)
+        return IdSet.from_codes(np.intersect1d(codes, other_codes, assume_unique=True), dictionary)
+
+    def __or__(self, other):
+        dictionary, codes, other_codes = self._aligned(other)
+        return IdSet.from_codes(np.union1d(codes, other_codes).astype(np.uint32), dictionary)
+
+    def __sub__(self, other):
+        dictionary, codes, other_codes = self._aligned(other)
+        return IdSet.from_codes(np.setdiff1d(codes, other_codes, assume_unique=True), dictionary)
+
+    # the arrays are immutable in practice, so the in-place operators just rebind self.codes
+    def _assign(self, result):
+        self.codes = result.codes
+        self.dictionary = result.dictionary
+        return self
+
+    def __iand__(self, other):
+        return self._assign(self & other)
+
+    def __ior__(self, other):
+        return self._assign(self | other)
+
+    def __isub__(self, other):
+        return self._assign(self - other)
+
+    def intersection(self, other):
+        return self & other
+
+    def union(self, other):
+        return self | other
+
+    def difference(self, other):
+        return self - other
+
+def as_idset(ids, dictionary=None):
+    """ Convert an iterable of '_id' strings into an IdSet of dictionary (by default the current one), IdSets are returned as is """
+    return ids if isinstance(ids, IdSet) else IdSet(ids, dictionary)
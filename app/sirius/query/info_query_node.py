@@ -1,21 +1,10 @@
 import copy
 from sirius.mongo import InfoNodes
-
-def intersect_id_filter_set(id_filter, id_set):
-    """ Intersect the '_id' field of a mongo filter with a set of ids """
-    assert isinstance(id_set, set)
-    if not id_set:
-        return []
-    elif id_filter is None:
-        return list(id_set)
-    elif isinstance(id_filter, str):
-        return [id_filter] if id_filter in id_set else None
-    elif isinstance(id_filter, dict):
-        if '$in' in id_filter:
-            id_set.intersection(id_filter.pop('$in'))
-        return list(id_set)
-    else:
-        return []
+from sirius.query.planner import evaluate_edges, restrict_id_filter, combine_limits, bounded_id_set, intersect_id_filter_set
+from sirius.query.idset import IdSet
+from sirius.query.subtree_cache import cached_id_set
+from sirius.query.profiler import profiled
+from sirius.query.budget import budget_checked, find_kwargs, command_kwargs
 
 class InfoQueryNode(object):
     def __init__(self, mongo_collection=None, qfilter=None, edges=None, edge_rule=None, limit=0, verbose=False):
@@ -26,84 +15,80 @@ class InfoQueryNode(object):
         self.edge_rule = 0 if edge_rule == None else edge_rule
         self.limit = int(limit)
         self.verbose = verbose
+        # set by QueryTree: key in the subtree_cache, the QueryExecutor for concurrent children, the QueryProfiler and QueryBudget
+        self.cache_key = None
+        self.executor = None
+        self.profiler = None
+        self.budget = None
 
-    def find(self, projection=None):
+    def find(self, projection=None, limit=0):
         """
         Find all nodes from self.mongo_collection, based on self.filter and the edge connected.
         Return a cursor of MongoDB.find() query, or an empty list if none found
+        At most limit documents are returned in addition to self.limit
         """
         mongo_filter = copy.deepcopy(self.filter)
         if len(self.edges) > 0:
-            first_edgenode = self.edges[0]
-            result_id_set = first_edgenode.find_from_id()
-            if len(result_id_set) == 0 and self.edge_rule != 1:
-                return []
-            for edgenode in self.edges[1:]:
-                e_ids = edgenode.find_from_id()
-                if self.edge_rule == 0: # AND
-                    result_id_set &= e_ids
-                    if len(result_id_set) == 0: return []
-                elif self.edge_rule == 1: # OR
-                    result_id_set |= e_ids
-                elif self.edge_rule == 2: # NOT
-                    result_id_set -= e_ids
-                    if len(result_id_set) == 0: return []
+            # the edges only need to be evaluated for the ids allowed by the '_id' filter
+            result_id_set = evaluate_edges(self.edges, self.edge_rule, id_filter=bounded_id_set(mongo_filter), executor=self.executor)
             if len(result_id_set) == 0: return []
             # intersect the ids from edges with the ids from filter
-            id_filter = mongo_filter.pop('_id', None)
-            intersect_ids = intersect_id_filter_set(id_filter, result_id_set)
+            intersect_ids, mongo_filter = intersect_id_filter_set(mongo_filter, result_id_set)
             if not intersect_ids:
                 return []
-            elif len(intersect_ids) == 1:
-                mongo_filter['_id'] = intersect_ids[0]
-            else:
-                mongo_filter['_id'] = {"$in": intersect_ids}
+            mongo_filter = restrict_id_filter(mongo_filter, intersect_ids)
         if self.verbose == True:
             print(mongo_filter)
-        return self.mongo_collection.find(mongo_filter, limit=self.limit, projection=projection, no_cursor_timeout=True)
+        return self.mongo_collection.find(mongo_filter, limit=combine_limits(self.limit, limit), projection=projection, **find_kwargs(self.budget))
 
     def distinct(self, key):
         if not self.edges:
-            result = self.mongo_collection.distinct(key, self.filter, maxTimeMS=15000)
+            result = self.mongo_collection.distinct(key, self.filter, **command_kwargs(self.budget, 15000))
         else:
             result = self.find().distinct(key)
         return result
 
-    def findid(self):
+    def count(self):
+        """
+        Count the results without fetching the documents.
+        Without edges MongoDB counts the filter, with index-only plans when the filter is covered by an index,
+        otherwise this is the size of the result id set.
+        """
+        if not self.edges:
+            kwargs = command_kwargs(self.budget)
+            if self.limit > 0:
+                kwargs['limit'] = self.limit
+            return self.mongo_collection.count_documents(self.filter, **kwargs)
+        return len(self.findid())
+
+    @profiled
+    @budget_checked
+    @cached_id_set
+    def findid(self, id_filter=None):
         """
         Find all nodes from self.mongo_collection, based on self.filter and the edge connected
-        Return a set that contain strings of node['_id']
+        Return an IdSet that contain strings of node['_id']
+
+        If id_filter is provided, the result is restricted to ids in id_filter
         """
         mongo_filter = self.filter.copy()
         if len(self.edges) > 0:
-            first_edgenode = self.edges[0]
-            result_ids = first_edgenode.find_from_id()
-            if len(result_ids) == 0 and self.edge_rule != 1:
-                return set()
-            for edgenode in self.edges[1:]:
-                e_ids = edgenode.find_from_id()
-                if self.edge_rule == 0: # AND
-                    result_ids &= e_ids
-                    if len(result_ids) == 0:
-                        return set()
-                elif self.edge_rule == 1: # OR
-                    result_ids |= e_ids
-                elif self.edge_rule == 2: # NOT
-                    result_ids -= e_ids
-                    if len(result_ids) == 0:
-                        return set()
+            # push the '_id' filter of this node down to the edges, with the id_filter of the parent
+            result_ids = evaluate_edges(self.edges, self.edge_rule, id_filter=bounded_id_set(mongo_filter, id_filter), executor=self.executor)
+            if len(result_ids) == 0:
+                return IdSet()
             # intersect the ids from edges with the ids from filter
-            id_filter = mongo_filter.pop('_id', None)
-            intersect_ids = intersect_id_filter_set(id_filter, result_ids)
+            intersect_ids, mongo_filter = intersect_id_filter_set(mongo_filter, result_ids)
             if not intersect_ids:
-                return set()
-            elif len(intersect_ids) == 1:
-                mongo_filter['_id'] = intersect_ids[0]
-            else:
-                mongo_filter['_id'] = {"$in": intersect_ids}
+                return IdSet()
+            mongo_filter = restrict_id_filter(mongo_filter, intersect_ids)
+        elif id_filter is not None:
+            if len(id_filter) == 0:
+                return IdSet()
+            mongo_filter = restrict_id_filter(mongo_filter, id_filter)
         if self.verbose == True:
             print(mongo_filter)
-        return set(d['_id'] for d in self.mongo_collection.find(mongo_filter, {'_id':1}, limit=self.limit))
+        return IdSet(d['_id'] for d in self.mongo_collection.find(mongo_filter, {'_id':1}, limit=self.limit, **find_kwargs(self.budget)))
 
     def export(self, filename, ftype):
         raise NotImplementedError("Exporting InfoQuery is not implemented yet.")
\ No newline at end of file
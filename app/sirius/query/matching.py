@@ -0,0 +1,121 @@
+"""
+In-memory evaluation of MongoDB filters.
+
+Cached query results and the edge index answer queries without MongoDB, they use match_filter() and match_condition()
+to evaluate filters with the same semantics, including the matching of array fields by their elements.
+The filters should be in the MongoDB form given by QueryTree.build_filter().
+"""
+
+# the operators of field conditions that match_condition() evaluates
+SUPPORTED_OPERATORS = {'$eq', '$ne', '$gt', '$gte', '$lt', '$lte', '$in', '$nin', '$exists'}
+
+class UnsupportedFilter(Exception):
+    """ Raised when a filter can not be evaluated in memory, the query should go to MongoDB instead """
+    pass
+
+_missing = object()
+
+def get_path(doc, path, defaults=None):
+    """ Get the value of a dotted path in a document, or _missing """
+    value = doc
+    for key in path.split('.'):
+        if isinstance(value, dict) and key in value:
+            value = value[key]
+        else:
+            value = _missing
+            break
+    if value is _missing and defaults is not None:
+        value = defaults.get(path, _missing)
+    return value
+
+def _candidates(value):
+    """ MongoDB compares an array field by each of its elements, and by the whole array, and a missing field as null """
+    if value is _missing:
+        return [None]
+    if isinstance(value, list):
+        return value + [value]
+    return [value]
+
+def _equal(value, target):
+    """ MongoDB equality, booleans are never equal to numbers """
+    if isinstance(value, bool) != isinstance(target, bool):
+        return False
+    return value == target
+
+def _compare(value, op, target):
+    if value is None and target is None:
+        # null is only equal to itself
+        return op in ('$gte', '$lte')
+    if isinstance(value, bool) != isinstance(target, bool):
+        # MongoDB only compares values of the same type
+        return False
+    try:
+        if op == '$gt': return value > target
+        if op == '$gte': return value >= target
+        if op == '$lt': return value < target
+        if op == '$lte': return value <= target
+    except TypeError:
+        return False
+
+def _is_in(value, targets):
+    return any(_equal(value, t) for t in targets)
+
+def match_condition(value, condition):
+    """ Match the value of a field with the condition of the field in a filter, value is _missing for a missing field """
+    if not isinstance(condition, dict) or not any(k.startswith('$') for k in condition):
+        # equality with a value
+        return any(_equal(v, condition) for v in _candidates(value))
+    for op, target in condition.items():
+        if op == '$eq':
+            matched = any(_equal(v, target) for v in _candidates(value))
+        elif op == '$ne':
+            matched = not any(_equal(v, target) for v in _candidates(value))
+        elif op in ('$gt', '$gte', '$lt', '$lte'):
+            matched = any(_compare(v, op, target) for v in _candidates(value))
+        elif op == '$in':
+            matched = any(_is_in(v, target) for v in _candidates(value) if not isinstance(v, list))
+        elif op == '$nin':
+            matched = not any(_is_in(v, target) for v in _candidates(value) if not isinstance(v, list))
+        elif op == '$exists':
+            matched = (value is not _missing) == bool(target)
+        else:
+            raise UnsupportedFilter(f"Operator {op} is not supported in memory")
+        if not matched:
+            return False
+    return True
+
+def match_filter(doc, mongo_filter, defaults=None):
+    """
+    Return True if doc matches mongo_filter, for the operators $eq, $ne, $gt, $gte, $lt, $lte, $in, $nin, $exists, $and, $or.
+    Other operators like $text and $regex raise UnsupportedFilter.
+    defaults gives the values of fields that are not stored in doc, like the contig of the per-contig track caches.
+    """
+    for key, condition in mongo_filter.items():
+        if key == '$and':
+            if not all(match_filter(doc, f, defaults) for f in condition):
+                return False
+        elif key == '$or':
+            if not any(match_filter(doc, f, defaults) for f in condition):
+                return False
+        elif key.startswith('$'):
+            raise UnsupportedFilter(f"Operator {key} is not supported in memory")
+        elif not match_condition(get_path(doc, key, defaults), condition):
+            return False
+    return True
+
+def filter_fields(mongo_filter):
+    """ Return the set of fields used by a filter, raise UnsupportedFilter if match_filter() can not evaluate it """
+    result = set()
+    for key, condition in mongo_filter.items():
+        if key in ('$and', '$or'):
+            for f in condition:
+                result |= filter_fields(f)
+        elif key.startswith('$'):
+            raise UnsupportedFilter(f"Operator {key} is not supported in memory")
+        else:
+            if isinstance(condition, dict) and any(k.startswith('$') for k in condition):
+                for op in condition:
+                    if op not in SUPPORTED_OPERATORS:
+                        raise UnsupportedFilter(f"Operator {op} is not supported in memory")
+            result.add(key)
+    return result
@@ -0,0 +1,172 @@
+"""
+Compile a QueryTree into a single MongoDB aggregation pipeline.
+
+Each edge of a node becomes a $lookup into the Edges collection, and each next node of an edge becomes a
+nested $lookup into its collection, so the whole GenomeNode -> EdgeNode -> InfoNode chain is evaluated
+server-side, without pulling intermediate id sets into Python.
+The edge rules are translated into a $match on the sizes of the looked-up arrays.
+
+Limitations
+-----------
+Genome arithmetics are not supported, and $text filters are only allowed on the head node,
+since $text has to be the first stage of the top-level pipeline.
+All collections have to live in the same database, so user files can not be joined.
+The limit is only applied on the head node, the limits of the inner nodes are not needed
+since no intermediate id sets are built.
+"""
+
+from sirius.query.planner import count_with_cap, combine_limits, remaining_limit
+from sirius.query.budget import command_kwargs
+
+# the pipeline runs the $lookup stages once for every document matching the head filter,
+# if there are more of them, evaluating the edges first in Python is cheaper
+PIPELINE_MAX_SCAN = 100000
+
+def can_compile(node, is_head=True, database_name=None):
+    """ Check if a query node and all its children can be compiled into an aggregation pipeline """
+    if database_name is None:
+        database_name = node.mongo_collection.database.name
+    elif node.mongo_collection.database.name != database_name:
+        return False
+    if not is_head and '$text' in node.filter:
+        return False
+    if hasattr(node, 'nextnode'):
+        return node.nextnode is None or can_compile(node.nextnode, is_head=False, database_name=database_name)
+    if getattr(node, 'arithmetics', None):
+        return False
+    return all(can_compile(e, is_head=False, database_name=database_name) for e in node.edges)
+
+def should_use_pipeline(node):
+    """ Decide if the aggregation pipeline is the better backend for a query node """
+    if not getattr(node, 'edges', None) or not can_compile(node):
+        return False
+    return count_with_cap(node.mongo_collection, node.filter, PIPELINE_MAX_SCAN + 1) <= PIPELINE_MAX_SCAN
+
+def edge_rule_match(edge_fields, edge_rule):
+    """ Build the $match condition that combines the looked-up edge arrays with the edge rule """
+    if edge_rule == 0: # AND
+        return {f: {'$ne': []} for f in edge_fields}
+    elif edge_rule == 1: # OR
+        return {'$or': [{f: {'$ne': []}} for f in edge_fields]}
+    elif edge_rule == 2: # NOT
+        match = {edge_fields[0]: {'$ne': []}}
+        for f in edge_fields[1:]:
+            match[f] = {'$size': 0}
+        return match
+    else:
+        raise ValueError(f"Invalid edge_rule {edge_rule}")
+
+def build_edge_lookups(node, depth):
+    """ Build the $lookup stages for the edges of a node, and the $match stage for its edge rule """
+    if not node.edges:
+        return [], []
+    var = f'nid{depth}'
+    stages, edge_fields = [], []
+    for i, edge in enumerate(node.edges):
+        field = f'_e{depth}_{i}'
+        stages.append({'$lookup': {
+            'from': edge.mongo_collection.name,
+            'let': {var: '$_id'},
+            'pipeline': build_edge_pipeline(edge, '$$' + var, depth + 1),
+            'as': field
+        }})
+        edge_fields.append(field)
+    stages.append({'$match': edge_rule_match(edge_fields, node.edge_rule)})
+    return stages, edge_fields
+
+def build_node_pipeline(node, id_var, depth):
+    """ Build the pipeline of a node that is looked up by its '_id' """
+    match = {'$expr': {'$eq': ['$_id', id_var]}}
+    if node.filter:
+        match = {'$and': [node.filter, match]}
+    stages = [{'$match': match}]
+    stages += build_edge_lookups(node, depth)[0]
+    stages += [{'$limit': 1}, {'$project': {'_id': 1}}]
+    return stages
+
+def build_edge_pipeline(edge, from_var, depth):
+    """ Build the pipeline of an edge that is looked up by the '_id' of its parent node """
+    from_id_key, to_id_key = 'from_id', 'to_id'
+    if edge.reverse:
+        from_id_key, to_id_key = to_id_key, from_id_key
+    match = {'$expr': {'$eq': ['$' + from_id_key, from_var]}}
+    if edge.filter:
+        match = {'$and': [edge.filter, match]}
+    stages = [{'$match': match}]
+    if edge.nextnode is not None:
+        var = f'tid{depth}'
+        stages.append({'$lookup': {
+            'from': edge.nextnode.mongo_collection.name,
+            'let': {var: '$' + to_id_key},
+            'pipeline': build_node_pipeline(edge.nextnode, '$$' + var, depth + 1),
+            'as': '_n'
+        }})
+        stages.append({'$match': {'_n': {'$ne': []}}})
+    stages += [{'$limit': 1}, {'$project': {'_id': 1}}]
+    return stages
+
+def compile_pipeline(node, projection=None, start_after=None, sort_by_id=False, limit=0, offset=0):
+    """
+    Compile a query node into an aggregation pipeline on node.mongo_collection
+
+    Parameters
+    ----------
+    node: GenomeQueryNode or InfoQueryNode
+        The head node of a QueryTree, can_compile(node) should be True
+    projection: list, optional
+        The fields to return, same as in Collection.find()
+    start_after: string, optional
+        Only return documents with '_id' greater than this, for keyset pagination
+    sort_by_id: bool, default False
+        Return the documents ordered by '_id'
+    limit: int, default 0
+        Return at most this many documents, in addition to node.limit
+    offset: int, default 0
+        The number of results up to start_after, which count toward node.limit, should be less than node.limit
+
+    Returns
+    -------
+    pipeline: list
+        The stages of the aggregation pipeline
+    """
+    pipeline = []
+    head_match = node.filter
+    if start_after is not None:
+        after_match = {'_id': {'$gt': start_after}}
+        head_match = {'$and': [head_match, after_match]} if head_match else after_match
+    if head_match:
+        pipeline.append({'$match': head_match})
+    if sort_by_id:
+        pipeline.append({'$sort': {'_id': 1}})
+    lookup_stages, edge_fields = build_edge_lookups(node, 0)
+    pipeline += lookup_stages
+    limit = combine_limits(remaining_limit(node.limit, offset), limit)
+    if limit > 0:
+        pipeline.append({'$limit': limit})
+    if projection is not None:
+        pipeline.append({'$project': {f: 1 for f in projection}})
+    elif edge_fields:
+        pipeline.append({'$project': {f: 0 for f in edge_fields}})
+    return pipeline
+
+def find_with_pipeline(node, projection=None, **kwargs):
+    """ Run the compiled pipeline of a query node, return a cursor like Collection.find() """
+    pipeline = compile_pipeline(node, projection=projection, **kwargs)
+    if node.verbose:
+        print(pipeline)
+    return node.mongo_collection.aggregate(pipeline, allowDiskUse=True, **command_kwargs(node.budget))
+
+def count_with_pipeline(node):
+    """ Count the results of a query node with its compiled pipeline, without fetching the documents """
+    pipeline = compile_pipeline(node, projection=['_id']) + [{'$count': 'n'}]
+    for d in node.mongo_collection.aggregate(pipeline, allowDiskUse=True, **command_kwargs(node.budget)):
+        return d['n']
+    return 0
+
+def distinct_with_pipeline(node, key):
+    """ Find the distinct values of key in the results of a query node, with a $group stage after its compiled pipeline """
+    pipeline = compile_pipeline(node, projection=[key]) + [
+        {'$unwind': '$' + key},
+        {'$group': {'_id': '$' + key}},
+    ]
+    return [d['_id'] for d in node.mongo_collection.aggregate(pipeline, allowDiskUse=True, **command_kwargs(node.budget))]
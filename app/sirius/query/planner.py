@@ -0,0 +1,286 @@
+"""
+Cost-based planning for the edges of a query node.
+
+The edges of a GenomeQueryNode or InfoQueryNode are combined by an edge rule (0 "and", 1 "or", 2 "not").
+Instead of evaluating them in list order, we estimate the cardinality of each edge first, run the most
+selective one, and feed its id set into the remaining edges as a semi-join filter on 'from_id', so the
+other edges only scan the edges connected to nodes that can still be in the result.
+The '_id' condition of the node itself, and the id_filter given by its parent, are pushed down the same way.
+For "not", the excluded edges are evaluated as anti-joins against the ids of the first edge, see anti_join().
+"""
+
+import numpy as np
+from pymongo.errors import ExecutionTimeout, OperationFailure
+from sirius.query.idset import IdSet, as_idset
+from sirius.query.matching import match_condition, UnsupportedFilter
+from sirius.mongo.utils import in_filter
+from sirius.query.executor import parallel_map
+
+# time cap for each count_documents() call used for estimation
+ESTIMATE_TIME_MS = 200
+# the next node of an edge is probed for its ids if it has no more results than this, and no edges or arithmetics
+ESTIMATE_PROBE_IDS = 1000
+# number of documents sampled to estimate counts that are too slow to compute
+ESTIMATE_SAMPLE_SIZE = 10000
+# id sets larger than this are not pushed down as semi-join filters, since they won't fit one $in batch
+SEMIJOIN_MAX_IDS = 100000
+# number of excluded ids streamed into the anti-join bitmap at once
+ANTIJOIN_CHUNK_IDS = 100000
+
+def count_with_cap(mongo_collection, mongo_filter, limit=0):
+    """ Count documents matching mongo_filter, return float('inf') if the count takes longer than ESTIMATE_TIME_MS """
+    if not mongo_filter:
+        # use the collection metadata instead of scanning
+        n = mongo_collection.estimated_document_count()
+        return min(n, limit) if limit > 0 else n
+    kwargs = {'maxTimeMS': ESTIMATE_TIME_MS}
+    if limit > 0:
+        kwargs['limit'] = limit
+    try:
+        return mongo_collection.count_documents(mongo_filter, **kwargs)
+    except ExecutionTimeout:
+        return limit if limit > 0 else float('inf')
+
+def is_probe_cheap(node):
+    """ Return True if the ids of node come from its own filter only, without evaluating edges or arithmetics """
+    return not node.edges and not getattr(node, 'arithmetics', None)
+
+def probe_ids(node):
+    """
+    Fetch at most ESTIMATE_PROBE_IDS ids of a node without edges or arithmetics, in ESTIMATE_TIME_MS like the counts.
+    Return None if that takes longer.
+    """
+    limit = combine_limits(node.limit, ESTIMATE_PROBE_IDS)
+    try:
+        return [d['_id'] for d in node.mongo_collection.find(node.filter, projection=['_id'], limit=limit, max_time_ms=ESTIMATE_TIME_MS)]
+    except ExecutionTimeout:
+        return None
+
+def estimate_cardinality(node):
+    """
+    Estimate the number of results of a query node or edge, without fetching the results.
+
+    For a QueryEdge, the count of edges matching its own filter is an upper bound of its from_id set.
+    If the next node is small enough, the edges are also restricted to the next node's ids.
+    The ids are only fetched from a next node without edges or arithmetics, so the probe is one capped find() of its filter,
+    the estimate of a larger subtree is not worth evaluating the subtree in full.
+    For a GenomeQueryNode or InfoQueryNode, the count of its filter is combined with the estimates of its edges.
+    """
+    if hasattr(node, 'nextnode'):
+        n = count_with_cap(node.mongo_collection, node.filter, node.limit)
+        if node.nextnode is not None:
+            n_next = estimate_cardinality(node.nextnode)
+            if n_next == 0:
+                return 0
+            next_ids = probe_ids(node.nextnode) if n_next <= ESTIMATE_PROBE_IDS and is_probe_cheap(node.nextnode) else None
+            if next_ids is not None:
+                to_id_key = 'from_id' if node.reverse else 'to_id'
+                probe_filter = node.filter.copy()
+                probe_filter[to_id_key] = {'$in': next_ids}
+                n = min(n, count_with_cap(node.mongo_collection, probe_filter, node.limit))
+        return n
+    n = count_with_cap(node.mongo_collection, node.filter, node.limit)
+    if getattr(node, 'arithmetics', None):
+        # union could add results, we don't try to estimate that
+        return float('inf')
+    if node.edges:
+        edge_estimates = [estimate_cardinality(e) for e in node.edges]
+        if node.edge_rule == 0:
+            n = min(n, min(edge_estimates))
+        elif node.edge_rule == 1:
+            n = min(n, sum(edge_estimates))
+        elif node.edge_rule == 2:
+            n = min(n, edge_estimates[0])
+    return n
+
+def sample_count(mongo_collection, mongo_filter, limit=0, sample_size=ESTIMATE_SAMPLE_SIZE):
+    """
+    Estimate the number of documents matching mongo_filter from a random sample of the collection,
+    scaled to the number of documents in the collection metadata.
+    Filters that can not be used after $sample, like $text, give the collection size as an upper bound.
+    """
+    n_total = mongo_collection.estimated_document_count()
+    n = n_total
+    if mongo_filter and n_total > 0:
+        pipeline = [{'$sample': {'size': sample_size}}, {'$match': mongo_filter}, {'$count': 'n'}]
+        try:
+            n_match = next(iter(mongo_collection.aggregate(pipeline, maxTimeMS=ESTIMATE_TIME_MS * 10)), {'n': 0})['n']
+            n = round(n_total * n_match / min(sample_size, n_total))
+        except (ExecutionTimeout, OperationFailure):
+            pass
+    return min(n, limit) if limit > 0 else n
+
+def estimate_count(node):
+    """
+    Fast estimate of the number of results of a query node, for the count endpoint.
+    This is the estimate_cardinality() used for planning, which is exact for nodes without edges,
+    and an upper bound otherwise. If that is unknown, the filter of the node is estimated by sampling.
+    """
+    n = estimate_cardinality(node)
+    if n == float('inf'):
+        n = sample_count(node.mongo_collection, node.filter, node.limit)
+    return n
+
+def evaluate_edges(edges, edge_rule, id_filter=None, executor=None):
+    """
+    Evaluate a list of QueryEdges and combine their from_id sets with edge_rule.
+
+    Parameters
+    ----------
+    edges: list
+        List of QueryEdge objects, should not be empty
+    edge_rule: int
+        0 means "and", 1 means "or", 2 means "not"
+    id_filter: IdSet or set, optional
+        If provided, the result is restricted to ids in this set, which is pushed down to the edges
+    executor: QueryExecutor, optional
+        If provided, the independent edges are evaluated concurrently
+
+    Returns
+    -------
+    result_ids: IdSet
+        The combined set of ids
+
+    Notes
+    -----
+    For "and", the edges are sorted by their estimated cardinality, the most selective one is evaluated first,
+    and its id set is used to restrict the other edges, which are then evaluated concurrently.
+    For "not", the first edge has to stay the base of the result, the excluded edges are restricted to the base.
+    For "or", there is nothing to restrict, all edges are evaluated concurrently.
+    """
+    pushdown_ids = id_filter if id_filter is not None and len(id_filter) <= SEMIJOIN_MAX_IDS else None
+    if edge_rule == 1:
+        result_ids = IdSet()
+        for e_ids in parallel_map(executor, lambda e: e.find_from_id(id_filter=pushdown_ids), edges):
+            result_ids |= e_ids
+    else:
+        if edge_rule == 0 and len(edges) > 1:
+            estimates = parallel_map(executor, estimate_cardinality, edges)
+            edges = [edges[i] for i in sorted(range(len(edges)), key=lambda i: estimates[i])]
+        result_ids = edges[0].find_from_id(id_filter=pushdown_ids)
+        if len(result_ids) > 0 and len(edges) > 1:
+            if edge_rule == 0: # AND
+                semijoin_ids = result_ids if len(result_ids) <= SEMIJOIN_MAX_IDS else None
+                for e_ids in parallel_map(executor, lambda e: e.find_from_id(id_filter=semijoin_ids), edges[1:]):
+                    result_ids &= e_ids
+            elif edge_rule == 2: # NOT
+                result_ids = anti_join(result_ids, edges[1:], executor=executor)
+    if id_filter is not None and pushdown_ids is None:
+        result_ids &= id_filter
+    return result_ids
+
+def choose_anti_join(base_ids, edge):
+    """
+    Choose how to exclude the results of edge from base_ids:
+    'probe' evaluates the edge only for the base ids, in batches of SEMIJOIN_MAX_IDS, so it costs about len(base_ids),
+    'bitmap' streams all from_ids of the edge into a bitmap, so it costs about the number of excluded edges.
+    """
+    if len(base_ids) <= SEMIJOIN_MAX_IDS or edge.edge_index() is not None:
+        return 'probe'
+    return 'probe' if len(base_ids) <= estimate_cardinality(edge) else 'bitmap'
+
+def exclusion_mask(base_ids, from_ids, chunk_size=ANTIJOIN_CHUNK_IDS):
+    """
+    Return a boolean array, True for the ids of base_ids that are in the iterable from_ids.
+    The ids are marked in a bitmap over the dictionary codes of base_ids as they are streamed, so the excluded ids are never stored.
+    Ids that were never encoded can't be in base_ids, they are skipped without growing the dictionary.
+    """
+    n_codes = int(base_ids.codes[-1]) + 1
+    bitmap = np.zeros((n_codes + 7) // 8, dtype=np.uint8)
+    def mark(codes):
+        codes = np.array(codes, dtype=np.int64)
+        np.bitwise_or.at(bitmap, codes >> 3, (1 << (codes & 7)).astype(np.uint8))
+    lookup = base_ids.dictionary.lookup
+    chunk = []
+    for one_id in from_ids:
+        code = lookup(one_id)
+        if code is not None and code < n_codes:
+            chunk.append(code)
+            if len(chunk) >= chunk_size:
+                mark(chunk)
+                chunk = []
+    if chunk:
+        mark(chunk)
+    codes = base_ids.codes.astype(np.int64)
+    return ((bitmap[codes >> 3] >> (codes & 7)) & 1).astype(bool)
+
+def anti_join(base_ids, edges, executor=None):
+    """
+    Return the ids of base_ids that have no result in any of the edges, the "not" edge rule.
+    Instead of materializing the full id set of each excluded edge, only the excluded ids among base_ids are computed,
+    with the strategy of choose_anti_join() for each edge.
+    """
+    def excluded_mask(edge):
+        strategy = choose_anti_join(base_ids, edge)
+        if edge.profiler is not None:
+            edge.profiler.set(edge, anti_join=strategy)
+        if strategy == 'bitmap':
+            return exclusion_mask(base_ids, edge.iter_from_ids())
+        mask = np.zeros(len(base_ids), dtype=bool)
+        for i in range(0, len(base_ids), SEMIJOIN_MAX_IDS):
+            batch_ids = IdSet.from_codes(base_ids.codes[i:i+SEMIJOIN_MAX_IDS], base_ids.dictionary)
+            e_ids = edge.find_from_id(id_filter=batch_ids)
+            mask[i:i+SEMIJOIN_MAX_IDS] = np.isin(batch_ids.codes, e_ids.codes_in(base_ids.dictionary, add=False), assume_unique=True)
+        return mask
+    keep = np.ones(len(base_ids), dtype=bool)
+    for mask in parallel_map(executor, excluded_mask, edges):
+        keep &= ~mask
+    return IdSet.from_codes(base_ids.codes[keep], base_ids.dictionary)
+
+def combine_limits(*limits):
+    """ Return the smallest of the positive limits, or 0 (no limit) if there is none """
+    limits = [l for l in limits if l > 0]
+    return min(limits) if limits else 0
+
+def remaining_limit(limit, offset):
+    """ Return the part of a limit left after offset results, 0 (no limit) if limit is 0, should only be used with offset < limit """
+    return max(limit - offset, 1) if limit > 0 else 0
+
+def restrict_id_filter(mongo_filter, id_set, key='_id'):
+    """ Restrict a mongo filter to documents with {key} in id_set, keeping any existing condition on {key} """
+    return in_filter(mongo_filter, key, list(id_set))
+
+def bounded_id_set(mongo_filter, id_filter=None):
+    """
+    Return the IdSet of ids allowed by the '_id' condition of mongo_filter and by id_filter,
+    or None if neither of them bounds the ids, e.g. for a node without '_id' condition and no parent restriction.
+    Conditions other than equality and $in are not used here, the ids found are still checked against the whole filter.
+    """
+    condition = mongo_filter.get('_id')
+    ids = None
+    if isinstance(condition, str):
+        ids = IdSet([condition])
+    elif isinstance(condition, dict):
+        if isinstance(condition.get('$eq'), str):
+            ids = IdSet([condition['$eq']])
+        elif isinstance(condition.get('$in'), list):
+            ids = IdSet(i for i in condition['$in'] if isinstance(i, str))
+    if id_filter is not None:
+        ids = as_idset(id_filter) if ids is None else ids & id_filter
+    return ids
+
+def intersect_id_filter_set(mongo_filter, id_set):
+    """
+    Intersect the '_id' condition of a mongo filter with a set of ids.
+
+    Returns
+    -------
+    (ids, mongo_filter): tuple
+        The list of ids in id_set that satisfy the '_id' condition, and a copy of mongo_filter without the condition,
+        or with it kept when it has operators that can't be evaluated in memory
+    """
+    assert isinstance(id_set, IdSet)
+    mongo_filter = dict(mongo_filter)
+    condition = mongo_filter.pop('_id', None)
+    if condition is None or not id_set:
+        return list(id_set), mongo_filter
+    if isinstance(condition, dict) and '$in' in condition:
+        id_set = id_set & [i for i in condition['$in'] if isinstance(i, str)]
+        condition = {k: v for k, v in condition.items() if k != '$in'}
+        if not condition:
+            return list(id_set), mongo_filter
+    try:
+        return [i for i in id_set if match_condition(i, condition)], mongo_filter
+    except UnsupportedFilter:
+        mongo_filter['_id'] = condition
+        return list(id_set), mongo_filter
@@ -0,0 +1,149 @@
+"""
+Profiling of QueryTree execution, used by the /query/explain endpoint.
+
+A QueryTree built with profile=True gives every node a QueryProfiler, and wraps the mongo collection of every node
+in a ProfiledCollection, so we can report for each node of the executed plan:
+wall time, number of MongoDB round trips, documents examined (from MongoDB explain), result id-set sizes and cache hits.
+"""
+
+import time
+import functools
+import threading
+from collections import defaultdict
+
+class QueryProfiler:
+    """
+    Thread-safe collector of per-node statistics.
+
+    Attributes
+    ----------
+    stats: dict
+        Mapping from id(node) to a dictionary of statistics of that node
+
+    explain: bool
+        If True, the first find() of each node is also explained, to get the documents examined by MongoDB
+
+    """
+    def __init__(self, explain=True):
+        self.explain = explain
+        self.stats = defaultdict(lambda: defaultdict(int))
+        self.t_start = time.time()
+        self.lock = threading.Lock()
+
+    def record(self, node, **kwargs):
+        """ Add the values of kwargs to the statistics of node """
+        with self.lock:
+            node_stats = self.stats[id(node)]
+            for key, value in kwargs.items():
+                node_stats[key] += value
+
+    def set(self, node, **kwargs):
+        """ Set the statistics of node, keeping the existing values """
+        with self.lock:
+            node_stats = self.stats[id(node)]
+            for key, value in kwargs.items():
+                node_stats.setdefault(key, value)
+
+    def report(self, node):
+        """ Build the executed plan tree starting from node, with the statistics of each node """
+        result = {
+            'node': type(node).__name__,
+            'filter': node.filter,
+            'limit': node.limit,
+            'stats': dict(self.stats.get(id(node), {})),
+        }
+        if hasattr(node, 'nextnode'):
+            result['reverse'] = node.reverse
+            result['toNode'] = self.report(node.nextnode) if node.nextnode is not None else None
+        else:
+            result['edge_rule'] = node.edge_rule
+            result['toEdges'] = [self.report(e) for e in node.edges]
+            arithmetics = []
+            for ar in getattr(node, 'arithmetics', []):
+                arithmetics.append({
+                    'operator': ar['operator'],
+                    'targets': [self.report(t) for t in ar['targets']]
+                })
+            if arithmetics:
+                result['arithmetics'] = arithmetics
+        return result
+
+def profiled(method):
+    """
+    Decorator for the findid() and find_from_id() methods of query nodes.
+    Records the wall time, the number of calls and the size of the resulting id set, if the node has a profiler.
+    """
+    @functools.wraps(method)
+    def _profiled_method(self, *args, **kwargs):
+        profiler = getattr(self, 'profiler', None)
+        if profiler is None:
+            return method(self, *args, **kwargs)
+        t0 = time.time()
+        result = method(self, *args, **kwargs)
+        t1 = time.time()
+        profiler.set(self, started_at=round(t0 - profiler.t_start, 4))
+        profiler.record(self, calls=1, wall_time=t1-t0, id_set_size=len(result))
+        return result
+    return _profiled_method
+
+class ProfiledCollection:
+    """
+    Proxy of a pymongo Collection that counts the round trips to MongoDB for a node.
+    In explain mode, the first find() is also explained to record the documents and keys examined.
+    """
+    def __init__(self, collection, profiler, node):
+        self.collection = collection
+        self.profiler = profiler
+        self.node = node
+        self._explained = False
+
+    def __getattr__(self, name):
+        return getattr(self.collection, name)
+
+    def _explain_find(self, *args, **kwargs):
+        if not self.profiler.explain or self._explained:
+            return
+        self._explained = True
+        try:
+            execution_stats = self.collection.find(*args, **kwargs).explain().get('executionStats', {})
+        except Exception as e:
+            print(f"Explain failed with error {e}")
+            return
+        self.profiler.record(self.node,
+            docs_examined=execution_stats.get('totalDocsExamined', 0),
+            keys_examined=execution_stats.get('totalKeysExamined', 0),
+        )
+
+    def find(self, *args, **kwargs):
+        self.profiler.record(self.node, mongo_round_trips=1)
+        self._explain_find(*args, **kwargs)
+        return self.collection.find(*args, **kwargs)
+
+    def find_one(self, *args, **kwargs):
+        self.profiler.record(self.node, mongo_round_trips=1)
+        return self.collection.find_one(*args, **kwargs)
+
+    def aggregate(self, *args, **kwargs):
+        self.profiler.record(self.node, mongo_round_trips=1)
+        return self.collection.aggregate(*args, **kwargs)
+
+    def distinct(self, *args, **kwargs):
+        self.profiler.record(self.node, mongo_round_trips=1)
+        return self.collection.distinct(*args, **kwargs)
+
+    def count_documents(self, *args, **kwargs):
+        self.profiler.record(self.node, mongo_round_trips=1)
+        return self.collection.count_documents(*args, **kwargs)
+
+    def estimated_document_count(self, *args, **kwargs):
+        self.profiler.record(self.node, mongo_round_trips=1)
+        return self.collection.estimated_document_count(*args, **kwargs)
+
+def batch_reporter(node):
+    """ Return a callback for the on_batch argument of sirius.mongo.utils lookups, recording the batches of node """
+    profiler = getattr(node, 'profiler', None)
+    if profiler is None:
+        return None
+    def _report(n_ids, n_docs, seconds):
+        profiler.record(node, lookup_batches=1, lookup_ids=n_ids, lookup_time=seconds)
+    return _report
@@ -1,4 +1,12 @@
+import numpy as np
 from sirius.mongo import Edges
+from sirius.mongo.utils import batched_lookup, batched_count
+from sirius.query.planner import restrict_id_filter, combine_limits, SEMIJOIN_MAX_IDS
+from sirius.query.idset import IdSet, as_idset
+from sirius.query.edge_index import get_edge_index
+from sirius.query.subtree_cache import cached_id_set
+from sirius.query.profiler import profiled, batch_reporter, ProfiledCollection
+from sirius.query.budget import budget_checked, find_kwargs, command_kwargs
 
 class QueryEdge(object):
     def __init__(self, mongo_collection=None, qfilter=None, nextnode=None, reverse=False, limit=0, verbose=False):
@@ -8,11 +16,17 @@ class QueryEdge(object):
         self.reverse = reverse
         self.limit = int(limit)
         self.verbose = verbose
+        # set by QueryTree: key in the subtree_cache, the QueryExecutor for concurrent children, the QueryProfiler and QueryBudget
+        self.cache_key = None
+        self.executor = None
+        self.profiler = None
+        self.budget = None
 
-    def find(self, projection=None):
+    def find(self, projection=None, limit=0):
         """
         Find all Edges from self.mongo_collection, based on self.filter, and the next node I connect to
         Return a cursor of MongoDB.find() query, or an empty list if Nothing found
+        At most limit Edges are returned in addition to self.limit
         """
         mongo_filter = self.filter.copy()
         target_id_key = 'from_id' if self.reverse else 'to_id'
@@ -23,36 +37,128 @@ class QueryEdge(object):
             mongo_filter[target_id_key] = {'$in': target_ids}
         if self.verbose == True:
             print(mongo_filter)
-        return self.mongo_collection.find(mongo_filter, limit=self.limit, projection=projection, no_cursor_timeout=True)
+        return self.mongo_collection.find(mongo_filter, limit=combine_limits(self.limit, limit), projection=projection, **find_kwargs(self.budget))
 
     def distinct(self, key):
         if self.nextnode is None:
-            result = self.mongo_collection.distinct(key, self.filter, maxTimeMS=15000)
+            result = self.mongo_collection.distinct(key, self.filter, **command_kwargs(self.budget, 15000))
         else:
             result = self.find().distinct(key)
         return result
 
-    def find_from_id(self):
+    def edge_index(self):
+        """ Return the EdgeIndex if it is loaded and can evaluate this edge, otherwise None """
+        index = get_edge_index()
+        if index is None:
+            return None
+        mongo_collection = self.mongo_collection
+        if isinstance(mongo_collection, ProfiledCollection):
+            mongo_collection = mongo_collection.collection
+        # user files are not in the index
+        if mongo_collection is not Edges:
+            return None
+        return index if index.supports(self.filter) else None
+
+    def count(self):
+        """ Count the Edges that find() would return, without fetching them """
+        index = self.edge_index()
+        if index is not None:
+            edges = None
+            if self.nextnode is not None:
+                edges = index.edges_to(self.nextnode.findid(), reverse=self.reverse)
+            n = len(index.filter_edges(self.filter, edges))
+            return min(n, self.limit) if self.limit > 0 else n
+        target_id_key = 'from_id' if self.reverse else 'to_id'
+        kwargs = command_kwargs(self.budget)
+        if self.nextnode is None:
+            if self.limit > 0:
+                kwargs['limit'] = self.limit
+            return self.mongo_collection.count_documents(self.filter, **kwargs)
+        n = batched_count(self.mongo_collection, self.nextnode.findid(), field=target_id_key, mongo_filter=self.filter,
+                          on_batch=batch_reporter(self), **kwargs)
+        return min(n, self.limit) if self.limit > 0 else n
+
+    @profiled
+    @budget_checked
+    @cached_id_set
+    def find_from_id(self, id_filter=None):
         """
         Find all self.mongo_collection from self.mongo_collection, based on self.filter, and the next node I connect to
-        Return a set that contain strings of edgenode['from_id']
+        Return an IdSet that contain strings of edgenode['from_id']
+
+        If id_filter is provided, only edges with from_id in id_filter are considered (semi-join from the parent node),
+        and the next node is only checked for the nodes these edges connect to.
         """
+        index = self.edge_index()
+        if index is not None:
+            return self.find_from_id_with_index(index, id_filter)
         mongo_filter = self.filter.copy()
         from_id_key, to_id_key = 'from_id', 'to_id'
         if self.reverse:
             from_id_key, to_id_key = to_id_key, from_id_key
-        result_ids = set()
+        if id_filter is not None:
+            if len(id_filter) == 0: return IdSet()
+            mongo_filter = restrict_id_filter(mongo_filter, id_filter, key=from_id_key)
+        result_ids = IdSet()
         if self.nextnode != None:
-            target_ids = list(self.nextnode.findid())
-            if len(target_ids) == 0: return set()
-            batch_size = 100000
-            for i_batch in range(int(len(target_ids) / batch_size)+1):
-                batch_ids = target_ids[i_batch*batch_size:(i_batch+1)*batch_size]
-                mongo_filter[to_id_key] = {"$in": batch_ids}
-                result_ids.update(d[from_id_key] for d in self.mongo_collection.find(mongo_filter, {from_id_key:1}, limit=self.limit))
+            target_id_filter = None
+            if id_filter is not None:
+                # collect the nodes reachable from the allowed from_ids, so the next node doesn't have to find all of its results
+                target_id_filter = IdSet(d[to_id_key] for d in self.mongo_collection.find(mongo_filter, {to_id_key:1}, **find_kwargs(self.budget)))
+                if len(target_id_filter) == 0: return IdSet()
+                if len(target_id_filter) > SEMIJOIN_MAX_IDS:
+                    target_id_filter = None
+            target_ids = self.nextnode.findid(id_filter=target_id_filter)
+            if len(target_ids) == 0: return IdSet()
+            # self.limit is a quota of Edges over all batches
+            result_ids = IdSet(d[from_id_key] for d in batched_lookup(self.mongo_collection, target_ids, field=to_id_key, mongo_filter=mongo_filter,
+                                                                      limit=self.limit, projection={from_id_key:1}, on_batch=batch_reporter(self), **find_kwargs(self.budget)))
         else:
-            result_ids.update(d[from_id_key] for d in self.mongo_collection.find(mongo_filter, {from_id_key:1}, limit=self.limit))
+            result_ids = IdSet(d[from_id_key] for d in self.mongo_collection.find(mongo_filter, {from_id_key:1}, limit=self.limit, **find_kwargs(self.budget)))
         return result_ids
 
+    def iter_from_ids(self):
+        """
+        Generate the from_id of every Edge found by find_from_id(), without building an id set.
+        The ids can repeat, this is used to stream the excluded ids of "not" edge rules, see planner.anti_join()
+        """
+        from_id_key, to_id_key = 'from_id', 'to_id'
+        if self.reverse:
+            from_id_key, to_id_key = to_id_key, from_id_key
+        if self.nextnode is None:
+            docs = self.mongo_collection.find(self.filter, {from_id_key:1}, limit=self.limit, **find_kwargs(self.budget))
+        else:
+            target_ids = self.nextnode.findid()
+            if len(target_ids) == 0: return
+            docs = batched_lookup(self.mongo_collection, target_ids, field=to_id_key, mongo_filter=self.filter,
+                                  limit=self.limit, projection={from_id_key:1}, on_batch=batch_reporter(self), **find_kwargs(self.budget))
+        for d in docs:
+            yield d[from_id_key]
+
+    def find_from_id_with_index(self, index, id_filter=None):
+        """ Implementation of find_from_id() with the EdgeIndex, only the next node is queried in MongoDB """
+        from_end, to_end = ('to', 'from') if self.reverse else ('from', 'to')
+        edges = None
+        if id_filter is not None:
+            if len(id_filter) == 0: return IdSet()
+            edges = index.filter_edges(self.filter, index.edges_from(as_idset(id_filter), reverse=self.reverse))
+        if self.nextnode != None:
+            target_id_filter = None
+            if edges is not None:
+                target_id_filter = index.end_ids(edges, to_end)
+                if len(target_id_filter) == 0: return IdSet()
+                if len(target_id_filter) > SEMIJOIN_MAX_IDS:
+                    target_id_filter = None
+            target_ids = self.nextnode.findid(id_filter=target_id_filter)
+            if len(target_ids) == 0: return IdSet()
+            if edges is None:
+                edges = index.filter_edges(self.filter, index.edges_to(as_idset(target_ids), reverse=self.reverse))
+            else:
+                edges = edges[np.isin(index.end_codes(to_end)[edges], as_idset(target_ids).codes_in(index.dictionary, add=False))]
+        elif edges is None:
+            edges = index.filter_edges(self.filter)
+        # self.limit is a quota of Edges, like in MongoDB
+        return index.end_ids(edges, from_end, limit=self.limit)
+
     def export(self, filename, ftype):
         raise NotImplementedError("Exporting query Edge is not implemented yet")
\ No newline at end of file
@@ -1,36 +1,66 @@
 import os
 import sys
+import time
+import bisect
+import numpy as np
 from sirius.helpers.constants import QUERY_TYPE_GENOME, QUERY_TYPE_INFO, QUERY_TYPE_EDGE
 from sirius.query.genome_query_node import GenomeQueryNode
 from sirius.query.info_query_node import InfoQueryNode
 from sirius.query.query_edge import QueryEdge
+from sirius.query.pipeline import can_compile, should_use_pipeline, find_with_pipeline, count_with_pipeline, distinct_with_pipeline
+from sirius.query.planner import estimate_count, combine_limits, remaining_limit
+from sirius.query.subtree_cache import subtree_key
+from sirius.query.canonical import CanonicalQuery, canonicalize, DEFAULT_QUERY_LIMIT, DEFAULT_EDGE_RULE, DEFAULT_WINDOW_SIZE
+from sirius.query.executor import QueryExecutor
+from sirius.query.idset import IdSet, DecodedView
+from sirius.query.profiler import QueryProfiler, ProfiledCollection
+from sirius.query.budget import find_kwargs
 from sirius.mongo import userdb
 
 class QueryTree(object):
     Query_operators = {'>':'$gt', '>=':'$gte', '<':'$lt', '<=':'$lte', '=':'$eq', '==':'$eq', '!=':'$ne'}
     EdgeRules = {'and': 0, 'or': 1, 'not': 2}
-    def __init__(self, query=dict(), verbose=False):
+    # backend: 'auto' selects per query, 'pipeline' compiles into one aggregation, 'python' evaluates node by node
+    Backends = {'auto', 'pipeline', 'python'}
+    def __init__(self, query=dict(), verbose=False, backend='auto', profile=False, budget=None):
         self.verbose = verbose
+        assert backend in self.Backends, f'backend should be one of {self.Backends}'
+        self.backend = backend
+        # the children of all nodes in this tree share the concurrency cap of one query
+        self.executor = QueryExecutor()
+        # time and size limits shared by all nodes, a query over budget raises QueryTooExpensive
+        # only the interactive endpoints pass a budget, exports and track cache builds have no limits
+        self.budget = budget
+        self.executor.budget = self.budget
+        # with profile=True, every node reports its execution statistics, see self.explain()
+        self.profiler = QueryProfiler() if profile else None
+        # DecodedView of the result ids sorted by '_id', computed once for keyset pagination of complex queries
+        self._sorted_ids = None
+        # the backend is chosen on the first call of self.use_pipeline(), then kept for every page and count of this tree
+        self._use_pipeline = None
         if query:
+            # build from the canonical form, so equal subtrees get the same cache_key
+            if not isinstance(query, CanonicalQuery):
+                query = canonicalize(query)
             self.head = self.build_recur(query)
 
     def build_recur(self, query):
         if not query: return None
         typ = query['type']
         qfilter = self.build_filter(query['filters'])
-        limit = query.get('limit', 100000) # default limit can finish in 1s
+        limit = query.get('limit', DEFAULT_QUERY_LIMIT)
         # redirect to read user database
         mongo_collection = None
         if ('userFileID' in query):
             mongo_collection = userdb.get_collection(query['userFileID'])
         if typ == QUERY_TYPE_GENOME:
-            edgeRule = self.EdgeRules[query.get('edgeRule', 'and')]
+            edgeRule = self.EdgeRules[query.get('edgeRule', DEFAULT_EDGE_RULE)]
             edges = [self.build_recur(d) for d in query.get('toEdges', [])]
             # genome arithmetics
             arithmetics = self.build_arithmetics(query.get('arithmetics', []))
             resultNode = GenomeQueryNode(mongo_collection, qfilter, edges, edgeRule, arithmetics, limit)
         elif typ == QUERY_TYPE_INFO:
-            edgeRule = self.EdgeRules[query.get('edgeRule', 'and')]
+            edgeRule = self.EdgeRules[query.get('edgeRule', DEFAULT_EDGE_RULE)]
             edges = [self.build_recur(d) for d in query.get('toEdges', [])]
             resultNode = InfoQueryNode(mongo_collection, qfilter, edges, edgeRule, limit)
         elif typ == QUERY_TYPE_EDGE:
@@ -40,9 +70,17 @@ class QueryTree(object):
         else:
             raise NotImplementedError("Query with type %s not implemented yet." % query['type'])
         resultNode.verbose = self.verbose
+        # the results of this subtree can be shared with other queries that contain it
+        resultNode.cache_key = subtree_key(query)
+        resultNode.executor = self.executor
+        resultNode.budget = self.budget
+        if self.profiler is not None:
+            resultNode.profiler = self.profiler
+            resultNode.mongo_collection = ProfiledCollection(resultNode.mongo_collection, self.profiler, resultNode)
         return resultNode
 
-    def build_filter(self, dfilter=None):
+    @classmethod
+    def build_filter(cls, dfilter=None):
         """ Parse a filter dictionary to match MongoDB query language """
         if not dfilter: return dict()
         result = dict()
@@ -50,7 +88,7 @@ class QueryTree(object):
             if isinstance(value, dict):
                 new_value = dict()
                 for k,v in value.items():
-                    new_k = self.Query_operators.get(k, k)
+                    new_k = cls.Query_operators.get(k, k)
                     new_v = v
                     new_value[new_k] = new_v
                 result[key] = new_value
@@ -71,16 +109,145 @@ class QueryTree(object):
             # operator-specific settings and checks
             assert len(ar['targets']) > 0
             if ar['operator'] == 'window':
-                ar['windowSize'] = orig_ar.get('windowSize', 1000)
+                ar['windowSize'] = orig_ar.get('windowSize', DEFAULT_WINDOW_SIZE)
             result.append(ar)
         return result
 
-    def find(self, projection=None):
-        return self.head.find(projection=projection)
+    def iter_nodes(self, node=None):
+        """ Iterate over all nodes of the tree, including the targets of arithmetics """
+        if node is None:
+            node = getattr(self, 'head', None)
+            if node is None:
+                return
+        yield node
+        if getattr(node, 'nextnode', None) is not None:
+            yield from self.iter_nodes(node.nextnode)
+        for edge in getattr(node, 'edges', []):
+            yield from self.iter_nodes(edge)
+        for ar in getattr(node, 'arithmetics', []):
+            for target in ar['targets']:
+                yield from self.iter_nodes(target)
+
+    def set_budget(self, budget):
+        """ Replace the QueryBudget of all nodes, e.g. to give each page of results its own time limit """
+        self.budget = budget
+        self.executor.budget = budget
+        for node in self.iter_nodes():
+            node.budget = budget
+
+    def use_pipeline(self):
+        """ Decide if this query should be executed as a single aggregation pipeline, only once for the tree """
+        if self.backend == 'python':
+            return False
+        elif self.backend == 'pipeline':
+            if not can_compile(self.head):
+                raise NotImplementedError("This query can not be compiled into an aggregation pipeline")
+            return True
+        if self._use_pipeline is None:
+            # should_use_pipeline() counts the documents of the head node, once instead of for every call
+            self._use_pipeline = should_use_pipeline(self.head)
+        return self._use_pipeline
+
+    def find(self, projection=None, limit=0):
+        """ Find the results of the query, at most limit documents if limit > 0, in addition to the limit of the head node """
+        if self.use_pipeline():
+            return find_with_pipeline(self.head, projection=projection, limit=limit)
+        return self.head.find(projection=projection, limit=limit)
+
+    def find_sorted(self, projection=None, start_after=None, limit=0, offset=0):
+        """
+        Find results ordered by '_id', only those with '_id' greater than start_after.
+        This is used for keyset pagination, each page resumes from the last '_id' of the previous page.
+
+        Parameters
+        ----------
+        projection: list, optional
+            The fields to return
+        start_after: string, optional
+            The '_id' of the last document of the previous page
+        limit: int, default 0
+            Return at most this many documents, 0 means no limit
+        offset: int, default 0
+            The number of results up to start_after, so the limit of the head node applies to the whole results, not to each page
+
+        Returns
+        -------
+        A cursor or generator of documents ordered by '_id'
+        """
+        head = self.head
+        if head.limit > 0 and offset >= head.limit:
+            return iter([])
+        if self.use_pipeline():
+            return find_with_pipeline(head, projection=projection, start_after=start_after, sort_by_id=True, limit=limit, offset=offset)
+        if not getattr(head, 'edges', None) and not getattr(head, 'arithmetics', None) and getattr(head, 'nextnode', None) is None:
+            mongo_filter = head.filter
+            if start_after is not None:
+                after_filter = {'_id': {'$gt': start_after}}
+                mongo_filter = {'$and': [mongo_filter, after_filter]} if mongo_filter else after_filter
+            limit = combine_limits(remaining_limit(head.limit, offset), limit)
+            return head.mongo_collection.find(mongo_filter, projection=projection, sort=[('_id', 1)], limit=limit, **find_kwargs(self.budget))
+        # the sorted ids are already cut at the limit of the head node
+        return self.find_sorted_by_ids(projection=projection, start_after=start_after, limit=limit)
+
+    def find_sorted_by_ids(self, projection=None, start_after=None, limit=0, batch_size=1000):
+        """ Implementation of find_sorted() for queries with edges or arithmetics, based on the sorted result ids """
+        if self._sorted_ids is None:
+            if hasattr(self.head, 'nextnode'):
+                result_ids = IdSet(d['_id'] for d in self.head.find(projection=['_id']))
+            else:
+                result_ids = self.head.findid()
+            ids = list(result_ids)
+            order = sorted(range(len(ids)), key=ids.__getitem__)
+            if self.head.limit > 0:
+                order = order[:self.head.limit]
+            self._sorted_ids = DecodedView(result_ids.codes[np.array(order, dtype=np.int64)], result_ids.dictionary)
+        sorted_ids = self._sorted_ids
+        i_start = 0 if start_after is None else bisect.bisect_right(sorted_ids, start_after)
+        i_end = len(sorted_ids) if limit <= 0 else min(i_start + limit, len(sorted_ids))
+        for i_batch in range(i_start, i_end, batch_size):
+            batch_ids = sorted_ids[i_batch:min(i_batch+batch_size, i_end)]
+            yield from self.head.mongo_collection.find({'_id': {'$in': batch_ids}}, projection=projection, sort=[('_id', 1)], **find_kwargs(self.budget))
 
     def distinct(self, key):
+        """ Find the distinct values of key in the results, queries with edges use a $group aggregation when they can """
+        if self.use_pipeline():
+            return distinct_with_pipeline(self.head, key)
         return self.head.distinct(key)
 
+    def count(self, estimate=False):
+        """
+        Count the results of the query without fetching the documents.
+        With estimate=True, return a fast estimate from collection statistics and sampling instead.
+        """
+        if estimate:
+            return estimate_count(self.head)
+        if self.use_pipeline():
+            return count_with_pipeline(self.head)
+        return self.head.count()
+
+    def explain(self):
+        """
+        Execute the query with profiling, and return the executed plan tree with the statistics of each node:
+        wall time, MongoDB round trips, documents and keys examined, id set sizes, and subtree cache hits.
+        """
+        assert self.profiler is not None, 'QueryTree should be built with profile=True to explain'
+        t0 = time.time()
+        use_pipeline = self.use_pipeline()
+        if use_pipeline:
+            results = find_with_pipeline(self.head, projection=['_id'])
+        else:
+            results = self.head.find(projection=['_id'])
+        n_results = sum(1 for _ in results)
+        t1 = time.time()
+        # the head time is already recorded if it ran through findid()
+        self.profiler.set(self.head, wall_time=t1-t0, n_results=n_results)
+        return {
+            'backend': 'pipeline' if use_pipeline else 'python',
+            'wall_time': t1-t0,
+            'n_results': n_results,
+            'plan': self.profiler.report(self.head)
+        }
+
     def export(self, filename, ftype, sort=False):
         """ Export query results to a file with specified type """
         assert hasattr(self, 'head'), 'Query is not built, self.head is not set'
@@ -0,0 +1,90 @@
+"""
+Answering narrower queries from the cached results of broader queries.
+
+Users often refine a query by adding a filter, like the same ENCODE query with {'type': 'Enhancer-like'} added.
+If a cached query has the same type and its filters are a subset of the new query's filters,
+the results of the new query are the cached rows that also match the remaining filters.
+match_filter() evaluates these remaining filters in memory, for the common MongoDB operators,
+and SubsumptionIndex keeps track of the cached results that can be used this way.
+"""
+
+import threading
+import cachetools
+from sirius.query.query_tree import QueryTree
+from sirius.query.matching import UnsupportedFilter, filter_fields
+
+def is_simple_query(query):
+    """ Subsumption is only checked for queries of a single node """
+    return not (query.get('toEdges') or query.get('arithmetics') or query.get('toNode') or 'userFileID' in query)
+
+def residual_filter(broad_query, narrow_query):
+    """
+    If every result of narrow_query is a result of broad_query, return the filter that selects them from the results of broad_query.
+    Otherwise return None. Both queries should be canonical.
+    """
+    if broad_query.get('type') != narrow_query.get('type'):
+        return None
+    if not is_simple_query(broad_query) or not is_simple_query(narrow_query):
+        return None
+    broad_filters = broad_query.get('filters') or {}
+    narrow_filters = narrow_query.get('filters') or {}
+    # the narrow query is the broad query with more conditions
+    for key, condition in broad_filters.items():
+        if key not in narrow_filters or narrow_filters[key] != condition:
+            return None
+    return {key: condition for key, condition in narrow_filters.items() if key not in broad_filters}
+
+def covers(projection, fields):
+    """ Return True if the documents returned with projection contain all the fields """
+    for field in fields:
+        parts = field.split('.')
+        if not any('.'.join(parts[:i]) in projection for i in range(1, len(parts)+1)):
+            return False
+    return True
+
+class SubsumptionIndex:
+    """
+    Thread-safe index of cached query results, that can answer narrower queries.
+
+    Each entry keeps a reference to the cached result of a query with the projection used to get it,
+    and the number of rows, so the memory of the cached results is released when they are evicted here.
+    """
+    def __init__(self, max_rows=5000000):
+        self.entries = cachetools.LRUCache(maxsize=max_rows, getsizeof=lambda entry: max(entry[3], 1))
+        self.lock = threading.Lock()
+
+    def add(self, query, projection, result, n_rows):
+        """ Remember the result of a query, only results that are not cut by the limit of the query can be used """
+        if not is_simple_query(query):
+            return
+        if query.get('limit', 0) > 0 and n_rows >= query['limit']:
+            return
+        if n_rows > self.entries.maxsize:
+            return
+        key = (query.digest if hasattr(query, 'digest') else repr(query), tuple(projection))
+        with self.lock:
+            self.entries[key] = (query, tuple(projection), result, n_rows)
+
+    def find(self, query, projection):
+        """
+        Find a cached result for a broader query with the same projection, whose rows have all the fields of the residual filter,
+        and whose residual filter only has operators that match_filter() supports.
+        Return (result, residual_filter), or None if there is none.
+        """
+        projection = tuple(projection)
+        with self.lock:
+            entries = list(self.entries.values())
+        for broad_query, broad_projection, result, n_rows in entries:
+            if broad_projection != projection:
+                continue
+            residual = residual_filter(broad_query, query)
+            if residual is None:
+                continue
+            try:
+                residual = QueryTree.build_filter(residual)
+                if not covers(broad_projection, filter_fields(residual)):
+                    continue
+            except UnsupportedFilter:
+                continue
+            return result, residual
+        return None
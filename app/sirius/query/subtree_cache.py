@@ -0,0 +1,86 @@
+"""
+Memoization of the id sets of QueryTree subtrees, shared by all queries in this process.
+
+Different top-level queries often share identical subtrees, like the same trait EdgeNode under different GenomeNode filters.
+Each node built by QueryTree gets a cache_key computed from the query dictionary of its subtree,
+and the findid() / find_from_id() results of the node are stored here under that key.
+The cache is bounded by the total number of ids it holds, instead of the number of entries.
+"""
+
+import functools
+import threading
+import cachetools
+from sirius.query.idset import IdSet
+from sirius.query.canonical import query_digest
+
+# each id costs 4 bytes in an IdSet, so this holds about 200 MB of ids
+SUBTREE_CACHE_MAX_IDS = 50000000
+# the database could be updated, so the cached results expire
+SUBTREE_CACHE_TTL = 3600
+
+class SubtreeCache:
+    """ Thread-safe TTL cache of IdSets, with size-aware eviction based on the number of ids """
+    def __init__(self, max_ids=SUBTREE_CACHE_MAX_IDS, ttl=SUBTREE_CACHE_TTL):
+        self.cache = cachetools.TTLCache(maxsize=max_ids, ttl=ttl, getsizeof=lambda idset: max(len(idset), 1))
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """ Return a copy of the cached IdSet, or None if not cached """
+        with self.lock:
+            result = self.cache.get(key)
+            if result is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        # the callers modify the id sets in place, so we never give out the cached object
+        return IdSet.from_codes(result.codes, result.dictionary)
+
+    def set(self, key, idset):
+        if len(idset) > self.cache.maxsize:
+            return
+        with self.lock:
+            self.cache[key] = IdSet.from_codes(idset.codes, idset.dictionary)
+
+    def clear(self):
+        with self.lock:
+            self.cache.clear()
+
+    def cache_info(self):
+        return f"SubtreeCache(hits={self.hits}, misses={self.misses}, entries={len(self.cache)}, ids={self.cache.currsize})"
+
+subtree_cache = SubtreeCache()
+
+def subtree_key(query):
+    """ Compute the cache key of a query subtree from its dictionary, which QueryTree has made canonical """
+    return query_digest(query)
+
+def cached_id_set(method):
+    """
+    Decorator for the findid() and find_from_id() methods of query nodes.
+
+    Nodes with a cache_key look up their full result in the subtree_cache first.
+    When an id_filter is given, a cached full result is intersected with it,
+    but a filtered result is never stored, since it is not the result of the subtree.
+    """
+    @functools.wraps(method)
+    def _cached_method(self, id_filter=None):
+        key = getattr(self, 'cache_key', None)
+        if key is None:
+            return method(self, id_filter=id_filter)
+        result = subtree_cache.get(key)
+        profiler = getattr(self, 'profiler', None)
+        if result is not None:
+            if profiler is not None:
+                profiler.record(self, cache_hits=1)
+            if id_filter is not None:
+                result &= id_filter
+            return result
+        if profiler is not None:
+            profiler.record(self, cache_misses=1)
+        result = method(self, id_filter=id_filter)
+        if id_filter is None:
+            subtree_cache.set(key, result)
+        return result
+    return _cached_method
@@ -1,10 +1,16 @@
 #!/usr/bin/env python
 
+import threading
 import unittest
 import json
 from sirius.tests.timed_test_case import TimedTestCase
 from sirius.query.query_tree import QueryTree
+from sirius.query.canonical import CanonicalQuery
 from sirius.core.annotationtrack import get_annotation_query
+from sirius.core.all_variant_track import get_all_variants_in_range, tile_bits_for_span
+from sirius.core.variant_track import get_variant_contig_results
+from sirius.core.utilities import contig_query, rows_on_contig, nearby_contigs, BackgroundRunner, threadsafe_sized_lru
+from sirius.mongo import GenomeNodes
 
 class CoreTest(TimedTestCase):
 
@@ -15,6 +21,22 @@ class CoreTest(TimedTestCase):
         n_result = len(list(qt.find()))
         self.assertGreater(n_result, 10, 'Query cancer traits should return more than 10 InfoNodes')
 
+    def test_QueryTree_count(self):
+        """ Test QueryTree.count() matches the number of results of QueryTree.find() """
+        dfilter = {'type': 'InfoNode', 'filters': {'$text': "cancer"}}
+        qt = QueryTree(dfilter)
+        self.assertEqual(qt.count(), len(list(qt.find())))
+        self.assertGreaterEqual(qt.count(estimate=True), qt.count())
+
+    def test_QueryTree_limit(self):
+        """ Test the limit of a query with edges is respected over all batches """
+        query = {'type': 'GenomeNode', 'filters': {'type': 'SNP'}, 'limit': 10, 'toEdges': [
+            {'type': 'EdgeNode', 'filters': {'type': 'association:snp:trait'}}
+        ]}
+        qt = QueryTree(query)
+        self.assertEqual(len(list(qt.find())), 10)
+        self.assertEqual(len(list(qt.find(limit=3))), 3)
+
     def test_core_views(self):
         """ Test core.annotationtrack.get_annotation_query() """
         query = {'type':'GenomeNode', "filters":{"type":'gene'}}
@@ -22,6 +44,63 @@ class CoreTest(TimedTestCase):
         d = json.loads(result)
         self.assertGreater(d['countInRange'], 8, 'Number of genes in Chr1 1-1M should be greater than 8')
 
+    def test_all_variants_tiles(self):
+        """ Test get_all_variants_in_range() assembled from tiles matches the variants found in the range """
+        self.assertEqual(tile_bits_for_span(1, 1000), 16)
+        self.assertEqual(tile_bits_for_span(1, 2**20), 20)
+        self.assertEqual(tile_bits_for_span(1, 2**20 + 1), 21)
+        for start_bp, end_bp in [(1, 100000), (65530, 65540), (1000001, 1300000)]:
+            qfilt = {'type': {'$in': ['SNP', 'variant']}, 'contig': 'chr1', 'start': {'$gte': start_bp, '$lte': end_bp}}
+            expected = sorted(d['_id'] for d in GenomeNodes.find(qfilt, projection=['_id']))
+            result = get_all_variants_in_range('chr1', start_bp, end_bp)
+            self.assertEqual(sorted(d['id'] for d in result), expected)
+
+    def test_contig_query(self):
+        """ Test contig_query() restricts the head node of a query to one contig """
+        query = {'type': 'GenomeNode', 'filters': {'type': 'SNP'}, 'toEdges': [{'type': 'EdgeNode', 'filters': {}}]}
+        result = contig_query(query, 'chr1')
+        self.assertEqual(result['filters'], {'type': 'SNP', 'contig': 'chr1'})
+        self.assertEqual(result['toEdges'][0]['filters'], {})
+        self.assertEqual(contig_query(result, 'chr1'), result)
+        self.assertIsNone(contig_query(result, 'chr2'))
+        result = contig_query({'type': 'GenomeNode', 'filters': {'contig': {'$in': ['chr1', 'chr2']}}}, 'chr2')
+        self.assertEqual(result['filters']['contig'], {'$in': ['chr1', 'chr2'], '$eq': 'chr2'})
+        # the ids added by arithmetics are not restricted by the head filter
+        rows = [{'_id': 'Gsnp_rs1', 'contig': 'chr1'}, {'_id': 'Gsnp_rs2', 'contig': 'chr2'}]
+        self.assertEqual([d['_id'] for d in rows_on_contig(rows, 'chr2')], ['Gsnp_rs2'])
+
+    def test_track_limit_per_contig(self):
+        """ Test the limit of a track query applies to each contig """
+        query = CanonicalQuery({'type': 'GenomeNode', 'filters': {'type': 'SNP'}, 'limit': 5})
+        for contig in ['chr1', 'chr2']:
+            columns = get_variant_contig_results(query, contig)
+            self.assertEqual(len(columns), 5)
+            ids = [d['_id'] for d in columns.rows()]
+            self.assertEqual(GenomeNodes.count_documents({'_id': {'$in': ids}, 'contig': contig}), 5)
+
+    def test_background_fill(self):
+        """ Test only the nearby contigs are filled, and the background queue is bounded """
+        contigs = ['chr1', 'chr2', 'chr3', 'chr4']
+        self.assertEqual(nearby_contigs('chr1', contigs), ['chr2', 'chr3'])
+        self.assertEqual(nearby_contigs('chr3', contigs), ['chr4', 'chr2'])
+        self.assertEqual(nearby_contigs('chrUn_gl000220', contigs), [])
+        release = threading.Event()
+        runner = BackgroundRunner(max_workers=1, max_pending=2)
+        self.assertEqual([runner.submit(release.wait, i) for i in (1, 1, 2, 3)], [True, False, True, False])
+        release.set()
+
+    def test_threadsafe_sized_lru(self):
+        """ Test threadsafe_sized_lru() bounds the total size of the results, and doesn't keep results larger than that """
+        calls = []
+        @threadsafe_sized_lru(maxsize=10, getsizeof=len)
+        def rows(n):
+            calls.append(n)
+            return [0] * n
+        for n in [4, 4, 5, 20, 20, 3, 5]:
+            rows(n)
+        self.assertEqual(calls, [4, 5, 20, 20, 3, 5])
+        self.assertLessEqual(rows.cache_info().currsize, 10)
+
     def test_import_auth(self):
         """ Test import core.auth0 module """
         from sirius.core import auth0
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+
+import unittest
+from sirius.tests.timed_test_case import TimedTestCase
+from sirius.query.matching import match_filter, get_path
+from sirius.query.budget import QueryTooExpensive
+from sirius.core.query_endpoint import QueryResultsCache, GWASResults, encode_page_token
+
+class SortedCollection:
+    """ Collection stand-in for find() with a filter, a sort on '_id' and a limit, and aggregate() with $match and $group """
+    def __init__(self, docs):
+        self.docs = sorted(docs, key=lambda d: d['_id'])
+        # the number of find() calls that raise before the next one succeeds
+        self.failures = 0
+
+    def find(self, mongo_filter=None, projection=None, sort=None, limit=0, **kwargs):
+        if self.failures > 0:
+            self.failures -= 1
+            raise QueryTooExpensive('time', 'Query did not finish in time')
+        docs = [dict(d) for d in self.docs if match_filter(d, mongo_filter or {})]
+        return docs[:limit] if limit > 0 else docs
+
+    def aggregate(self, pipeline, **kwargs):
+        docs = self.docs
+        for stage in pipeline:
+            if '$match' in stage:
+                docs = [d for d in docs if match_filter(d, stage['$match'])]
+            elif '$group' in stage:
+                group = stage['$group']
+                (name, accumulator), = [(k, v) for k, v in group.items() if k != '_id']
+                result = dict()
+                for d in docs:
+                    key, value = get_path(d, group['_id'][1:]), get_path(d, accumulator['$min'][1:])
+                    result[key] = min(result.get(key, value), value)
+                docs = [{'_id': key, name: value} for key, value in result.items()]
+        return docs
+
+def results_cache(n_docs, limit=0):
+    query = {'type': 'GenomeNode', 'filters': {'type': 'SNP'}, 'limit': limit}
+    results = QueryResultsCache(query)
+    results.qt.backend = 'python'
+    results.qt.head.mongo_collection = SortedCollection([{'_id': f'G{i:03d}', 'type': 'SNP'} for i in range(n_docs)])
+    return results
+
+class QueryEndpointTest(TimedTestCase):
+    def test_get_page(self):
+        """ Test the pages of QueryResultsCache follow the '_id' order, and resume from the checkpoints """
+        results = results_cache(50)
+        results.checkpoint_interval = 8
+        rows, reached_end = results.get_page(0, 10)
+        self.assertEqual([d['id'] for d in rows], [f'G{i:03d}' for i in range(10)])
+        self.assertFalse(reached_end)
+        self.assertIn(8, results.checkpoints)
+        rows, reached_end = results.get_page(45, 60)
+        self.assertEqual([d['id'] for d in rows], [f'G{i:03d}' for i in range(45, 50)])
+        self.assertTrue(reached_end)
+        self.assertEqual(results.total, 50)
+        rows, reached_end = results.get_page(20, 25)
+        self.assertEqual([d['id'] for d in rows], [f'G{i:03d}' for i in range(20, 25)])
+
+    def test_page_token(self):
+        """ Test a continuation token gives the next page, and a forged one does not change the pages of other clients """
+        results = results_cache(50)
+        rows, start, reached_end = results.get_page_from_token(encode_page_token(10, 'G009'), 5)
+        self.assertEqual(start, 10)
+        self.assertEqual([d['id'] for d in rows], [f'G{i:03d}' for i in range(10, 15)])
+        self.assertFalse(reached_end)
+        # this token claims that 'G045' is at offset 2
+        rows, start, reached_end = results.get_page_from_token(encode_page_token(2, 'G045'), 100)
+        self.assertEqual(len(rows), 4)
+        self.assertTrue(reached_end)
+        self.assertIsNone(results.total)
+        self.assertEqual(results.checkpoint_offsets, [0])
+        rows, reached_end = results.get_page(0, 100)
+        self.assertEqual(len(rows), 50)
+        self.assertTrue(reached_end)
+
+    def test_page_limit(self):
+        """ Test the limit of the query applies to all pages together """
+        results = results_cache(50, limit=10)
+        rows, reached_end = results.get_page(0, 5)
+        self.assertEqual(len(rows), 5)
+        self.assertFalse(reached_end)
+        rows, reached_end = results.get_page(5, 15)
+        self.assertEqual([d['id'] for d in rows], [f'G{i:03d}' for i in range(5, 10)])
+        self.assertTrue(reached_end)
+        rows, reached_end = results.get_page(15, 30)
+        self.assertEqual(rows, [])
+        self.assertTrue(reached_end)
+        rows, start, reached_end = results.get_page_from_token(encode_page_token(8, 'G007'), 5)
+        self.assertEqual([d['id'] for d in rows], ['G008', 'G009'])
+        self.assertTrue(reached_end)
+
+    def test_gwas_pages(self):
+        """ Test the GWAS results are ordered by the lowest p-value, and a failed page loses no SNPs """
+        gwas = gwas_results()
+        gwas.fetch_size = 2
+        snps = gwas.genome_query_node.mongo_collection
+        snps.failures = 1
+        with self.assertRaises(QueryTooExpensive):
+            gwas.get_page(0, 2)
+        rows, reached_end = gwas.get_page(0, 2)
+        self.assertEqual([d['id'] for d in rows], ['G1', 'G2'])
+        self.assertEqual([d['info']['p-value'] for d in rows], [0.05, 0.1])
+        self.assertFalse(reached_end)
+        snps.failures = 1
+        with self.assertRaises(QueryTooExpensive):
+            gwas.get_page(2, 10)
+        rows, reached_end = gwas.get_page(2, 10)
+        self.assertEqual([d['id'] for d in rows], ['G4', 'G3'])
+        self.assertEqual(rows[-1]['info']['p-value'], None)
+        self.assertTrue(reached_end)
+
+    def test_gwas_limit(self):
+        """ Test the limit of the GWAS edge is a quota of Edges for the p-values, like for the SNPs without a p-value """
+        gwas = gwas_results(edge_limit=3)
+        rows, reached_end = gwas.get_page(0, 10)
+        self.assertEqual([d['id'] for d in rows], ['G2', 'G1', 'G3'])
+        self.assertEqual([d['info']['p-value'] for d in rows], [0.1, 0.5, None])
+        self.assertTrue(reached_end)
+
+def gwas_results(edge_limit=0):
+    query = {'type': 'GenomeNode', 'filters': {'type': 'SNP'}, 'toEdges': [{'type': 'EdgeNode', 'filters': {}, 'limit': edge_limit}]}
+    gwas = GWASResults(query)
+    pvalues = [('G1', 0.5), ('G2', 0.1), ('G3', None), ('G1', 0.05), ('G4', 0.3)]
+    gwas.query_edge.mongo_collection = SortedCollection([{'_id': f'E{i}', 'from_id': gid, 'info': {'p-value': p}} for i, (gid, p) in enumerate(pvalues)])
+    gwas.genome_query_node.mongo_collection = SortedCollection([{'_id': f'G{i}', 'type': 'SNP'} for i in range(1, 6)])
+    # the results of the stand-in collections should not be shared through the subtree cache
+    for node in gwas.qt.iter_nodes():
+        node.cache_key = None
+    return gwas
+
+if __name__ == "__main__":
+    unittest.main()
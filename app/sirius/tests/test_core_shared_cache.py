@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+
+import tempfile
+import unittest
+import threading
+import socketserver
+import numpy as np
+from sirius.tests.timed_test_case import TimedTestCase
+from sirius.query.canonical import CanonicalQuery
+from sirius.core import shared_cache
+from sirius.core.shared_cache import LocalBackend, MmapBackend, RedisBackend, shared_cache_key, shared_cached, sign_value, verified_value
+
+class RespStandIn(socketserver.StreamRequestHandler):
+    """ Local stand-in of a Redis server, only GET and SET """
+    store = dict()
+
+    def read_command(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        args = []
+        for _ in range(int(line[1:-2])):
+            n = int(self.rfile.readline()[1:-2])
+            args.append(self.rfile.read(n + 2)[:-2])
+        return args
+
+    def handle(self):
+        while True:
+            args = self.read_command()
+            if args is None:
+                return
+            if args[0] == b'SET':
+                self.store[args[1]] = args[2]
+                self.wfile.write(b'+OK\r\n')
+            elif args[0] == b'GET':
+                value = self.store.get(args[1])
+                if value is None:
+                    self.wfile.write(b'$-1\r\n')
+                else:
+                    self.wfile.write(b'$%d\r\n%s\r\n' % (len(value), value))
+            else:
+                self.wfile.write(b'-ERR unknown command\r\n')
+
+class SharedCacheTest(TimedTestCase):
+    def test_key(self):
+        """ Test the shared cache keys use the canonical query digest """
+        q1 = CanonicalQuery({'type': 'GenomeNode', 'filters': {'type': 'SNP'}, 'limit': 100000})
+        q2 = CanonicalQuery({'filters': {'type': 'SNP'}, 'type': 'GenomeNode'})
+        self.assertEqual(shared_cache_key('f', (q1, ('name',)), {}), shared_cache_key('f', (q2, ('name',)), {}))
+        self.assertNotEqual(shared_cache_key('f', (q1,), {}), shared_cache_key('g', (q1,), {}))
+
+    def test_mmap_backend(self):
+        """ Test MmapBackend stores values until they expire """
+        with tempfile.TemporaryDirectory() as directory:
+            backend = MmapBackend(directory)
+            self.assertIsNone(backend.get('k'))
+            backend.set('k', b'value', ttl=100)
+            self.assertEqual(backend.get('k'), b'value')
+            backend.set('old', b'value', ttl=-1)
+            self.assertIsNone(backend.get('old'))
+            backend.evict()
+            self.assertEqual(backend.get('k'), b'value')
+
+    def test_redis_backend(self):
+        """ Test RedisBackend with a local stand-in server, and shared_cached() across two 'workers' """
+        server = socketserver.ThreadingTCPServer(('localhost', 0), RespStandIn)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        original_backend = shared_cache.backend
+        try:
+            backend = RedisBackend(f'localhost:{server.server_address[1]}')
+            self.assertIsNone(backend.get('k'))
+            backend.set('k', b'\r\nbinary\x00', ttl=100)
+            self.assertEqual(backend.get('k'), b'\r\nbinary\x00')
+            shared_cache.backend = backend
+            calls = []
+            def compute(query):
+                calls.append(query)
+                return {'chr1': np.arange(5)}
+            # the same function in two workers
+            worker1 = shared_cached()(compute)
+            worker2 = shared_cached()(compute)
+            query = CanonicalQuery({'type': 'GenomeNode', 'filters': {}})
+            worker1(query)
+            result = worker2(query)
+            self.assertEqual(len(calls), 1)
+            self.assertTrue(np.array_equal(result['chr1'], np.arange(5)))
+        finally:
+            shared_cache.backend = original_backend
+            server.shutdown()
+            server.server_close()
+
+    def test_local_backend(self):
+        """ Test the results are not serialized when the backend doesn't share them """
+        original_backend = shared_cache.backend
+        try:
+            shared_cache.backend = LocalBackend()
+            # a lambda can't be pickled
+            result = shared_cached()(lambda x: (lambda: x))(1)
+            self.assertEqual(result(), 1)
+        finally:
+            shared_cache.backend = original_backend
+
+    def test_signature(self):
+        """ Test signed values are verified, and values with a wrong signature are ignored """
+        signed = sign_value(b'value', secret=b'secret')
+        self.assertEqual(verified_value(signed, secret=b'secret'), b'value')
+        self.assertIsNone(verified_value(signed, secret=b'other'))
+        self.assertIsNone(verified_value(signed[:-1] + b'X', secret=b'secret'))
+        self.assertEqual(sign_value(b'value', secret=b''), b'value')
+
+if __name__ == "__main__":
+    unittest.main()
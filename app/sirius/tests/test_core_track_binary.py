@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+
+import json
+import unittest
+import numpy as np
+from werkzeug.datastructures import MIMEAccept
+from sirius.tests.timed_test_case import TimedTestCase
+from sirius.core.track_columns import TrackColumns
+from sirius.core.track_binary import encode_track, decode_track, wants_binary
+
+class TrackBinaryTest(TimedTestCase):
+    rows = [
+        {'_id': f'Gsnp_rs{i}', 'start': 100 * i, 'length': 1, 'type': 'SNP' if i % 3 else 'gene', 'name': f'rs{i}é',
+         'info': {'variant_ref': 'ACGT'[i % 4], 'variant_alt': ['A', 'C'] if i == 5 else 'G'}}
+        for i in range(1, 21)
+    ]
+    names = ['_id', 'start', 'length', 'type', 'name', 'info.variant_ref', 'info.variant_alt']
+
+    def test_round_trip(self):
+        """ Test the binary encoding of a range of rows decodes to the same values """
+        columns = TrackColumns(self.rows, self.names)
+        i_start, i_end = columns.range_indices(300, 1500)
+        header = {'contig': 'chr1', 'start_bp': 300, 'end_bp': 1500}
+        response = encode_track(header, columns, i_start, i_end, [(n, 'id' if n == '_id' else n) for n in self.names])
+        decoded_header, data = decode_track(response)
+        self.assertEqual(decoded_header['contig'], 'chr1')
+        self.assertEqual(decoded_header['count'], i_end - i_start)
+        kinds = {c['name']: c['kind'] for c in decoded_header['columns']}
+        self.assertEqual(kinds['start'], 'int32')
+        self.assertEqual(kinds['type'], 'enum')
+        self.assertEqual(kinds['id'], 'strings')
+        self.assertEqual(kinds['info.variant_alt'], 'json')
+        # every part is aligned for typed arrays
+        self.assertTrue(all(c['offset'] % 4 == 0 for c in decoded_header['columns']))
+        for name in self.names:
+            response_name = 'id' if name == '_id' else name
+            self.assertEqual(data[response_name], _values(columns, name, i_start, i_end))
+        self.assertLess(len(response), len(json.dumps(columns.rows(i_start, i_end))))
+
+    def test_empty(self):
+        """ Test the binary encoding without results """
+        header, data = decode_track(encode_track({'contig': 'chr1'}, None, 0, 0, [('start', 'start')]))
+        self.assertEqual(header['count'], 0)
+        self.assertEqual(data, {})
+        columns = TrackColumns([], self.names)
+        header, data = decode_track(encode_track({}, columns, 0, 0, [(n, n) for n in self.names]))
+        self.assertEqual(data['start'], [])
+
+    def test_wants_binary(self):
+        """ Test the content negotiation keeps JSON unless the client prefers the binary format """
+        self.assertFalse(wants_binary(MIMEAccept([('*/*', 1)])))
+        self.assertFalse(wants_binary(MIMEAccept([('application/json', 1), ('application/octet-stream', 0.5)])))
+        self.assertTrue(wants_binary(MIMEAccept([('application/octet-stream', 1)])))
+
+def _values(columns, name, i_start, i_end):
+    values = columns[name]
+    values = values.tolist() if isinstance(values, np.ndarray) else values
+    return values[i_start:i_end]
+
+if __name__ == "__main__":
+    unittest.main()
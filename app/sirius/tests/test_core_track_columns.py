@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+
+import pickle
+import unittest
+import numpy as np
+from sirius.tests.timed_test_case import TimedTestCase
+from sirius.core.track_columns import TrackColumns, StringColumn
+
+class TrackColumnsTest(TimedTestCase):
+    rows = [
+        {'_id': 'Gsnp_rs3', 'start': 300, 'type': 'SNP', 'name': 'rs3', 'info': {'variant_ref': 'A', 'variant_alt': 'G'}},
+        {'_id': 'Gsnp_rs1', 'start': 100, 'type': 'SNP', 'name': 'rs1', 'info': {'variant_ref': 'C'}},
+        {'_id': 'Gsnp_rs2', 'start': 200, 'type': 'SNP', 'name': 'rs2', 'info': {'variant_ref': 'T', 'variant_alt': ['A', 'C']}},
+    ]
+    names = ['_id', 'start', 'type', 'name', 'info.variant_ref', 'info.variant_alt']
+
+    def test_string_column(self):
+        """ Test StringColumn encodes the distinct values once, and missing values """
+        column = StringColumn(['SNP', 'gene', None, 'SNP', 'é'])
+        self.assertEqual(list(column.codes), [0, 1, -1, 0, 2])
+        self.assertEqual(column.take(0, 5), ['SNP', 'gene', None, 'SNP', 'é'])
+        self.assertEqual(column.take(3, 5), ['SNP', 'é'])
+
+    def test_track_columns(self):
+        """ Test TrackColumns sorts the rows by start, and builds the rows of a range with nested fields """
+        columns = TrackColumns(self.rows, self.names)
+        self.assertEqual(len(columns), 3)
+        self.assertIsInstance(columns.columns['start'], np.ndarray)
+        self.assertIsInstance(columns.columns['_id'], StringColumn)
+        self.assertEqual(list(columns['start']), [100, 200, 300])
+        self.assertEqual(columns.range_indices(150, 300), (1, 2))
+        self.assertEqual(columns.rows(0, 2), [
+            {'_id': 'Gsnp_rs1', 'start': 100, 'type': 'SNP', 'name': 'rs1', 'info': {'variant_ref': 'C'}},
+            {'_id': 'Gsnp_rs2', 'start': 200, 'type': 'SNP', 'name': 'rs2', 'info': {'variant_ref': 'T', 'variant_alt': ['A', 'C']}},
+        ])
+        self.assertEqual(columns.tuples(['start', 'name'], 2, 3), [(300, 'rs3')])
+        copied = pickle.loads(pickle.dumps(columns))
+        self.assertEqual(copied.rows(), columns.rows())
+        empty = TrackColumns([], self.names)
+        self.assertEqual(len(empty), 0)
+        self.assertEqual(empty.range_indices(0, 1000), (0, 0))
+
+    def test_overlapping(self):
+        """ Test the rows overlapping a range include the long features starting before it, in the order of their start """
+        rows = [
+            {'_id': 'Ggene_long', 'start': 100, 'length': 10000, 'type': 'gene', 'name': 'long'},
+            {'_id': 'Ggene_short', 'start': 200, 'length': 10, 'type': 'gene', 'name': 'short'},
+            {'_id': 'Ggene_mid', 'start': 4000, 'length': 2000, 'type': 'gene', 'name': 'mid'},
+            {'_id': 'Ggene_in', 'start': 5500, 'length': 10, 'type': 'exon', 'name': 'in'},
+            {'_id': 'Ggene_after', 'start': 20000, 'length': 10, 'type': 'exon', 'name': 'after'},
+        ]
+        columns = TrackColumns(rows, ['_id', 'start', 'length', 'type', 'name'])
+        self.assertEqual(list(columns.max_ends), [10099, 10099, 10099, 10099, 20009])
+        in_range = columns.overlapping(5000, 6000)
+        self.assertEqual(in_range['name'], ['long', 'mid', 'in'])
+        self.assertEqual([d['_id'] for d in in_range.rows()], ['Ggene_long', 'Ggene_mid', 'Ggene_in'])
+        self.assertEqual(len(columns.overlapping(10100, 20000)), 0)
+        # the 'end' column is used when there is one, a feature ending at start_bp overlaps
+        ends = TrackColumns([{'start': 10, 'end': 50}, {'start': 20, 'end': 30}], ['start', 'end'])
+        self.assertEqual(list(ends.overlap_indices(50, 60)), [0])
+        self.assertEqual(list(ends.overlap_indices(31, 60)), [0])
+        self.assertEqual(list(ends.overlap_indices(30, 60)), [0, 1])
+        # without lengths, the rows are found by their start
+        self.assertEqual(columns.overlapping(0, 50).names, columns.names)
+        starts_only = TrackColumns([{'start': 1}, {'start': 5}], ['start'])
+        self.assertEqual(list(starts_only.overlap_indices(2, 6)), [1])
+        # same rows as checking every row
+        rng = np.random.RandomState(0)
+        random_rows = [{'start': int(s), 'length': int(l)} for s, l in zip(rng.randint(0, 100000, 500), rng.geometric(0.001, 500))]
+        random_columns = TrackColumns(random_rows, ['start', 'length'])
+        for start_bp in rng.randint(0, 100000, 50).tolist():
+            end_bp = start_bp + int(rng.randint(1, 5000))
+            expected = [i for i in range(len(random_columns))
+                        if random_columns.starts[i] < end_bp and random_columns.starts[i] + random_columns['length'][i] - 1 >= start_bp]
+            self.assertEqual(list(random_columns.overlap_indices(start_bp, end_bp)), expected)
+
+if __name__ == "__main__":
+    unittest.main()
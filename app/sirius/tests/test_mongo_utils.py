@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+
+import threading
+import unittest
+from sirius.tests.timed_test_case import TimedTestCase
+from sirius.mongo.utils import iter_id_batches, encoded_id_size, batched_lookup, batched_count, lookup_stats
+from sirius.mongo.utils import _lookup_pool, LOOKUP_POOL_WORKERS, LOOKUP_MAX_BATCH_IDS
+
+class ListCollection:
+    """ Minimal collection of documents in a list, supporting find() and count_documents() with an '_id' $in filter """
+    def __init__(self, docs):
+        self.docs = docs
+        self.n_finds = 0
+
+    def _match(self, mongo_filter):
+        ids = set(mongo_filter['_id']['$in'])
+        return [d for d in self.docs if d['_id'] in ids]
+
+    def find(self, mongo_filter, limit=0, projection=None):
+        self.n_finds += 1
+        result = self._match(mongo_filter)
+        return result[:limit] if limit > 0 else result
+
+    def count_documents(self, mongo_filter):
+        return len(self._match(mongo_filter))
+
+class MongoUtilsTest(TimedTestCase):
+    def test_iter_id_batches(self):
+        """ Test the id batches are sized by their encoded bytes and number of ids """
+        ids = [f'G{i:010d}' for i in range(100)]
+        batches = list(iter_id_batches(ids, max_bytes=200, max_ids=1000))
+        self.assertEqual(sum(batches, []), ids)
+        for batch in batches:
+            self.assertLessEqual(sum(encoded_id_size(i, one_id) for i, one_id in enumerate(batch)), 200)
+        batches = list(iter_id_batches(ids, max_ids=30))
+        self.assertEqual([len(b) for b in batches], [30, 30, 30, 10])
+
+    def test_batched_lookup(self):
+        """ Test batched_lookup() returns the documents in order, and stops issuing batches at the limit """
+        docs = [{'_id': f'G{i:05d}'} for i in range(250000)]
+        collection = ListCollection(docs)
+        ids = [d['_id'] for d in docs]
+        lookup_stats.reset()
+        self.assertEqual(list(batched_lookup(collection, ids)), docs)
+        self.assertEqual(collection.n_finds, 3)
+        self.assertEqual(lookup_stats.summary()['batches'], 3)
+        self.assertEqual(batched_count(collection, ids), 250000)
+        collection.n_finds = 0
+        result = list(batched_lookup(collection, ids, limit=10, concurrency=1))
+        self.assertEqual(result, docs[:10])
+        self.assertEqual(collection.n_finds, 1)
+
+    def test_batched_lookup_after_limit(self):
+        """ Test a batch that starts after the limit is reached is skipped, instead of fetched without a limit """
+        docs = [{'_id': f'G{i:06d}'} for i in range(250000)]
+        collection = ListCollection(docs)
+        limits = []
+        find = collection.find
+        def recording_find(mongo_filter, limit=0, projection=None):
+            limits.append(limit)
+            return find(mongo_filter, limit=limit, projection=projection)
+        collection.find = recording_find
+        # keep all the lookup threads but one busy, and queue a task between the first and the second batch
+        releases = [threading.Event() for _ in range(LOOKUP_POOL_WORKERS)]
+        for release in releases[1:]:
+            _lookup_pool.submit(release.wait)
+        finished = threading.Semaphore(0)
+        def ids():
+            for i, d in enumerate(docs):
+                if i == LOOKUP_MAX_BATCH_IDS + 1:
+                    _lookup_pool.submit(releases[0].wait)
+                yield d['_id']
+        result = batched_lookup(collection, ids(), limit=5, concurrency=4, on_batch=lambda *args: finished.release())
+        self.assertEqual(next(result), docs[0])
+        self.assertTrue(finished.acquire(timeout=5))
+        # the limit is reached, the next batches start now
+        for release in releases:
+            release.set()
+        for _ in range(2):
+            self.assertTrue(finished.acquire(timeout=5))
+        self.assertEqual(list(result), docs[1:5])
+        self.assertEqual(limits, [5])
+
+if __name__ == "__main__":
+    unittest.main()
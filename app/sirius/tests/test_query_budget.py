@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+
+import time
+import unittest
+from pymongo.errors import ExecutionTimeout
+from sirius.tests.timed_test_case import TimedTestCase
+from sirius.query.idset import IdSet
+from sirius.query.executor import QueryExecutor
+from sirius.query.query_tree import QueryTree
+from sirius.query.budget import QueryBudget, QueryTooExpensive, budget_checked, find_kwargs, command_kwargs
+
+class BudgetNode:
+    """ Fake query node whose findid() returns n_ids ids, or raises a MongoDB timeout """
+    def __init__(self, budget, n_ids=3, timeout=False):
+        self.budget = budget
+        self.n_ids = n_ids
+        self.timeout = timeout
+
+    @budget_checked
+    def findid(self, id_filter=None):
+        if self.timeout:
+            raise ExecutionTimeout('operation exceeded time limit')
+        return IdSet(f'G{i}' for i in range(self.n_ids))
+
+class QueryBudgetTest(TimedTestCase):
+    def test_kwargs(self):
+        """ Test the maxTimeMS keyword arguments follow the remaining time """
+        self.assertEqual(find_kwargs(None), {})
+        self.assertEqual(command_kwargs(None), {})
+        self.assertEqual(command_kwargs(None, 15000), {'maxTimeMS': 15000})
+        budget = QueryBudget(max_time_ms=1000)
+        self.assertTrue(0 < find_kwargs(budget)['max_time_ms'] <= 1000)
+        self.assertTrue(0 < command_kwargs(budget, 15000)['maxTimeMS'] <= 1000)
+        self.assertEqual(command_kwargs(budget, 10)['maxTimeMS'], 10)
+
+    def test_deadline(self):
+        """ Test a budget out of time is cancelled, and stays cancelled """
+        budget = QueryBudget(max_time_ms=10)
+        time.sleep(0.02)
+        with self.assertRaises(QueryTooExpensive) as cm:
+            budget.check()
+        self.assertEqual(cm.exception.to_dict()['reason'], 'time')
+        self.assertIs(budget.cancelled, cm.exception)
+        with self.assertRaises(QueryTooExpensive):
+            find_kwargs(budget)
+
+    def test_budget_checked(self):
+        """ Test budget_checked caps the id set size and converts MongoDB timeouts """
+        budget = QueryBudget(max_ids=5)
+        self.assertEqual(len(BudgetNode(budget).findid()), 3)
+        with self.assertRaises(QueryTooExpensive) as cm:
+            BudgetNode(budget, n_ids=6).findid()
+        self.assertEqual(cm.exception.reason, 'size')
+        # the other nodes of the cancelled query stop too
+        with self.assertRaises(QueryTooExpensive):
+            BudgetNode(budget).findid()
+        with self.assertRaises(QueryTooExpensive) as cm:
+            BudgetNode(QueryBudget(), timeout=True).findid()
+        self.assertEqual(cm.exception.reason, 'time')
+        # nodes without a budget are not checked
+        self.assertEqual(len(BudgetNode(None, n_ids=6).findid()), 6)
+
+    def test_executor_cancel(self):
+        """ Test a failed task of the QueryExecutor cancels the budget of its siblings """
+        executor = QueryExecutor()
+        executor.budget = QueryBudget()
+        def task(i):
+            if i == 1:
+                raise RuntimeError('failed')
+            return i
+        with self.assertRaises(RuntimeError):
+            executor.map(task, [0, 1])
+        with self.assertRaises(QueryTooExpensive) as cm:
+            executor.budget.check()
+        self.assertEqual(cm.exception.reason, 'error')
+
+    def test_query_tree_budget(self):
+        """ Test QueryTree has no budget unless one is given, so exports and cache builds are not limited """
+        query = {'type': 'GenomeNode', 'filters': {'type': 'SNP'}, 'toEdges': [{'type': 'EdgeNode', 'filters': {}}]}
+        self.assertIsNone(QueryTree(query).head.budget)
+        budget = QueryBudget()
+        qt = QueryTree(query, budget=budget)
+        self.assertIs(qt.executor.budget, budget)
+        self.assertTrue(all(node.budget is budget for node in qt.iter_nodes()))
+
+if __name__ == "__main__":
+    unittest.main()
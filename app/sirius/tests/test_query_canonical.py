@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+
+import unittest
+from sirius.tests.timed_test_case import TimedTestCase
+from sirius.query.canonical import CanonicalQuery, canonicalize
+from sirius.core.utilities import threadsafe_lru
+
+def edge(name):
+    return {'type': 'EdgeNode', 'filters': {'type': 'association:snp:trait'}, 'toNode': {'type': 'InfoNode', 'filters': {'name': name}}}
+
+class CanonicalQueryTest(TimedTestCase):
+    def test_equivalent_queries(self):
+        """ Test equivalent queries have the same canonical form and digest """
+        q1 = {'type': 'GenomeNode', 'filters': {'type': 'SNP', 'contig': {'$in': ['chr2', 'chr1', 'chr1']}}, 'toEdges': [edge('a'), edge('b')]}
+        q2 = {'type': 'GenomeNode', 'filters': {'contig': {'$in': ['chr1', 'chr2']}, 'type': 'SNP'}, 'toEdges': [edge('b'), edge('a')],
+              'edgeRule': 'and', 'limit': 100000}
+        self.assertEqual(canonicalize(q1), canonicalize(q2))
+        self.assertEqual(CanonicalQuery(q1).digest, CanonicalQuery(q2).digest)
+        self.assertEqual(hash(CanonicalQuery(q1)), hash(CanonicalQuery(q2)))
+        self.assertEqual(canonicalize(canonicalize(q1)), canonicalize(q1))
+        # the input is not modified
+        self.assertNotIn('limit', q1)
+        self.assertEqual(q1['filters']['contig']['$in'], ['chr2', 'chr1', 'chr1'])
+
+    def test_different_queries(self):
+        """ Test the base edge of a 'not' query and explicit non-default values are kept """
+        q1 = {'type': 'GenomeNode', 'filters': {}, 'toEdges': [edge('a'), edge('b')], 'edgeRule': 'not'}
+        q2 = {'type': 'GenomeNode', 'filters': {}, 'toEdges': [edge('b'), edge('a')], 'edgeRule': 'not'}
+        self.assertNotEqual(CanonicalQuery(q1), CanonicalQuery(q2))
+        q3 = {'type': 'GenomeNode', 'filters': {}, 'limit': 10}
+        q4 = {'type': 'GenomeNode', 'filters': {}}
+        self.assertNotEqual(CanonicalQuery(q3), CanonicalQuery(q4))
+
+    def test_cache_key(self):
+        """ Test threadsafe_lru caches hit for equivalent queries """
+        calls = []
+        @threadsafe_lru(maxsize=8)
+        def cached(query):
+            calls.append(query)
+            return len(calls)
+        cached(CanonicalQuery({'type': 'InfoNode', 'filters': {'name': {'$in': ['x', 'y']}}}))
+        cached(CanonicalQuery({'type': 'InfoNode', 'filters': {'name': {'$in': ['y', 'x']}}, 'edgeRule': 'and'}))
+        self.assertEqual(len(calls), 1)
+
+if __name__ == "__main__":
+    unittest.main()
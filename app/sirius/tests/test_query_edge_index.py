@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+
+import os
+import tempfile
+import unittest
+import numpy as np
+from sirius.tests.timed_test_case import TimedTestCase
+from sirius.query.edge_index import EdgeIndex
+from sirius.query.idset import IdSet
+
+class QueryEdgeIndexTest(TimedTestCase):
+    docs = [
+        {'from_id': 'Gsnp_rs1', 'to_id': 'Itrait1', 'type': 'association', 'source': ['GWAS'], 'info': {'p-value': 1e-8}},
+        {'from_id': 'Gsnp_rs1', 'to_id': 'Itrait2', 'type': 'association', 'source': ['GWAS'], 'info': {'p-value': 0.01}},
+        {'from_id': 'Gsnp_rs2', 'to_id': 'Itrait1', 'type': 'association', 'source': ['GWAS'], 'info': {'p-value': 0.5}},
+        {'from_id': 'Gsnp_rs3', 'to_id': 'Igene1', 'type': 'eqtl', 'source': ['GTEx'], 'info': {}},
+    ]
+
+    def test_filter_edges(self):
+        """ Test EdgeIndex.filter_edges() matches the filters like MongoDB, and supports() rejects other fields """
+        index = EdgeIndex.from_documents(self.docs)
+        self.assertEqual(len(index), 4)
+        self.assertEqual(list(index.filter_edges({'type': 'association', 'info.p-value': {'$lt': 0.05}})), [0, 1])
+        self.assertEqual(list(index.filter_edges({'source': 'GTEx'})), [3])
+        self.assertEqual(list(index.filter_edges({'source': {'$nin': ['GWAS']}, 'info.p-value': {'$ne': 0.5}})), [3])
+        self.assertTrue(index.supports({'type': {'$in': ['eqtl']}, 'info.p-value': {'$lte': 1e-5}}))
+        self.assertFalse(index.supports({'info.biosample': 'liver'}))
+        self.assertFalse(index.supports({'type': {'$regex': 'assoc'}}))
+
+    def test_traversal(self):
+        """ Test the CSR gathers of the edges from and to a set of ids, and saving and loading a snapshot """
+        index = EdgeIndex.from_documents(self.docs)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'edges.npz')
+            index.save(path)
+            loaded = EdgeIndex.load(path)
+        for idx in (index, loaded):
+            edges = idx.edges_from(IdSet(['Gsnp_rs1', 'Gsnp_rs3']))
+            self.assertEqual(sorted(edges), [0, 1, 3])
+            self.assertEqual(set(idx.end_ids(edges, 'to')), {'Itrait1', 'Itrait2', 'Igene1'})
+            edges = idx.edges_to(IdSet(['Itrait1']))
+            self.assertEqual(set(idx.end_ids(edges, 'from')), {'Gsnp_rs1', 'Gsnp_rs2'})
+            edges = idx.edges_from(IdSet(['Itrait1']), reverse=True)
+            self.assertEqual(sorted(edges), [0, 2])
+            self.assertEqual(len(idx.edges_from(IdSet(['Gsnp_never_seen']))), 0)
+            self.assertEqual(list(idx.filter_edges({'source': 'GWAS'}, np.array([3, 2]))), [2])
+
+if __name__ == "__main__":
+    unittest.main()
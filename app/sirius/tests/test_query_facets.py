@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+
+import unittest
+from sirius.tests.timed_test_case import TimedTestCase
+from sirius.query.canonical import CanonicalQuery
+from sirius.query.facets import facet_table_for_query, facet_table_id, build_facet_tables
+
+def get_field(doc, path):
+    for key in path.split('.'):
+        doc = doc.get(key) if isinstance(doc, dict) else None
+    return doc
+
+class PipelineCollection:
+    """ Minimal collection of documents in a list, with distinct() and the $project, $unwind and $group stages of aggregate() """
+    def __init__(self, docs=(), name='', database=None):
+        self.docs = list(docs)
+        self.name = name
+        self.database = database
+        self.n_aggregates = 0
+
+    def distinct(self, key):
+        values = []
+        for d in self.docs:
+            value = get_field(d, key)
+            for v in value if isinstance(value, list) else [value]:
+                if v is not None and v not in values:
+                    values.append(v)
+        return values
+
+    def aggregate(self, pipeline, allowDiskUse=False):
+        self.n_aggregates += 1
+        docs = self.docs
+        for stage in pipeline:
+            op, spec = next(iter(stage.items()))
+            if op == '$project':
+                docs = [{k: get_field(d, v[1:]) for k, v in spec.items()} for d in docs]
+            elif op == '$unwind':
+                field = spec[1:]
+                docs = [dict(d, **{field: v}) for d in docs if d.get(field) not in (None, [])
+                        for v in (d[field] if isinstance(d[field], list) else [d[field]])]
+            elif op == '$group':
+                counts = dict()
+                for d in docs:
+                    key = d[spec['_id'][1:]] if isinstance(spec['_id'], str) else tuple((k, d[v[1:]]) for k, v in spec['_id'].items())
+                    counts[key] = counts.get(key, 0) + 1
+                docs = [{'_id': dict(key) if isinstance(key, tuple) else key, 'count': n} for key, n in counts.items()]
+        return docs
+
+    def drop(self):
+        self.database.pop(self.name, None)
+
+    def insert_many(self, docs):
+        self.docs += docs
+        self.database[self.name] = self
+
+    def rename(self, name, dropTarget=False):
+        self.database.pop(self.name)
+        self.name = name
+        self.database[name] = self
+
+class Database(dict):
+    def __missing__(self, name):
+        return PipelineCollection(name=name, database=self)
+
+class FacetsTest(TimedTestCase):
+    def test_facet_table_for_query(self):
+        """ Test only queries with no filter or a single simple filter are answered by facet tables """
+        query = CanonicalQuery({'type': 'GenomeNode', 'filters': {}})
+        self.assertEqual(facet_table_for_query(query, 'info.biosample'), facet_table_id('GenomeNode', 'info.biosample'))
+        query = CanonicalQuery({'type': 'EdgeNode', 'filters': {'type': 'association:snp:trait'}})
+        self.assertEqual(facet_table_for_query(query, 'source'), 'EdgeNode|source|type=association:snp:trait')
+        # index without facet table
+        self.assertIsNone(facet_table_for_query(query, 'info.p-value'))
+        # filters on other keys, or with operators
+        self.assertIsNone(facet_table_for_query(CanonicalQuery({'type': 'GenomeNode', 'filters': {'name': 'BRCA1'}}), 'type'))
+        self.assertIsNone(facet_table_for_query(CanonicalQuery({'type': 'GenomeNode', 'filters': {'type': {'$in': ['SNP']}}}), 'source'))
+        # queries with edges
+        query = CanonicalQuery({'type': 'GenomeNode', 'filters': {}, 'toEdges': [{'type': 'EdgeNode', 'filters': {}}]})
+        self.assertIsNone(facet_table_for_query(query, 'type'))
+
+    def test_build_facet_tables(self):
+        """ Test build_facet_tables() counts the values for all filter values with one aggregation per index and filter key """
+        nodes = PipelineCollection([
+            {'type': 'SNP', 'source': ['dbSNP', 'GWAS'], 'info': {'biosample': 'liver'}},
+            {'type': 'SNP', 'source': 'dbSNP', 'info': {'biosample': ['liver', 'lung']}},
+            {'type': 'gene', 'source': 'ENSEMBL'},
+        ])
+        database = Database()
+        facets_collection = database['Facets']
+        n_tables = build_facet_tables(verbose=False, collections={'GenomeNode': nodes}, facets_collection=facets_collection)
+        # 4 indices, each with no filter and 5 filter values
+        self.assertEqual(n_tables, 24)
+        self.assertEqual(nodes.n_aggregates, 4 * 3)
+        self.assertEqual(set(database), {'Facets'})
+        tables = {d['_id']: {v['value']: v['count'] for v in d['values']} for d in database['Facets'].docs}
+        self.assertEqual(tables['GenomeNode|info.biosample'], {'liver': 2, 'lung': 1})
+        self.assertEqual(tables['GenomeNode|info.biosample|source=GWAS'], {'liver': 1})
+        self.assertEqual(tables['GenomeNode|source|type=SNP'], {'dbSNP': 2, 'GWAS': 1})
+        self.assertEqual(tables['GenomeNode|info.biosample|type=gene'], {})
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+
+import gc
+import weakref
+import unittest
+from sirius.tests.timed_test_case import TimedTestCase
+from sirius.query import idset
+from sirius.query.idset import IdSet, IdDictionary, current_dictionary
+
+class QueryIdSetTest(TimedTestCase):
+    ids1 = ['Gsnp_rs1', 'Gsnp_rs2', 'Gsnp_rs3', 'Gsnp_rs3']
+    ids2 = ['Gsnp_rs2', 'Gsnp_rs3', 'Gsnp_rs4']
+
+    def test_id_dictionary(self):
+        """ Test IdDictionary.encode() and IdDictionary.decode() """
+        id_dict = IdDictionary()
+        codes = id_dict.encode(self.ids1)
+        self.assertEqual(list(codes), [0, 1, 2, 2])
+        self.assertEqual(id_dict.decode(codes), self.ids1)
+        self.assertEqual(len(id_dict), 3)
+        self.assertEqual(id_dict.lookup('Gsnp_rs4'), None)
+
+    def test_idset_init_len(self):
+        """ Test IdSet.__init__(), IdSet.__len__() and IdSet.__contains__() """
+        self.assertEqual(len(IdSet()), 0)
+        self.assertFalse(IdSet())
+        s1 = IdSet(self.ids1)
+        self.assertEqual(len(s1), 3)
+        self.assertEqual(set(s1), set(self.ids1))
+        self.assertIn('Gsnp_rs1', s1)
+        self.assertNotIn('Gsnp_rs4', s1)
+        self.assertNotIn('Gsnp_never_seen', s1)
+
+    def test_idset_operators(self):
+        """ Test IdSet and/or/not operators """
+        s1, s2 = IdSet(self.ids1), IdSet(self.ids2)
+        self.assertEqual(set(s1 & s2), set(self.ids1) & set(self.ids2))
+        self.assertEqual(set(s1 | s2), set(self.ids1) | set(self.ids2))
+        self.assertEqual(set(s1 - s2), set(self.ids1) - set(self.ids2))
+        # operations with plain iterables of strings
+        self.assertEqual(set(s1 & set(self.ids2)), set(self.ids1) & set(self.ids2))
+        s1 -= self.ids2
+        self.assertEqual(s1, IdSet(['Gsnp_rs1']))
+
+    def test_dictionary_generations(self):
+        """ Test a full dictionary is replaced, the IdSets of both work together, and the old one is freed with its IdSets """
+        original_max_ids = idset.ID_DICTIONARY_MAX_IDS
+        try:
+            # s1 and s2 both start a new dictionary
+            idset.ID_DICTIONARY_MAX_IDS = len(current_dictionary())
+            s1 = IdSet(self.ids1)
+            old_dictionary = weakref.ref(s1.dictionary)
+            idset.ID_DICTIONARY_MAX_IDS = len(s1.dictionary)
+            s2 = IdSet(self.ids2)
+            self.assertIsNot(s2.dictionary, s1.dictionary)
+            idset.ID_DICTIONARY_MAX_IDS = original_max_ids
+            self.assertEqual(set(s1 & s2), set(self.ids1) & set(self.ids2))
+            self.assertEqual(set(s1 | s2), set(self.ids1) | set(self.ids2))
+            self.assertEqual(s1 - s2, IdSet(['Gsnp_rs1']))
+            other_dictionary = IdDictionary()
+            other_dictionary.encode(['Gsnp_rs3', 'Gsnp_rs4'])
+            self.assertEqual(s1.codes_in(other_dictionary, add=False).tolist(), [0])
+            s1 &= s2
+            self.assertIs(s1.dictionary, s2.dictionary)
+            gc.collect()
+            self.assertIsNone(old_dictionary())
+        finally:
+            idset.ID_DICTIONARY_MAX_IDS = original_max_ids
+
+if __name__ == "__main__":
+    unittest.main()
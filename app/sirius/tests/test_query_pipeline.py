@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+
+import unittest
+from types import SimpleNamespace
+from sirius.tests.timed_test_case import TimedTestCase
+from sirius.query.matching import match_condition, get_path
+from sirius.query.query_tree import QueryTree
+from sirius.query.query_edge import QueryEdge
+from sirius.query.genome_query_node import GenomeQueryNode
+from sirius.query.pipeline import compile_pipeline, edge_rule_match
+
+database = SimpleNamespace(name='sirius', collections=dict())
+
+def resolve(value, doc, variables):
+    """ The value of a field path '$field' or a variable '$$var' in an aggregation expression """
+    if isinstance(value, str) and value.startswith('$$'):
+        return variables[value[2:]]
+    if isinstance(value, str) and value.startswith('$'):
+        return get_path(doc, value[1:])
+    return value
+
+def match_stage(doc, mongo_filter, variables):
+    for key, condition in mongo_filter.items():
+        if key == '$and':
+            matched = all(match_stage(doc, f, variables) for f in condition)
+        elif key == '$or':
+            matched = any(match_stage(doc, f, variables) for f in condition)
+        elif key == '$expr':
+            a, b = condition['$eq']
+            matched = resolve(a, doc, variables) == resolve(b, doc, variables)
+        elif isinstance(condition, dict) and '$size' in condition:
+            matched = len(get_path(doc, key)) == condition['$size']
+        else:
+            matched = match_condition(get_path(doc, key), condition)
+        if not matched:
+            return False
+    return True
+
+class LookupCollection:
+    """
+    Collection stand-in with find() and count_documents(), and the stages of aggregate() that compile_pipeline() generates,
+    including the nested $lookup stages with 'let' variables.
+    """
+    def __init__(self, name, docs):
+        self.name = name
+        self.docs = sorted(docs, key=lambda d: d['_id'])
+        self.database = database
+        self.n_counts = 0
+        database.collections[name] = self
+
+    def find(self, mongo_filter=None, projection=None, limit=0, **kwargs):
+        docs = [dict(d) for d in self.docs if match_stage(d, mongo_filter or {}, {})]
+        return docs[:limit] if limit > 0 else docs
+
+    def find_one(self, mongo_filter=None, projection=None, **kwargs):
+        docs = self.find(mongo_filter, limit=1)
+        return docs[0] if docs else None
+
+    def count_documents(self, mongo_filter, limit=0, **kwargs):
+        self.n_counts += 1
+        return len(self.find(mongo_filter, limit=limit))
+
+    def estimated_document_count(self):
+        return len(self.docs)
+
+    def aggregate(self, pipeline, variables=None, **kwargs):
+        docs = [dict(d) for d in self.docs]
+        for stage in pipeline:
+            (op, spec), = stage.items()
+            if op == '$match':
+                docs = [d for d in docs if match_stage(d, spec, variables or {})]
+            elif op == '$sort':
+                docs.sort(key=lambda d: d['_id'])
+            elif op == '$limit':
+                docs = docs[:spec]
+            elif op == '$lookup':
+                other = database.collections[spec['from']]
+                for d in docs:
+                    lookup_variables = {k: resolve(v, d, variables or {}) for k, v in spec['let'].items()}
+                    d[spec['as']] = other.aggregate(spec['pipeline'], variables=lookup_variables)
+            elif op == '$project':
+                if all(spec.values()):
+                    docs = [{k: v for k, v in d.items() if k in spec or k == '_id'} for d in docs]
+                else:
+                    docs = [{k: v for k, v in d.items() if k not in spec} for d in docs]
+            elif op == '$count':
+                docs = [{spec: len(docs)}]
+            else:
+                raise NotImplementedError(op)
+        return docs
+
+genome_nodes = LookupCollection('GenomeNodes', [{'_id': f'G{i}', 'type': 'SNP' if i % 2 else 'gene'} for i in range(1, 9)])
+info_nodes = LookupCollection('InfoNodes', [{'_id': 'Iheight', 'type': 'trait'}, {'_id': 'Iweight', 'type': 'trait'}, {'_id': 'Iliver', 'type': 'tissue'}])
+edges = LookupCollection('Edges', [
+    {'_id': f'E{i}', 'from_id': from_id, 'to_id': to_id, 'type': typ}
+    for i, (from_id, to_id, typ) in enumerate([
+        ('G1', 'Iheight', 'association'), ('G2', 'Iheight', 'association'), ('G2', 'Iweight', 'association'),
+        ('G3', 'Iweight', 'association'), ('G5', 'Iheight', 'association'), ('G3', 'Iliver', 'eqtl'),
+        ('G6', 'Iliver', 'eqtl'), ('G7', 'Iliver', 'eqtl'), ('G1', 'Iliver', 'eqtl'),
+    ])
+])
+
+def query_tree(query, backend):
+    """ Build a QueryTree on the stand-in collections """
+    qt = QueryTree(query, backend=backend)
+    for node in qt.iter_nodes():
+        if isinstance(node, QueryEdge):
+            node.mongo_collection = edges
+        elif isinstance(node, GenomeQueryNode):
+            node.mongo_collection = genome_nodes
+        else:
+            node.mongo_collection = info_nodes
+        # the results of the stand-in collections should not be shared through the subtree cache
+        node.cache_key = None
+    return qt
+
+def trait_edge(name, typ='association'):
+    return {'type': 'EdgeNode', 'filters': {'type': typ}, 'toNode': {'type': 'InfoNode', 'filters': {'_id': 'I' + name}}}
+
+class QueryPipelineTest(TimedTestCase):
+    def test_edge_rule_match(self):
+        """ Test the $match condition of each edge rule on the looked-up edge arrays """
+        self.assertEqual(edge_rule_match(['_e0_0', '_e0_1'], 0), {'_e0_0': {'$ne': []}, '_e0_1': {'$ne': []}})
+        self.assertEqual(edge_rule_match(['_e0_0', '_e0_1'], 1), {'$or': [{'_e0_0': {'$ne': []}}, {'_e0_1': {'$ne': []}}]})
+        self.assertEqual(edge_rule_match(['_e0_0', '_e0_1', '_e0_2'], 2), {'_e0_0': {'$ne': []}, '_e0_1': {'$size': 0}, '_e0_2': {'$size': 0}})
+        with self.assertRaises(ValueError):
+            edge_rule_match(['_e0_0'], 3)
+
+    def test_compile_pipeline(self):
+        """ Test the stages compiled for a node with an edge to an info node """
+        query = {'type': 'GenomeNode', 'filters': {'type': 'SNP'}, 'toEdges': [trait_edge('height')], 'limit': 10}
+        head = query_tree(query, 'pipeline').head
+        pipeline = compile_pipeline(head, projection=['_id', 'type'], start_after='G1', sort_by_id=True, limit=5, offset=2)
+        self.assertEqual(pipeline[0], {'$match': {'$and': [{'type': 'SNP'}, {'_id': {'$gt': 'G1'}}]}})
+        self.assertEqual(pipeline[1], {'$sort': {'_id': 1}})
+        lookup = pipeline[2]['$lookup']
+        self.assertEqual((lookup['from'], lookup['let'], lookup['as']), ('Edges', {'nid0': '$_id'}, '_e0_0'))
+        edge_stages = lookup['pipeline']
+        self.assertEqual(edge_stages[0], {'$match': {'$and': [{'type': 'association'}, {'$expr': {'$eq': ['$from_id', '$$nid0']}}]}})
+        node_lookup = edge_stages[1]['$lookup']
+        self.assertEqual((node_lookup['from'], node_lookup['let']), ('InfoNodes', {'tid1': '$to_id'}))
+        self.assertEqual(node_lookup['pipeline'][0], {'$match': {'$and': [{'_id': 'Iheight'}, {'$expr': {'$eq': ['$_id', '$$tid1']}}]}})
+        self.assertEqual(edge_stages[2:], [{'$match': {'_n': {'$ne': []}}}, {'$limit': 1}, {'$project': {'_id': 1}}])
+        self.assertEqual(pipeline[3], {'$match': {'_e0_0': {'$ne': []}}})
+        # the head limit of 10 is shared with the 2 results before start_after
+        self.assertEqual(pipeline[4], {'$limit': 5})
+        self.assertEqual(pipeline[5], {'$project': {'_id': 1, 'type': 1}})
+        pipeline = compile_pipeline(head, offset=8)
+        self.assertEqual(pipeline[-2:], [{'$limit': 2}, {'$project': {'_e0_0': 0}}])
+
+    def test_pipeline_results(self):
+        """ Test the pipeline and python backends find the same results for queries with edges """
+        queries = [
+            {'type': 'GenomeNode', 'filters': {}, 'toEdges': [trait_edge('height')]},
+            {'type': 'GenomeNode', 'filters': {}, 'toEdges': [trait_edge('height'), trait_edge('liver', 'eqtl')], 'edgeRule': 'and'},
+            {'type': 'GenomeNode', 'filters': {}, 'toEdges': [trait_edge('weight'), trait_edge('liver', 'eqtl')], 'edgeRule': 'or'},
+            {'type': 'GenomeNode', 'filters': {}, 'toEdges': [trait_edge('liver', 'eqtl'), trait_edge('height')], 'edgeRule': 'not'},
+            {'type': 'GenomeNode', 'filters': {'type': 'SNP'}, 'toEdges': [{'type': 'EdgeNode', 'filters': {}}]},
+            {'type': 'InfoNode', 'filters': {'type': 'trait'}, 'toEdges': [{'type': 'EdgeNode', 'filters': {}, 'reverse': True,
+                'toNode': {'type': 'GenomeNode', 'filters': {'type': 'gene'}}}]},
+        ]
+        expected = [['G1', 'G2', 'G5'], ['G1'], ['G1', 'G2', 'G3', 'G6', 'G7'], ['G3', 'G6', 'G7'], ['G1', 'G3', 'G5', 'G7'], ['Iheight', 'Iweight']]
+        for query, expected_ids in zip(queries, expected):
+            results = dict()
+            for backend in ('pipeline', 'python'):
+                qt = query_tree(query, backend)
+                results[backend] = sorted(d['_id'] for d in qt.find())
+                self.assertEqual(qt.count(), len(expected_ids))
+            self.assertEqual(results['pipeline'], expected_ids)
+            self.assertEqual(results['python'], expected_ids)
+
+    def test_backend_decided_once(self):
+        """ Test the 'auto' backend counts the head results once for all the calls of a QueryTree """
+        query = {'type': 'GenomeNode', 'filters': {'type': 'SNP'}, 'toEdges': [trait_edge('height')]}
+        qt = query_tree(query, 'auto')
+        n_counts = genome_nodes.n_counts
+        self.assertTrue(qt.use_pipeline())
+        self.assertEqual(genome_nodes.n_counts, n_counts + 1)
+        list(qt.find())
+        list(qt.find_sorted(start_after='G1', limit=2))
+        qt.count()
+        self.assertEqual(genome_nodes.n_counts, n_counts + 1)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+
+import unittest
+from sirius.tests.timed_test_case import TimedTestCase
+from sirius.query.idset import IdSet
+from sirius.query.planner import bounded_id_set, intersect_id_filter_set, exclusion_mask, estimate_cardinality
+
+class CountingCollection:
+    """ Collection stand-in returning the same documents for any filter, counting the calls of each method """
+    def __init__(self, docs):
+        self.docs = docs
+        self.calls = []
+
+    def find(self, *args, **kwargs):
+        self.calls.append('find')
+        return list(self.docs)
+
+    def count_documents(self, *args, **kwargs):
+        self.calls.append('count_documents')
+        return len(self.docs)
+
+    def estimated_document_count(self):
+        return len(self.docs)
+
+class StandInNode:
+    """ The attributes of a query node read by estimate_cardinality() """
+    def __init__(self, mongo_collection, edges=None, arithmetics=None):
+        self.mongo_collection = mongo_collection
+        self.filter = {'type': 'gene'}
+        self.edges = edges or []
+        self.edge_rule = 0
+        self.arithmetics = arithmetics or []
+        self.limit = 0
+
+    def findid(self):
+        raise AssertionError("estimate_cardinality() should not evaluate a node")
+
+class StandInEdge(StandInNode):
+    def __init__(self, mongo_collection, nextnode):
+        super().__init__(mongo_collection)
+        self.nextnode = nextnode
+        self.reverse = False
+
+class QueryPlannerTest(TimedTestCase):
+    def test_bounded_id_set(self):
+        """ Test bounded_id_set() combines the '_id' condition of a filter with the id_filter of the parent """
+        self.assertIsNone(bounded_id_set({'type': 'SNP'}))
+        self.assertIsNone(bounded_id_set({'_id': {'$ne': 'Gsnp_rs1'}}))
+        self.assertEqual(set(bounded_id_set({'_id': 'Gsnp_rs1'})), {'Gsnp_rs1'})
+        self.assertEqual(set(bounded_id_set({'_id': {'$in': ['Gsnp_rs1', 'Gsnp_rs2']}}, IdSet(['Gsnp_rs2', 'Gsnp_rs3']))), {'Gsnp_rs2'})
+        self.assertEqual(set(bounded_id_set({}, IdSet(['Gsnp_rs3']))), {'Gsnp_rs3'})
+
+    def test_intersect_id_filter_set(self):
+        """ Test intersect_id_filter_set() keeps the intersection with the '_id' condition, and unsupported conditions in the filter """
+        id_set = IdSet(['Gsnp_rs1', 'Gsnp_rs2', 'Gsnp_rs3'])
+        ids, mongo_filter = intersect_id_filter_set({'type': 'SNP', '_id': {'$in': ['Gsnp_rs1', 'Gsnp_rs2', 'Gsnp_rs4']}}, id_set)
+        self.assertEqual(sorted(ids), ['Gsnp_rs1', 'Gsnp_rs2'])
+        self.assertEqual(mongo_filter, {'type': 'SNP'})
+        ids, mongo_filter = intersect_id_filter_set({'_id': {'$in': ['Gsnp_rs1', 'Gsnp_rs2'], '$ne': 'Gsnp_rs2'}}, id_set)
+        self.assertEqual(ids, ['Gsnp_rs1'])
+        ids, mongo_filter = intersect_id_filter_set({'_id': 'Gsnp_rs4'}, id_set)
+        self.assertEqual(ids, [])
+        ids, mongo_filter = intersect_id_filter_set({'_id': {'$regex': '^Gsnp'}}, id_set)
+        self.assertEqual(sorted(ids), sorted(id_set))
+        self.assertEqual(mongo_filter, {'_id': {'$regex': '^Gsnp'}})
+
+    def test_exclusion_mask(self):
+        """ Test exclusion_mask() marks the base ids found in the stream, including repeated and unknown ids """
+        base_ids = IdSet([f'Gsnp_rs{i}' for i in range(20)])
+        excluded = ['Gsnp_rs3', 'Gsnp_rs3', 'Gsnp_rs17', 'Gsnp_not_in_base', 'Ithe_id_never_encoded'] + [f'Gsnp_rs{i}' for i in range(10, 15)]
+        mask = exclusion_mask(base_ids, iter(excluded), chunk_size=3)
+        self.assertEqual(len(mask), len(base_ids))
+        marked = {one_id for one_id, m in zip(base_ids, mask) if m}
+        self.assertEqual(marked, {'Gsnp_rs3', 'Gsnp_rs17', 'Gsnp_rs10', 'Gsnp_rs11', 'Gsnp_rs12', 'Gsnp_rs13', 'Gsnp_rs14'})
+
+    def test_estimate_probe(self):
+        """ Test estimate_cardinality() fetches the ids of a small next node only if it has no edges or arithmetics """
+        genes = CountingCollection([{'_id': 'Gsnp_rs1'}, {'_id': 'Gsnp_rs2'}])
+        edges = CountingCollection([{'_id': f'E{i}'} for i in range(5)])
+        self.assertEqual(estimate_cardinality(StandInEdge(edges, StandInNode(genes))), 5)
+        self.assertEqual(genes.calls, ['count_documents', 'find'])
+        self.assertEqual(edges.calls, ['count_documents', 'count_documents'])
+        # the next node has edges of its own, its estimate is used without evaluating it
+        genes.calls, edges.calls = [], []
+        inner_edge = StandInEdge(CountingCollection([{'_id': 'E0'}]), StandInNode(CountingCollection([{'_id': 'Iinfo'}])))
+        self.assertEqual(estimate_cardinality(StandInEdge(edges, StandInNode(genes, edges=[inner_edge]))), 5)
+        self.assertNotIn('find', genes.calls)
+        self.assertEqual(edges.calls, ['count_documents'])
+        # the estimate of a next node with arithmetics is unknown
+        genes.calls, edges.calls = [], []
+        self.assertEqual(estimate_cardinality(StandInEdge(edges, StandInNode(genes, arithmetics=[{'operator': 'union'}]))), 5)
+        self.assertNotIn('find', genes.calls)
+
+if __name__ == "__main__":
+    unittest.main()
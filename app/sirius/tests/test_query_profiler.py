@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+
+import unittest
+from sirius.tests.timed_test_case import TimedTestCase
+from sirius.query.query_tree import QueryTree
+from sirius.query.profiler import QueryProfiler, ProfiledCollection, profiled
+
+class ExplainedCursor(list):
+    """ List of documents with the explain() of a pymongo Cursor """
+    def explain(self):
+        return {'executionStats': {'totalDocsExamined': 10, 'totalKeysExamined': 4}}
+
+class MockCollection:
+    """ Minimal collection returning the same documents for any find() """
+    def __init__(self, docs):
+        self.docs = docs
+        self.name = 'GenomeNodes'
+
+    def find(self, *args, **kwargs):
+        return ExplainedCursor(self.docs)
+
+    def find_one(self, *args, **kwargs):
+        return self.docs[0] if self.docs else None
+
+    def count_documents(self, *args, **kwargs):
+        return len(self.docs)
+
+class ProfiledNode:
+    def __init__(self, profiler):
+        self.profiler = profiler
+
+    @profiled
+    def findid(self):
+        return {'Gsnp_rs1', 'Gsnp_rs2'}
+
+class QueryProfilerTest(TimedTestCase):
+    docs = [{'_id': 'Gsnp_rs1'}, {'_id': 'Gsnp_rs2'}, {'_id': 'Gsnp_rs3'}]
+
+    def test_profiled_collection(self):
+        """ Test ProfiledCollection counts the round trips of a node, and explains its first find() """
+        profiler = QueryProfiler()
+        node = object()
+        collection = ProfiledCollection(MockCollection(self.docs), profiler, node)
+        self.assertEqual(len(collection.find({})), 3)
+        collection.find({})
+        collection.find_one({})
+        self.assertEqual(collection.count_documents({}), 3)
+        # other attributes are from the collection
+        self.assertEqual(collection.name, 'GenomeNodes')
+        stats = profiler.stats[id(node)]
+        self.assertEqual(stats['mongo_round_trips'], 4)
+        self.assertEqual(stats['docs_examined'], 10)
+        self.assertEqual(stats['keys_examined'], 4)
+
+    def test_profiled(self):
+        """ Test profiled records the calls, wall time and id set size of a node """
+        profiler = QueryProfiler()
+        node = ProfiledNode(profiler)
+        node.findid()
+        node.findid()
+        stats = profiler.stats[id(node)]
+        self.assertEqual(stats['calls'], 2)
+        self.assertEqual(stats['id_set_size'], 4)
+        self.assertGreaterEqual(stats['wall_time'], 0)
+        # set() keeps the values already recorded
+        profiler.set(node, wall_time=100, n_results=3)
+        self.assertLess(stats['wall_time'], 100)
+        self.assertEqual(stats['n_results'], 3)
+
+    def test_explain(self):
+        """ Test the plan of QueryTree.explain() has the statistics of the executed nodes """
+        qt = QueryTree({'type': 'GenomeNode', 'filters': {'type': 'SNP'}}, backend='python', profile=True)
+        qt.head.mongo_collection = ProfiledCollection(MockCollection(self.docs), qt.profiler, qt.head)
+        result = qt.explain()
+        self.assertEqual(result['backend'], 'python')
+        self.assertEqual(result['n_results'], 3)
+        plan = result['plan']
+        self.assertEqual(plan['node'], 'GenomeQueryNode')
+        self.assertEqual(plan['filter'], {'type': 'SNP'})
+        self.assertEqual(plan['toEdges'], [])
+        self.assertEqual(plan['stats']['mongo_round_trips'], 1)
+        self.assertEqual(plan['stats']['docs_examined'], 10)
+        self.assertEqual(plan['stats']['n_results'], 3)
+        self.assertLessEqual(plan['stats']['wall_time'], result['wall_time'])
+
+if __name__ == "__main__":
+    unittest.main()
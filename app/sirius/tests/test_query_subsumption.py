@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+
+import unittest
+from sirius.tests.timed_test_case import TimedTestCase
+from sirius.query.canonical import CanonicalQuery
+from sirius.query.matching import match_filter, filter_fields, UnsupportedFilter
+from sirius.query.subsumption import residual_filter, SubsumptionIndex
+
+class SubsumptionTest(TimedTestCase):
+    def test_match_filter(self):
+        """ Test match_filter() follows MongoDB semantics for the supported operators """
+        doc = {'type': 'Enhancer-like', 'start': 100, 'info': {'biosample': 'liver', 'targets': ['CTCF', 'POLR2A']}}
+        self.assertTrue(match_filter(doc, {'type': 'Enhancer-like', 'start': {'$gte': 100, '$lt': 200}}))
+        self.assertFalse(match_filter(doc, {'start': {'$gt': 100}}))
+        self.assertTrue(match_filter(doc, {'info.targets': 'CTCF', 'info.biosample': {'$in': ['liver', 'lung']}}))
+        self.assertTrue(match_filter(doc, {'info.targets': {'$nin': ['EP300']}, 'name': {'$exists': False}}))
+        self.assertFalse(match_filter(doc, {'info.targets': {'$ne': 'CTCF'}}))
+        self.assertTrue(match_filter(doc, {'$or': [{'type': 'Promoter-like'}, {'start': {'$lte': 100}}]}))
+        self.assertTrue(match_filter(doc, {'contig': 'chr1'}, defaults={'contig': 'chr1'}))
+        with self.assertRaises(UnsupportedFilter):
+            match_filter(doc, {'name': {'$regex': 'BRCA'}})
+
+    def test_match_null_and_bool(self):
+        """ Test a missing field matches null like in MongoDB, and booleans don't match numbers """
+        doc = {'start': 100, 'name': None, 'info': {'flag': True, 'count': 1}}
+        self.assertTrue(match_filter(doc, {'end': None}))
+        self.assertTrue(match_filter(doc, {'end': {'$eq': None}, 'name': {'$eq': None}}))
+        self.assertTrue(match_filter(doc, {'end': {'$in': [None, 5]}}))
+        self.assertFalse(match_filter(doc, {'end': {'$ne': None}}))
+        self.assertFalse(match_filter(doc, {'end': {'$nin': [None]}}))
+        self.assertTrue(match_filter(doc, {'end': {'$ne': 5}, 'start': {'$ne': None}}))
+        self.assertTrue(match_filter(doc, {'end': {'$gte': None}}))
+        self.assertFalse(match_filter(doc, {'end': {'$gt': None}}))
+        self.assertFalse(match_filter(doc, {'end': {'$lt': 5}}))
+        self.assertFalse(match_filter(doc, {'info.count': True}))
+        self.assertFalse(match_filter(doc, {'info.flag': 1}))
+        self.assertFalse(match_filter(doc, {'info.flag': {'$in': [1]}}))
+        self.assertTrue(match_filter(doc, {'info.flag': {'$ne': 1}, 'info.count': {'$nin': [True]}}))
+        self.assertFalse(match_filter(doc, {'info.flag': {'$gte': 1}}))
+        self.assertTrue(match_filter(doc, {'info.flag': True, 'info.count': 1.0}))
+
+    def test_residual_filter(self):
+        """ Test residual_filter() only accepts queries with more conditions than the cached query """
+        broad = CanonicalQuery({'type': 'GenomeNode', 'filters': {'info.biosample': 'liver'}})
+        narrow = CanonicalQuery({'type': 'GenomeNode', 'filters': {'info.biosample': 'liver', 'type': 'Enhancer-like'}})
+        self.assertEqual(residual_filter(broad, narrow), {'type': 'Enhancer-like'})
+        self.assertIsNone(residual_filter(narrow, broad))
+        other = CanonicalQuery({'type': 'GenomeNode', 'filters': {'info.biosample': 'lung', 'type': 'Enhancer-like'}})
+        self.assertIsNone(residual_filter(broad, other))
+
+    def test_index(self):
+        """ Test SubsumptionIndex only uses complete results with a projection covering the residual filter """
+        index = SubsumptionIndex()
+        broad = CanonicalQuery({'type': 'GenomeNode', 'filters': {'info.biosample': 'liver'}})
+        index.add(broad, ['_id', 'type'], 'result', 10)
+        narrow = CanonicalQuery({'type': 'GenomeNode', 'filters': {'info.biosample': 'liver', 'type': 'Enhancer-like'}})
+        self.assertEqual(index.find(narrow, ['_id', 'type']), ('result', {'type': 'Enhancer-like'}))
+        self.assertIsNone(index.find(narrow, ['_id']))
+        narrow = CanonicalQuery({'type': 'GenomeNode', 'filters': {'info.biosample': 'liver', 'name': 'x'}})
+        self.assertIsNone(index.find(narrow, ['_id', 'type']))
+        # operators that can't be evaluated in memory go to MongoDB
+        narrow = CanonicalQuery({'type': 'GenomeNode', 'filters': {'info.biosample': 'liver', 'type': {'$regex': '^Enh'}}})
+        self.assertIsNone(index.find(narrow, ['_id', 'type']))
+        with self.assertRaises(UnsupportedFilter):
+            filter_fields({'$or': [{'type': 'SNP'}, {'info.targets': {'$elemMatch': {'$eq': 'CTCF'}}}]})
+        self.assertEqual(filter_fields({'type': {'$in': ['SNP']}, 'info': {'a': 1}}), {'type', 'info'})
+        # results cut by the limit are not complete
+        index = SubsumptionIndex()
+        index.add(CanonicalQuery({'type': 'GenomeNode', 'filters': {}, 'limit': 10}), ['_id', 'type'], 'result', 10)
+        self.assertIsNone(index.find(CanonicalQuery({'type': 'GenomeNode', 'filters': {'type': 'SNP'}}), ['_id', 'type']))
+
+if __name__ == "__main__":
+    unittest.main()
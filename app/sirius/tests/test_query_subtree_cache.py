@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+
+import unittest
+from sirius.tests.timed_test_case import TimedTestCase
+from sirius.query.idset import IdSet
+from sirius.query.subtree_cache import SubtreeCache, subtree_cache, subtree_key, cached_id_set
+
+class CountingNode:
+    """ Fake query node that counts how many times its findid() runs """
+    def __init__(self, cache_key):
+        self.cache_key = cache_key
+        self.n_calls = 0
+
+    @cached_id_set
+    def findid(self, id_filter=None):
+        self.n_calls += 1
+        result = IdSet(['Ga', 'Gb', 'Gc'])
+        if id_filter is not None:
+            result &= id_filter
+        return result
+
+class SubtreeCacheTest(TimedTestCase):
+    def test_subtree_key(self):
+        """ Test subtree_key() is independent of key order """
+        q1 = {'type': 'GenomeNode', 'filters': {'type': 'SNP', 'source': 'dbSNP'}}
+        q2 = {'filters': {'source': 'dbSNP', 'type': 'SNP'}, 'type': 'GenomeNode'}
+        self.assertEqual(subtree_key(q1), subtree_key(q2))
+
+    def test_cache_copies(self):
+        """ Test SubtreeCache.get() returns copies that can be modified in place """
+        cache = SubtreeCache(max_ids=10)
+        cache.set('k', IdSet(['Ga', 'Gb']))
+        result = cache.get('k')
+        result -= ['Ga']
+        self.assertEqual(len(cache.get('k')), 2)
+        # too large to be cached
+        cache.set('big', IdSet(f'G{i}' for i in range(11)))
+        self.assertIsNone(cache.get('big'))
+
+    def test_cached_id_set(self):
+        """ Test cached_id_set decorator with and without id_filter """
+        subtree_cache.clear()
+        node = CountingNode('test_cached_id_set')
+        # a filtered result is not stored
+        self.assertEqual(set(node.findid(id_filter={'Ga'})), {'Ga'})
+        self.assertEqual(len(node.findid()), 3)
+        self.assertEqual(node.n_calls, 2)
+        # the full result is used for both
+        self.assertEqual(len(node.findid()), 3)
+        self.assertEqual(set(node.findid(id_filter={'Gb', 'Gd'})), {'Gb'})
+        self.assertEqual(node.n_calls, 2)
+
+if __name__ == "__main__":
+    unittest.main()
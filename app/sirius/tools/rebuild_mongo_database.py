@@ -676,8 +676,14 @@ def build_mongo_index():
         print("Creating sparse index %s" % idx)
         Edges.create_index(idx, sparse=True)
 
+def build_facets():
+    print("\n\n#5. Building facet tables for distinct values")
+    from sirius.query.facets import build_facet_tables
+    n_tables = build_facet_tables()
+    print(f"{n_tables} facet tables built")
+
 def patch_additional_info():
-    # print("\n\n#5. Patching additional information")
+    # print("\n\n#6. Patching additional information")
     # from sirius.tools import patch_gene_info
     # patch_gene_info.patch_gene_ID_info()
     # we skip this becasue HGNC dataset can do a better job
@@ -696,7 +702,8 @@ Steps:
 2. Delete all data from existing database
 3. Parse each data sets and upload to MongoDB
 4. Build index in data base
-5. Patch additional information
+5. Build facet tables for distinct values
+6. Patch additional information
 
 In Step 3, datasets are parsed and uploaded, in the following order:
 1. ENCODE_bigwig
@@ -740,6 +747,8 @@ def main():
     if args.starting_step <= 4:
         build_mongo_index()
     if args.starting_step <= 5:
+        build_facets()
+    if args.starting_step <= 6:
         patch_additional_info()
     if args.del_tmp:
         clean_up()